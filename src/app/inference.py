@@ -1,11 +1,7 @@
 import os
-import json
+from typing import Dict, Iterator, Tuple, Union
 
-import cv2
-import pandas as pd
-import numpy as np
 import streamlit as st
-from PIL import Image
 
 from app import utils
 from app.example_images import (
@@ -19,15 +15,33 @@ from interface.upload_folder import (
     show_save_visualisations_options,
     show_side_by_side_buttons,
 )
+from inference.columnar import ColumnarResults, write_output_csv
 from inference.infer import run_on_image
 from inference.population_filtering import (
-    Bounding_Boxes,
-    Predicted_Pore_Lengths,
+    Population_Statistics,
     remove_outliers_from_records,
 )
-from inference.utils import get_list_of_images_in_folder, convert_measurements
-from inference.output import create_output_csvs
+from inference.utils import (
+    convert_measurements,
+    get_list_of_images_in_folder,
+    split_into_batches,
+)
+from inference.result_store import get_result_store
+from inference.prefetch import ImagePrefetcher
+from inference.result_cache import (
+    find_uncached_images,
+    maybe_setup_result_cache,
+    merge_with_cached_results,
+)
+from inference.timing import (
+    record_image_stage_times,
+    record_run_stage_times,
+    save_timing_report,
+    start_run_timings,
+    time_stage,
+)
 from inference.visualisation import maybe_visualise_and_save
+from inference.workers import measure_decoded_batches, measure_in_pool
 from tools.load import clean_temporary_folder
 from tools.state import Option_State
 
@@ -84,12 +98,12 @@ def maybe_do_inference_on_all_images_in_folder():
             reset_tracked_predictions()
             do_inference_on_all_images_in_folder()
     if is_inference_available_for_folder():
-        reset_predictions()
-        apply_user_settings()
-        density_filename, measurement_filename = create_output_csvs()
-        display_download_links(density_filename, measurement_filename)
-        display_visualisation_options()
-        maybe_visualise_and_save()
+        density_csv, measurement_csv = maybe_update_output_csvs()
+        display_download_links(density_csv, measurement_csv)
+        # Stomata that were only counted have no measurements to draw
+        if measurement_csv is not None:
+            display_visualisation_options()
+            maybe_visualise_and_save()
 
 
 def is_inference_available_for_folder():
@@ -97,6 +111,7 @@ def is_inference_available_for_folder():
         return False
     check = is_folder_inference_done_using_the_selected_model()
     check = check and is_inference_for_the_current_folder()
+    check = check and is_folder_inference_measured_as_selected()
     return check
 
 
@@ -110,6 +125,13 @@ def is_folder_inference_done_using_the_selected_model():
     return currently_selected_model == model_used_for_inference
 
 
+def is_folder_inference_measured_as_selected():
+    # Stomata that were only counted are measured again if measurements are wanted
+    return (
+        Option_State["folder_inference"]["density_only"] == Option_State["density_only"]
+    )
+
+
 def is_inference_for_the_current_folder():
     current_folder = Option_State["folder_path"]
     available_inference = Option_State["folder_inference"]["name"]
@@ -123,8 +145,7 @@ def is_infer_button_pressed():
 
 
 def reset_tracked_predictions():
-    Predicted_Pore_Lengths = []
-    Bounding_Boxes = []
+    Population_Statistics.clear()
 
 
 def do_inference_on_all_images_in_folder():
@@ -142,55 +163,90 @@ def do_inference_on_all_images_in_folder():
     status_container = st.empty()
 
     n_stoma = 0
-    for filename in image_files:
-        image = np.array(Image.open(f"{directory}/{filename}"))
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-        predictions, time_elapsed = run_on_image(image, n_stoma)
-        record_predictions(predictions, filename, image.shape)
+    start_run_timings()
+    cache = maybe_setup_result_cache()
+    uncached_files = find_uncached_images(cache, directory, image_files)
+    n_workers = min(Option_State["n_workers"], len(uncached_files))
+    prefetcher = None
+    if n_workers > 1:
+        measured = measure_in_pool(uncached_files, n_workers)
+    else:
+        prefetcher = ImagePrefetcher(
+            directory, uncached_files, Option_State["prefetch_depth"]
+        )
+        batches = split_into_batches(prefetcher, Option_State["batch_size"])
+        measured = measure_decoded_batches(batches)
+    for result in merge_with_cached_results(cache, image_files, measured):
+        offset_stoma_ids(result, n_stoma)
+        record_result(result)
+        record_image_stage_times(result)
+        n_stoma += result["n_predictions"]
 
         progress += increment
         progress_bar.progress(int(progress))
 
         with status_container:
-            st.info(f"{filename} completed in {time_elapsed:.2f}s")
+            st.info(f"{result['filename']} completed in {result['time_elapsed']:.2f}s")
 
-        total_time += time_elapsed
-        n_stoma += predictions.n_predictions
+        total_time += result["time_elapsed"]
 
     progress_bar.progress(100)
     progress_bar.empty()
     progress_bar_header.empty()
+    summaries = [] if cache is None else [cache.summary()]
+    if prefetcher is None:
+        summaries.append(f"using {n_workers} worker processes")
+    else:
+        summaries.append(prefetcher.summary())
+    summary = ", ".join(summaries)
     with status_container:
-        st.success(f"Measured {len(image_files)} images in {total_time:.2f}s")
+        st.success(
+            f"Measured {len(image_files)} images in {total_time:.2f}s, {summary}"
+        )
 
-    remove_outliers_from_records()
+    with time_stage("population_filtering"):
+        remove_outliers_from_records()
     Option_State["folder_inference"] = {
         "name": Option_State["folder_path"],
         "model_used": Option_State["plant_type"],
-        "predictions": load_all_saved_predictions(),
+        "density_only": Option_State["density_only"],
+        "results": ColumnarResults(
+            iterate_saved_predictions(), Option_State["density_only"]
+        ),
+        "output_settings": None,
+        "output_csvs": None,
     }
+    maybe_save_timing_report()
 
 
-def record_predictions(
-    predictions,
-    filename,
-    image_size,
-):
-    path = "./output/temp/"
-    store_population_filtering_measurements(predictions)
-    filename = remove_extension_from_filename(filename)
+def maybe_save_timing_report():
+    if not Option_State["stage_timing"]:
+        return
+    record_run_stage_times()
+    run_name = os.path.basename(os.path.normpath(Option_State["folder_path"]))
+    st.info(f"Stage timings saved to {save_timing_report(run_name)}")
+
+
+def offset_stoma_ids(result: Dict, n_stoma: int):
+    # Each image's stoma ids start from zero until it is recorded
+    for detection in result["detections"] + result["invalid_detections"]:
+        detection["stoma_id"] += n_stoma
+
+
+def record_result(result: Dict):
+    store_population_filtering_measurements(result)
+    image_name = remove_extension_from_filename(result["filename"])
     to_save = {
-        "detections": predictions.detections,
-        "invalid_detections": predictions.invalid_detections,
-        "image_size": image_size[:-1],
+        "detections": result["detections"],
+        "invalid_detections": result["invalid_detections"],
+        "image_size": result["image_size"],
     }
-    filepath = path + ".".join([filename, "json"])
-    utils.write_to_json(to_save, filepath)
+    with time_stage("write_record"):
+        get_result_store().add_record(image_name, to_save)
 
 
-def store_population_filtering_measurements(predictions):
-    Bounding_Boxes.extend(predictions.bounding_box_dimensions)
-    Predicted_Pore_Lengths.extend(predictions.pore_lengths)
+def store_population_filtering_measurements(result: Dict):
+    Population_Statistics.add_result(result)
 
 
 def remove_extension_from_filename(filename):
@@ -198,64 +254,73 @@ def remove_extension_from_filename(filename):
     return filename.replace(file_extension, "")
 
 
-def reset_predictions():
-    Option_State["folder_inference"]["predictions"] = load_all_saved_predictions()
-
-
-def apply_user_settings():
-    apply_confidence_filter()
-    apply_immature_stoma_filter()
-    maybe_convert_length_measurement_units()
-
-
-def apply_confidence_filter():
-    apply_function(filter_low_confidence_predictions)
-
-
-def apply_immature_stoma_filter():
-    apply_function(filter_immature_stomata)
-
-
-def apply_function(function):
-    predictions = Option_State["folder_inference"]["predictions"]
-    for i, image in enumerate(predictions):
-        image_predictions = image["detections"]
-        image_predictions = function(image_predictions)
-        predictions[i]["detections"] = image_predictions
+def maybe_update_output_csvs() -> Tuple[Tuple[str, str], Union[Tuple[str, str], None]]:
+    # Reruns that leave the output settings unchanged reuse the written CSVs.
+    # Runs that only count stomata have no measurements CSV
+    folder_inference = Option_State["folder_inference"]
+    settings = get_output_settings()
+    if folder_inference["output_settings"] != settings:
+        results = folder_inference["results"]
+        measurement_csv = None
+        if not folder_inference["density_only"]:
+            measurement_csv = write_output_csv(
+                results.format_measurements(), "pore_measurements"
+            )
+        folder_inference["output_csvs"] = (
+            write_output_csv(results.format_densities(), "density"),
+            measurement_csv,
+        )
+        folder_inference["output_settings"] = settings
+    return folder_inference["output_csvs"]
+
+
+def get_output_settings() -> Tuple:
+    return tuple(
+        Option_State[key]
+        for key in [
+            "confidence_threshold",
+            "minimum_stoma_length",
+            "camera_calibration",
+            "plant_type",
+            "output_path",
+        ]
+    )
 
 
-def maybe_convert_length_measurement_units():
+def apply_user_settings_to_prediction(prediction: Dict):
+    detections = filter_low_confidence_predictions(prediction["detections"])
+    # Stomata that were only counted have no length to judge maturity by
+    if Option_State["density_only"]:
+        prediction["detections"] = detections
+        return
+    detections = filter_immature_stomata(detections)
     if is_valid_calibration():
-        apply_function(convert_measurements)
+        detections = convert_measurements(detections)
+    prediction["detections"] = detections
 
 
-def load_all_saved_predictions():
-    directory = "./output/temp/"
-    files = os.listdir(directory)
-    image_detections = []
-    for file in files:
-        if not file[-4:] == "json":
-            continue
-        with open(os.path.join(directory, file), "r") as read_file:
-            image_data = json.load(read_file)
-            image_data["image_name"] = file[:-5]
-            image_detections.append(image_data)
-    return image_detections
+def iterate_saved_predictions() -> Iterator[Dict]:
+    # Measurements without polygons, which are only loaded to draw an image
+    return get_result_store().iterate_records(include_geometry=False)
 
 
-def display_download_links(density_csv_name, measurement_csv_name):
-    measurement_df = pd.read_csv("./output/temp/" + measurement_csv_name)
-    measurement_button = get_download_csv_button(
-        measurement_df,
-        measurement_csv_name,
-        "Download Pore Measurements",
-    )
-    density_df = pd.read_csv("./output/temp/" + density_csv_name)
+def display_download_links(density_csv, measurement_csv):
+    # Each CSV is a filename and the text written to it
+    density_csv_name, density_text = density_csv
     density_button = get_download_csv_button(
-        density_df,
+        density_text.encode(),
         density_csv_name,
         "Download Density Measurements",
     )
+    if measurement_csv is None:
+        st.write(density_button, unsafe_allow_html=True)
+        return
+    measurement_csv_name, measurement_text = measurement_csv
+    measurement_button = get_download_csv_button(
+        measurement_text.encode(),
+        measurement_csv_name,
+        "Download Pore Measurements",
+    )
     show_side_by_side_buttons(measurement_button, density_button)
 
 
@@ -0,0 +1,48 @@
+from typing import Any, List, Sequence
+
+import numpy as np
+import shapely
+
+from inference.constants import ORPHAN_AREA_THRESHOLD
+from inference.utils import is_bbox_a_in_bbox_b, is_bbox_a_mostly_in_bbox_b
+
+
+class BoundingBoxIndex:
+    """
+    Spatial index over the xyxy bounding boxes of an image's structures, such
+    as its pores or subsidiary cells, built once and queried per stoma complex.
+    Queries return the items the boxes were indexed with, in indexing order.
+    """
+
+    def __init__(self, bboxes: Sequence[List[float]], items: Sequence[Any]):
+        self._bboxes = list(bboxes)
+        self._items = list(items)
+        coordinates = np.array(self._bboxes, dtype=float).reshape(-1, 4)
+        self._tree = shapely.STRtree(shapely.box(*coordinates.T))
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def find_contained_in(self, bbox: List[float]) -> List[Any]:
+        return [
+            self._items[i]
+            for i in self._query_candidates(bbox)
+            if is_bbox_a_in_bbox_b(self._bboxes[i], bbox)
+        ]
+
+    def find_mostly_in(
+        self,
+        bbox: List[float],
+        threshold: float = ORPHAN_AREA_THRESHOLD,
+    ) -> List[Any]:
+        return [
+            self._items[i]
+            for i in self._query_candidates(bbox)
+            if is_bbox_a_mostly_in_bbox_b(self._bboxes[i], bbox, threshold)
+        ]
+
+    def _query_candidates(self, bbox: List[float]) -> List[int]:
+        # Box areas are measured inclusively, so overlaps can reach a pixel beyond
+        x1, y1, x2, y2 = bbox
+        query = shapely.box(x1 - 1, y1 - 1, x2 + 1, y2 + 1)
+        return sorted(self._tree.query(query).tolist())
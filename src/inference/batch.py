@@ -0,0 +1,328 @@
+import argparse
+import os
+import time
+from typing import Dict, Iterable, Iterator, List, Union
+
+import torch
+
+from app.inference import (
+    apply_user_settings_to_prediction,
+    iterate_saved_predictions,
+    offset_stoma_ids,
+    record_result,
+    remove_extension_from_filename,
+)
+from inference.infer import (
+    maybe_download_config_files,
+    maybe_download_model_weights,
+)
+from inference.output import OutputWriter, create_output_csvs
+from inference.prefetch import ImagePrefetcher
+from inference.population_filtering import remove_outliers_from_records
+from inference.timing import (
+    record_image_stage_times,
+    record_run_stage_times,
+    save_timing_report,
+    start_run_timings,
+    time_stage,
+)
+from inference.result_cache import (
+    ResultCache,
+    find_uncached_images,
+    maybe_setup_result_cache,
+    merge_with_cached_results,
+)
+from inference.utils import get_list_of_images_in_folder, split_into_batches
+from inference.workers import (
+    get_worker_settings,
+    measure_decoded_batches,
+    measure_in_pool,
+    setup_worker,
+)
+from tools.constants import DEFAULT_TILE_OVERLAP, PLANT_OPTIONS
+from tools.state import Option_State
+
+
+def main():
+    args = parse_arguments()
+    setup_options(args)
+    image_files = get_list_of_images_in_folder(args.folder)
+    if len(image_files) == 0:
+        print(f"There are no images in {args.folder}")
+        return
+    maybe_download_config_files(args.species)
+    maybe_download_model_weights(args.species)
+    start_time = time.time()
+    start_run_timings()
+    measure_images(image_files, args.workers)
+    finalise_run()
+    time_elapsed = time.time() - start_time
+    print_run_summary(len(image_files), time_elapsed)
+    if args.stage_timing:
+        run_name = os.path.basename(os.path.normpath(args.folder))
+        print(f"Stage timings saved to {save_timing_report(run_name)}")
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m inference.batch",
+        description="Measure all images in a folder without the web interface.",
+    )
+    parser.add_argument("folder", help="Folder containing the images to measure")
+    parser.add_argument("--species", choices=PLANT_OPTIONS, required=True)
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Folder to write the run's records and CSVs to"
+        " (default: ./output/<folder name>_<timestamp>)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes, each holding its own model",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Number of images passed through the model at once",
+    )
+    parser.add_argument(
+        "--prefetch-depth",
+        type=int,
+        default=2,
+        help="Number of images decoded ahead of the model when using one worker",
+    )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        default=0,
+        help="Measure images larger than this in overlapping tiles, 0 disables tiling",
+    )
+    parser.add_argument(
+        "--tile-overlap",
+        type=int,
+        default=DEFAULT_TILE_OVERLAP,
+        help="Overlap between tiles in pixels, should exceed the size of a stoma",
+    )
+    parser.add_argument(
+        "--inference-resolution",
+        type=int,
+        default=0,
+        help="Shortest edge images are resized to before the model,"
+        " 0 uses the model's default",
+    )
+    parser.add_argument(
+        "--calibrated-resolution",
+        action="store_true",
+        help="Derive the resolution from --camera-calibration, downscaling images"
+        " sampled more finely than the species' example images",
+    )
+    parser.add_argument(
+        "--compact-masks",
+        action="store_true",
+        help="Keep masks at the mask head's resolution until they are measured",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Use int8 weights for the model's fully connected layers (CPU only)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["pytorch", "onnx"],
+        default="pytorch",
+        help="Run the model with PyTorch or, exported to ONNX, with ONNX Runtime",
+    )
+    parser.add_argument(
+        "--measurement-mode",
+        choices=["keypoints", "fast"],
+        default="keypoints",
+        help="Measure pores and guard cells along keypoint lines, or faster from"
+        " the ellipses with the same moments as their masks",
+    )
+    parser.add_argument(
+        "--density-only",
+        action="store_true",
+        help="Only count stomata from the model's boxes, skipping masks and"
+        " keypoints, and write only the density CSV",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Measure every image instead of reusing results cached by earlier runs",
+    )
+    parser.add_argument(
+        "--parquet",
+        action="store_true",
+        help="Also save the measurements and densities as Parquet files",
+    )
+    parser.add_argument(
+        "--stage-timing",
+        action="store_true",
+        help="Time each processing stage, saving a JSON report and a Prometheus"
+        " textfile to --timing-output",
+    )
+    parser.add_argument(
+        "--timing-output",
+        default=Option_State["timing_report_path"],
+        help="Folder to save stage timings to (default: %(default)s)",
+    )
+    parser.add_argument("--confidence-threshold", type=float, default=0.6)
+    parser.add_argument("--minimum-stoma-length", type=float, default=0.0)
+    parser.add_argument(
+        "--camera-calibration",
+        type=float,
+        default=0.0,
+        help="Pixels per micron, 0 to report measurements in pixels",
+    )
+    args = parser.parse_args()
+    if not os.path.isdir(args.folder):
+        parser.error(f"{args.folder} is not a directory")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.tile_size > 0 and args.tile_overlap >= args.tile_size:
+        parser.error("--tile-overlap must be smaller than --tile-size")
+    if args.prefetch_depth < 0:
+        parser.error("--prefetch-depth can not be negative")
+    if args.inference_resolution < 0:
+        parser.error("--inference-resolution can not be negative")
+    if args.quantize and torch.cuda.is_available():
+        parser.error("--quantize is only available without a GPU")
+    if args.calibrated_resolution and args.camera_calibration <= 0:
+        parser.error("--calibrated-resolution requires --camera-calibration")
+    if args.output is None:
+        args.output = get_default_output_path(args.folder)
+    if os.path.isdir(args.output) and len(os.listdir(args.output)) > 0:
+        parser.error(f"Output folder {args.output} is not empty")
+    return args
+
+
+def get_default_output_path(folder: str) -> str:
+    directory_name = os.path.basename(os.path.normpath(folder))
+    timestamp = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(".", "output", f"{directory_name}_{timestamp}")
+
+
+def setup_options(args: argparse.Namespace):
+    Option_State["plant_type"] = args.species
+    Option_State["folder_path"] = args.folder
+    Option_State["output_path"] = args.output
+    Option_State["batch_size"] = args.batch_size
+    Option_State["prefetch_depth"] = args.prefetch_depth
+    Option_State["tile_size"] = args.tile_size
+    Option_State["tile_overlap"] = args.tile_overlap
+    Option_State["inference_resolution"][args.species] = args.inference_resolution
+    Option_State["calibrated_resolution"] = args.calibrated_resolution
+    Option_State["compact_masks"] = args.compact_masks
+    Option_State["quantize_model"] = args.quantize
+    Option_State["inference_backend"] = (
+        "ONNX Runtime" if args.backend == "onnx" else "PyTorch"
+    )
+    Option_State["measurement_mode"] = (
+        "Fast" if args.measurement_mode == "fast" else "Keypoints"
+    )
+    Option_State["density_only"] = args.density_only
+    Option_State["use_result_cache"] = not args.no_cache
+    Option_State["parquet_output"] = args.parquet
+    Option_State["stage_timing"] = args.stage_timing
+    Option_State["timing_report_path"] = args.timing_output
+    Option_State["confidence_threshold"] = args.confidence_threshold
+    Option_State["minimum_stoma_length"] = args.minimum_stoma_length
+    Option_State["camera_calibration"] = args.camera_calibration
+    os.makedirs(args.output, exist_ok=True)
+
+
+def measure_images(image_files: List[str], n_workers: int):
+    directory = Option_State["folder_path"]
+    cache = maybe_setup_result_cache()
+    uncached_files = find_uncached_images(cache, directory, image_files)
+    if n_workers == 1 or len(uncached_files) == 0:
+        measure_images_in_process(cache, image_files, uncached_files)
+    else:
+        measure_images_in_pool(cache, image_files, uncached_files, n_workers)
+    if cache is not None:
+        print(cache.summary())
+
+
+def measure_images_in_process(
+    cache: Union[ResultCache, None],
+    image_files: List[str],
+    uncached_files: List[str],
+):
+    if len(uncached_files) > 0:
+        setup_worker(get_worker_settings(), torch.get_num_threads())
+    directory, depth = Option_State["folder_path"], Option_State["prefetch_depth"]
+    prefetcher = ImagePrefetcher(directory, uncached_files, depth)
+    batches = split_into_batches(prefetcher, Option_State["batch_size"])
+    measured = measure_decoded_batches(batches)
+    record_results(merge_with_cached_results(cache, image_files, measured))
+    print(prefetcher.summary())
+
+
+def measure_images_in_pool(
+    cache: Union[ResultCache, None],
+    image_files: List[str],
+    uncached_files: List[str],
+    n_workers: int,
+):
+    measured = measure_in_pool(uncached_files, n_workers)
+    record_results(merge_with_cached_results(cache, image_files, measured))
+
+
+def record_results(results: Iterable[Dict]):
+    # Each image's rows are written once it is recorded, so an interrupted run
+    # keeps the images measured so far. Outliers are only found once every
+    # image is measured, so finalise_run replaces these tables with filtered ones
+    n_stoma = 0
+    with OutputWriter(density_only=Option_State["density_only"]) as writer:
+        for result in results:
+            offset_stoma_ids(result, n_stoma)
+            record_result(result)
+            writer.write_image(get_prediction_with_user_settings(result))
+            record_image_stage_times(result)
+            print(f"{result['filename']} completed in {result['time_elapsed']:.2f}s")
+            n_stoma += result["n_predictions"]
+
+
+def get_prediction_with_user_settings(result: Dict) -> Dict:
+    # Measurements are converted in place, so the recorded detections are copied
+    prediction = {
+        "image_name": remove_extension_from_filename(result["filename"]),
+        "detections": [dict(detection) for detection in result["detections"]],
+        "invalid_detections": result["invalid_detections"],
+        "image_size": result["image_size"],
+    }
+    apply_user_settings_to_prediction(prediction)
+    return prediction
+
+
+def finalise_run():
+    with time_stage("population_filtering"):
+        remove_outliers_from_records()
+    with time_stage("write_csvs"):
+        create_output_csvs(iterate_predictions_with_user_settings())
+    record_run_stage_times()
+
+
+def iterate_predictions_with_user_settings() -> Iterator[Dict]:
+    # Records are streamed into the CSVs rather than all held in memory
+    for prediction in iterate_saved_predictions():
+        apply_user_settings_to_prediction(prediction)
+        yield prediction
+
+
+def print_run_summary(n_images: int, time_elapsed: float):
+    images_per_second = n_images / time_elapsed if time_elapsed > 0 else 0.0
+    print(
+        f"Measured {n_images} images in {time_elapsed:.2f}s"
+        f" ({images_per_second:.2f} images/s)"
+    )
+    print(f"Results saved to {Option_State['output_path']}")
+
+
+if __name__ == "__main__":
+    main()
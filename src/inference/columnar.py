@@ -0,0 +1,201 @@
+import math
+from typing import Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+
+from inference.constants import (
+    COUNT_OUTPUT_COLUMNS,
+    DENSITY_OUTPUT_COLUMNS,
+    DIFFUSIVITY_OF_WATER_IN_AIR_25C,
+    MEASUREMENT_KEYS,
+    MEASUREMENT_OUTPUT_COLUMN_NAMES,
+    MOLAR_VOLUME_OF_WATER_IN_AIR_25C,
+)
+from inference.output import get_output_filename, get_output_filepath
+from inference.result_store import SCALAR_FIELDS
+from tools.state import Option_State
+
+# Measurements converted to microns, as convert_measurements does
+LENGTH_FIELDS = [
+    "pore_width",
+    "pore_length",
+    "guard_cell_groove_length",
+    "guard_cell_width",
+]
+AREA_FIELDS = ["pore_area", "guard_cell_area", "subsidiary_cell_area"]
+INTEGER_FIELDS = ["stoma_id", "category_id"]
+# Output table keys named differently from the detection fields they show
+MEASUREMENT_FIELDS = {"pore_width_to_length_ratio": "width_over_length"}
+# Smallest calibration measurements are converted with, see is_valid_calibration
+MINIMUM_CALIBRATION = 0.0001
+
+
+class ColumnarResults:
+    """
+    The valid detections of a folder held once in memory, one NumPy array
+    per measurement, with the size and number of invalid detections of each
+    image. Output tables are read from it for the current settings: the
+    confidence and immature stomata filters are boolean masks, and units are
+    converted as columns are read, so changing a setting neither reloads nor
+    modifies the records. Stomata that were only counted are filtered by
+    confidence alone, and their densities have no g max.
+    """
+
+    def __init__(self, records: Iterable[Dict], density_only: bool = False):
+        self.density_only = density_only
+        image_names, image_sizes, n_invalid_detections = [], [], []
+        image_indices = []
+        values = {field: [] for field in INTEGER_FIELDS + SCALAR_FIELDS}
+        for index, record in enumerate(records):
+            image_names.append(record["image_name"])
+            image_sizes.append(record["image_size"][:2])
+            n_invalid_detections.append(len(record["invalid_detections"]))
+            image_indices += [index] * len(record["detections"])
+            for field, field_values in values.items():
+                # Non-finite measurements are not stored with the others
+                field_values += [
+                    detection.get(field, math.nan) for detection in record["detections"]
+                ]
+        self.image_names = np.array(image_names, dtype=object)
+        self.image_sizes = np.array(image_sizes, dtype=np.float64).reshape(-1, 2)
+        self.n_invalid_detections = np.array(n_invalid_detections, dtype=np.int64)
+        self.image_indices = np.array(image_indices, dtype=np.int64)
+        self.columns = {
+            field: np.array(
+                field_values,
+                dtype=np.int64 if field in INTEGER_FIELDS else np.float64,
+            )
+            for field, field_values in values.items()
+        }
+        self._measurement_lines = None
+        self._lines_calibration = None
+
+    @property
+    def n_images(self) -> int:
+        return len(self.image_names)
+
+    def __len__(self) -> int:
+        return len(self.image_indices)
+
+    def select(self) -> np.ndarray:
+        # Immature stomata are measured in pixels, before units are converted
+        confident = self.columns["confidence"] >= Option_State["confidence_threshold"]
+        if self.density_only:
+            return confident
+        mature = self.columns["pore_length"] >= Option_State["minimum_stoma_length"]
+        return confident & mature
+
+    def read_column(self, field: str) -> np.ndarray:
+        calibration = get_measurement_calibration()
+        values = self.columns[field]
+        if calibration is None:
+            return values
+        if field in LENGTH_FIELDS:
+            return values / calibration
+        if field in AREA_FIELDS:
+            return values / calibration**2
+        return values
+
+    def format_measurements(self) -> str:
+        lines = self._format_measurement_lines()[self.select()]
+        return format_csv_header(MEASUREMENT_OUTPUT_COLUMN_NAMES) + "".join(lines)
+
+    def _format_measurement_lines(self) -> np.ndarray:
+        # The line of every detection is kept until the calibration it was
+        # converted with changes, so filtering only selects lines
+        calibration = get_measurement_calibration()
+        if self._measurement_lines is None or calibration != self._lines_calibration:
+            columns = [self._read_measurement(key) for key in MEASUREMENT_KEYS]
+            self._measurement_lines = np.array(format_csv_lines(columns), dtype=object)
+            self._lines_calibration = calibration
+        return self._measurement_lines
+
+    def _read_measurement(self, key: str) -> np.ndarray:
+        if key == "image_name":
+            return self.image_names[self.image_indices]
+        if key == "class":
+            return np.where(self.columns["category_id"] != 0, "open", "closed")
+        return self.read_column(MEASUREMENT_FIELDS.get(key, key))
+
+    def format_densities(self) -> str:
+        selected = self.select()
+        n_selected = np.bincount(self.image_indices[selected], minlength=self.n_images)
+        n_stomata = n_selected + self.n_invalid_detections
+        density = n_stomata / calculate_image_areas(self.image_sizes)
+        if self.density_only:
+            lines = format_csv_lines([self.image_names, n_stomata, density])
+            return format_csv_header(COUNT_OUTPUT_COLUMNS) + "".join(lines)
+        pore_depth = self.average_of_images("guard_cell_width", selected) / 2
+        pore_length = self.average_of_images("pore_length", selected) / 2
+        if Option_State["plant_type"] == "Barley":
+            groove_length = (
+                self.average_of_images("guard_cell_groove_length", selected) / 2
+            )
+            a_max = math.pi * groove_length * pore_length
+        else:
+            a_max = math.pi * pore_length**2
+        g_max = calculate_g_max(density, pore_depth, a_max)
+        lines = format_csv_lines([self.image_names, n_stomata, density, g_max])
+        return format_csv_header(DENSITY_OUTPUT_COLUMNS) + "".join(lines)
+
+    def average_of_images(self, field: str, selected: np.ndarray) -> np.ndarray:
+        # Images without selected detections average to zero
+        image_indices = self.image_indices[selected]
+        totals = np.bincount(
+            image_indices,
+            weights=self.read_column(field)[selected],
+            minlength=self.n_images,
+        )
+        counts = np.bincount(image_indices, minlength=self.n_images)
+        averages = np.zeros(self.n_images)
+        np.divide(totals, counts, out=averages, where=counts > 0)
+        return averages
+
+
+def get_measurement_calibration() -> Union[float, None]:
+    calibration = Option_State["camera_calibration"]
+    if calibration > MINIMUM_CALIBRATION:
+        return calibration
+    return None
+
+
+def calculate_image_areas(image_sizes: np.ndarray) -> np.ndarray:
+    heights, widths = image_sizes[:, 0], image_sizes[:, 1]
+    calibration = Option_State["camera_calibration"]
+    if calibration > 0:
+        # Convert to mm
+        heights = heights / calibration / 1000
+        widths = widths / calibration / 1000
+    return heights * widths
+
+
+def calculate_g_max(
+    density: np.ndarray,
+    pore_depth: np.ndarray,
+    a_max: np.ndarray,
+) -> np.ndarray:
+    constant = DIFFUSIVITY_OF_WATER_IN_AIR_25C / MOLAR_VOLUME_OF_WATER_IN_AIR_25C
+    numerator = a_max * density
+    denominator = pore_depth + np.sqrt(a_max * math.pi / 4)
+    g_max = np.zeros(len(density))
+    valid = denominator > 0
+    g_max[valid] = constant * numerator[valid] / denominator[valid] / 1000
+    return g_max
+
+
+def format_csv_header(column_names: List[str]) -> str:
+    return ",".join(column_names) + "\n"
+
+
+def format_csv_lines(columns: List[np.ndarray]) -> List[str]:
+    # Values are written as the output tables write them, without quoting
+    columns = [map(str, column.tolist()) for column in columns]
+    return [",".join(row) + "\n" for row in zip(*columns)]
+
+
+def write_output_csv(csv_text: str, name: str) -> Tuple[str, str]:
+    # Returns the CSV's filename along with its text, to be offered for download
+    filename = get_output_filename(name, "csv")
+    with open(get_output_filepath(filename), "w") as file:
+        file.write(csv_text)
+    return filename, csv_text
@@ -1,5 +1,8 @@
 CLOSE_TO_EDGE_DISTANCE = 20  # In pixels
 CLOSE_TO_EDGE_SIZE_THRESHOLD = 0.85
+# Densities of runs that only count stomata, without the measurements of g max
+COUNT_KEYS = ["image_name", "n_stomata", "density"]
+COUNT_OUTPUT_COLUMNS = ["image name", "number of stomata", "density"]
 DENSITY_KEYS = ["image_name", "n_stomata", "density", "g_max"]
 DENSITY_OUTPUT_COLUMNS = ["image name", "number of stomata", "density", "g max"]
 DIFFUSIVITY_OF_WATER_IN_AIR_25C = 0.0282
@@ -1,53 +1,203 @@
 import os
+import threading
 import time
+from typing import Dict, List, Tuple
+
+import numpy as np
 
 import torch
 import detectron2
 from detectron2.data import MetadataCatalog
+from detectron2.data import transforms as T
 from detectron2.engine.defaults import DefaultPredictor
+from detectron2.modeling.postprocessing import detector_postprocess
+from detectron2.structures import Instances
 from detectron2.utils.visualizer import ColorMode
 
-from inference.predictions import ModelOutput
+from inference.initial_filter import BOX_FIELDS, PREDICTION_FIELDS, select_fields
+from inference.masks import postprocess_with_compact_masks
+from inference.onnx_backend import OnnxModel
+from inference.predictions import ModelOutput, format_model_output
+from inference.resolution import get_test_resolution
+from inference.tiling import is_tiling_required, run_on_tiles
+from inference.timing import add_stage_timing_hooks, time_stage
 from tools.cloud_files import EXTERNAL_DEPENDANCIES
 from tools.load import download_and_save_yaml, download_and_save_model_weights
 from tools.state import Option_State
 
 BASE_CONFIDENCE_THRESHOLD = 0.6
 Inference_Engines = {"Barley": None, "Arabidopsis": None}
+Engine_Setup_Locks = {species: threading.Lock() for species in Inference_Engines}
 
 
 class InferenceEngine:
-    def __init__(self, model_config):
+    def __init__(
+        self,
+        model_config,
+        quantize: bool = False,
+        backend: str = "PyTorch",
+    ):
         self.metadata = MetadataCatalog.get(model_config.DATASETS.TEST[0])
         self.instance_mode = ColorMode.IMAGE
+        self.quantize = quantize
+        self.is_quantized = False
+        self.backend = backend
+        # The pre-processing of DefaultPredictor, shared by both backends
+        self.input_format = model_config.INPUT.FORMAT
+        self.min_size_test = model_config.INPUT.MIN_SIZE_TEST
+        self.max_size_test = model_config.INPUT.MAX_SIZE_TEST
+        self.predictor, self.onnx_model = None, None
+        self._stage_timing_hooks = []
+        if backend == "ONNX Runtime":
+            self.onnx_model = OnnxModel(model_config)
+            return
         self.predictor = DefaultPredictor(model_config)
+        if quantize:
+            self._quantize_model(model_config)
+
+    def _quantize_model(self, model_config):
+        # The options only request quantization without a GPU, see
+        # quantize_model_checkbox and the batch script's arguments
+        if model_config.MODEL.DEVICE != "cpu":
+            return
+        # Weights of the fully connected layers in the box head are stored as int8
+        torch.ao.quantization.quantize_dynamic(
+            self.predictor.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+        self.is_quantized = True
 
     def run_on_image(self, image):
+        return self.run_on_batch([image])[0]
+
+    def run_on_batch(self, images: List[np.ndarray]) -> List[Instances]:
+        self._update_stage_timing_hooks()
+        with time_stage("preprocess"):
+            inputs = [self._prepare_input(image) for image in images]
+        with time_stage("model"):
+            results = self._run_without_postprocessing(inputs)
+        with time_stage("mask_pasting"):
+            return [
+                self._postprocess(result, model_input)
+                for result, model_input in zip(results, inputs)
+            ]
+
+    def _update_stage_timing_hooks(self):
+        # Hooks on the model's submodules only exist while timing is enabled
+        if self.predictor is None:
+            return
+        if Option_State["stage_timing"] and len(self._stage_timing_hooks) == 0:
+            self._stage_timing_hooks = add_stage_timing_hooks(self.predictor.model)
+        elif not Option_State["stage_timing"]:
+            for hook in self._stage_timing_hooks:
+                hook.remove()
+            self._stage_timing_hooks = []
+
+    def _run_without_postprocessing(self, inputs: List[Dict]) -> List[Instances]:
+        if self.onnx_model is not None:
+            return self.onnx_model.inference(inputs)
         with torch.no_grad():
-            predictions = self.predictor(image)
-        return predictions["instances"].to(torch.device("cpu"))
+            if Option_State["density_only"]:
+                return self._run_box_head(inputs)
+            return self.predictor.model.inference(inputs, do_postprocess=False)
+
+    def _run_box_head(self, inputs: List[Dict]) -> List[Instances]:
+        # GeneralizedRCNN.inference without the mask and keypoint heads
+        model = self.predictor.model
+        images = model.preprocess_image(inputs)
+        features = model.backbone(images.tensor)
+        proposals, _ = model.proposal_generator(images, features, None)
+        with time_stage("roi_heads"):
+            return model.roi_heads._forward_box(features, proposals)
+
+    def _postprocess(self, result: Instances, model_input: Dict) -> Instances:
+        height, width = model_input["height"], model_input["width"]
+        # Keypoint heatmaps are never read, and the ONNX model predicts masks
+        # and keypoints that counting has no use for
+        fields = BOX_FIELDS if Option_State["density_only"] else PREDICTION_FIELDS
+        result = select_fields(result, fields)
+        # Compact masks skip detectron2's pasting of masks to the image size
+        if Option_State["compact_masks"]:
+            result = result.to(torch.device("cpu"))
+            return postprocess_with_compact_masks(result, height, width)
+        # Pasted on the model's device, as the model's own post-processing does
+        result = detector_postprocess(result, height, width)
+        return result.to(torch.device("cpu"))
+
+    def _prepare_input(self, image: np.ndarray) -> Dict:
+        # Mirrors the pre-processing DefaultPredictor applies to a single image
+        if self.input_format == "RGB":
+            image = image[:, :, ::-1]
+        height, width = image.shape[:2]
+        transformed = self._get_resize(image).get_transform(image).apply_image(image)
+        transformed = torch.as_tensor(transformed.astype("float32").transpose(2, 0, 1))
+        return {"image": transformed, "height": height, "width": width}
+
+    def _get_resize(self, image: np.ndarray) -> T.ResizeShortestEdge:
+        resolution = get_test_resolution(image.shape[:2], self.min_size_test)
+        max_size = round(self.max_size_test * resolution / self.min_size_test)
+        return T.ResizeShortestEdge([resolution, resolution], max_size)
 
 
 def run_on_image(image, n_stoma: int = 0):
     maybe_setup_inference_engine()
     start_time = time.time()
     demo = Inference_Engines[Option_State["plant_type"]]
-    predictions = demo.run_on_image(image)
+    predictions = run_on_image_or_tiles(demo, image)
     time_elapsed = time.time() - start_time
-    return ModelOutput(predictions, n_stoma), time_elapsed
+    with time_stage("postprocessing"):
+        return format_model_output(predictions, n_stoma), time_elapsed
+
+
+def run_on_batch(images: List[np.ndarray]) -> Tuple[List[ModelOutput], float]:
+    maybe_setup_inference_engine()
+    start_time = time.time()
+    demo = Inference_Engines[Option_State["plant_type"]]
+    if any([is_tiling_required(image) for image in images]):
+        # Each image is split into tiles which are batched instead
+        batch_predictions = [run_on_image_or_tiles(demo, image) for image in images]
+    else:
+        batch_predictions = demo.run_on_batch(images)
+    time_elapsed = time.time() - start_time
+    # Stoma ids of each image start from zero, callers offset them when recording
+    with time_stage("postprocessing"):
+        model_outputs = [
+            format_model_output(predictions, 0) for predictions in batch_predictions
+        ]
+    return model_outputs, time_elapsed
+
+
+def run_on_image_or_tiles(demo: InferenceEngine, image: np.ndarray) -> Instances:
+    if is_tiling_required(image):
+        return run_on_tiles(demo, image)
+    return demo.run_on_image(image)
 
 
 def maybe_setup_inference_engine():
-    selected_species = Option_State["plant_type"]
-    if Inference_Engines[selected_species] is None:
-        setup_inference_engine(selected_species)
+    maybe_setup_species_inference_engine(Option_State["plant_type"])
+
+
+def maybe_setup_species_inference_engine(selected_species):
+    # The background preload may be building the same engine
+    with Engine_Setup_Locks[selected_species]:
+        engine = Inference_Engines[selected_species]
+        if engine is None or not is_engine_up_to_date(engine):
+            setup_inference_engine(selected_species)
+
+
+def is_engine_up_to_date(engine: InferenceEngine) -> bool:
+    is_up_to_date = engine.quantize == Option_State["quantize_model"]
+    return is_up_to_date and engine.backend == Option_State["inference_backend"]
 
 
 def setup_inference_engine(selected_species):
     maybe_download_config_files(selected_species)
     maybe_download_model_weights(selected_species)
     configuration = setup_model_configuration(selected_species.lower())
-    Inference_Engines[selected_species] = InferenceEngine(configuration)
+    Inference_Engines[selected_species] = InferenceEngine(
+        configuration,
+        Option_State["quantize_model"],
+        Option_State["inference_backend"],
+    )
 
 
 def maybe_download_config_files(selected_species):
@@ -84,7 +234,16 @@ def get_model_weights_filepath(selected_species):
     return f"./assets/{selected_species}/weights.pth"
 
 
+def register_stoma_heads():
+    # The model configurations refer to heads registered by this import
+    try:
+        from inference.modeling.stoma_head import KRCNNConvHead, KPROIHeads
+    except Exception as e:
+        print(e)
+
+
 def setup_model_configuration(selected_species):
+    register_stoma_heads()
     cfg = detectron2.config.get_cfg()
     # a dirty fix for the keypoint resolution config
     cfg.MODEL.ROI_KEYPOINT_HEAD.POOLER_RESOLUTION = (14, 14)
@@ -1,15 +1,13 @@
-import copy
 from typing import List, Union
 
+import torch
 from detectron2.structures import Instances
 
 from inference.utils import (
-    is_bbox_a_in_bbox_b,
-    is_bbox_a_mostly_in_bbox_b,
-    is_stomata_complex,
-    is_stomatal_pore,
-    is_overlapping,
-    get_bounding_box,
+    get_class_masks,
+    pairwise_is_bbox_a_in_bbox_b,
+    pairwise_is_bbox_a_mostly_in_bbox_b,
+    pairwise_is_overlapping,
 )
 from inference.constants import (
     CLOSE_TO_EDGE_DISTANCE,
@@ -18,190 +16,141 @@ from inference.constants import (
     SIZE_THRESHOLD,
 )
 
+BOX_FIELDS = ["pred_boxes", "scores", "pred_classes"]
+# The engine's output fields that are read, keypoint heatmaps never are
+PREDICTION_FIELDS = BOX_FIELDS + ["pred_masks", "pred_keypoints"]
+
 
 def filter_invalid_predictions(predictions: Instances) -> Instances:
-    remove_intersecting_predictions(predictions)
-    removed = remove_close_to_edge_detections(predictions)
-    removed = remove_extremely_small_detections(predictions, removed)
-    removed = remove_orphan_detections(predictions, removed)
-    return removed
+    # Each stage is a boolean mask over the original predictions
+    boxes = predictions.pred_boxes.tensor.double()
+    is_complex, is_pore, _ = get_class_masks(predictions)
+    valid = find_best_predictions(boxes, predictions.scores, is_complex)
+    close_to_edge = find_close_to_edge_detections(
+        boxes, is_complex & valid, predictions.image_size
+    )
+    valid &= ~close_to_edge
+    extremely_small = find_extremely_small_detections(boxes, is_complex & valid)
+    valid &= ~extremely_small
+    orphans = find_orphan_detections(boxes, is_complex & valid, is_pore, valid)
+    valid &= ~orphans
+    # Invalid detections are only reported by their boxes, so only those
+    # fields are copied, once, in the order of the stages that removed them
+    invalid = torch.cat(
+        [
+            torch.nonzero(removed).flatten()
+            for removed in [close_to_edge, extremely_small, orphans]
+        ]
+    )
+    invalid_predictions = select_fields(predictions, BOX_FIELDS)[invalid]
+    select_predictions(predictions, valid)
+    return invalid_predictions
+
+
+def find_best_predictions(
+    boxes: torch.Tensor,
+    scores: torch.Tensor,
+    is_complex: torch.Tensor,
+) -> torch.Tensor:
+    # Complexes are kept if they score at least as high as every box they overlap
+    overlapping = pairwise_is_overlapping(boxes, boxes)
+    overlapping.fill_diagonal_(False)
+    is_smaller = scores[:, None] < scores[None, :]
+    is_beaten = (overlapping & is_smaller).any(dim=1)
+    return ~(is_complex & is_beaten)
 
 
 def remove_intersecting_predictions(predictions: Instances):
-    final_indices = []
-    for i in range(len(predictions.pred_boxes)):
-        if is_stomata_complex(i, predictions):
-            if is_best_prediction(i, predictions):
-                final_indices.append(i)
-        else:
-            final_indices.append(i)
-    select_predictions(predictions, final_indices)
-
-
-def is_best_prediction(i: int, predictions: Instances) -> bool:
-    intersecting = get_intersecting_prediction_indices(i, predictions)
-    is_larger = is_score_larger_intersecting_predictions(i, predictions, intersecting)
-    return all(is_larger) or not intersecting
-
-
-def get_intersecting_prediction_indices(i: int, predictions: Instances) -> List[int]:
-    bbox = get_bounding_box(i, predictions)
-    intersecting = [
-        j
-        for j, bbox_j in enumerate(predictions.pred_boxes)
-        if not i == j and is_overlapping(bbox, bbox_j)
-    ]
-    return intersecting
-
-
-def is_score_larger_intersecting_predictions(
-    i: int,
-    predictions: Instances,
-    intersecting: List[int],
-) -> List[bool]:
-    is_larger = [
-        predictions.scores[i].item() >= predictions.scores[j].item()
-        for j in intersecting
-    ]
-    return is_larger
+    boxes = predictions.pred_boxes.tensor.double()
+    is_complex, _, _ = get_class_masks(predictions)
+    best = find_best_predictions(boxes, predictions.scores, is_complex)
+    select_predictions(predictions, best)
 
 
 def select_predictions(
     predictions: Instances,
-    indices: List[int],
-    inplace=True,
-) -> Union[Instances, None]:
-    if not inplace:
-        predictions = copy.deepcopy(predictions)
+    indices: Union[List[int], torch.Tensor],
+):
+    # Runs that only count stomata have no masks or keypoints
     predictions.pred_boxes.tensor = predictions.pred_boxes.tensor[indices]
-    predictions.scores = predictions.scores[indices]
-    predictions.pred_classes = predictions.pred_classes[indices]
-    predictions.pred_masks = predictions.pred_masks[indices]
-    predictions.pred_keypoints = predictions.pred_keypoints[indices]
-    predictions.pred_keypoint_heatmaps = predictions.pred_keypoint_heatmaps[indices]
-    if not inplace:
-        return predictions
-
-
-def remove_close_to_edge_detections(predictions: Instances) -> Instances:
-    valid_indices, invalid_indices = [], []
-    average_area = calculate_average_bbox_area(predictions)
-    for i in range(len(predictions.pred_boxes)):
-        if is_stomata_complex(i, predictions):
-            if is_detection_too_close_to_edge(i, predictions, average_area):
-                invalid_indices.append(i)
-            else:
-                valid_indices.append(i)
-        else:
-            valid_indices.append(i)
-    invalid = select_predictions(predictions, invalid_indices, inplace=False)
-    select_predictions(predictions, valid_indices)
-    return invalid
-
-
-def calculate_average_bbox_area(predictions: Instances) -> float:
-    areas = [
-        calculate_bbox_area(bbox)
-        for i, bbox in enumerate(predictions.pred_boxes)
-        if is_stomata_complex(i, predictions)
-    ]
+    for field, values in list(predictions.get_fields().items()):
+        if field != "pred_boxes":
+            predictions.set(field, values[indices])
+
+
+def select_fields(predictions: Instances, fields: List[str]) -> Instances:
+    # The selected fields are shared with predictions, not copied
+    return Instances(
+        predictions.image_size,
+        **{field: predictions.get(field) for field in fields},
+    )
+
+
+def find_close_to_edge_detections(
+    boxes: torch.Tensor,
+    is_complex: torch.Tensor,
+    image_size: List[int],
+) -> torch.Tensor:
+    average_area = calculate_average_bbox_area(boxes, is_complex)
+    is_near_edge = is_bbox_near_edge(boxes, *image_size)
+    is_small = calculate_bbox_area(boxes) < CLOSE_TO_EDGE_SIZE_THRESHOLD * average_area
+    return is_complex & is_near_edge & is_small
+
+
+def calculate_average_bbox_area(boxes: torch.Tensor, is_complex: torch.Tensor) -> float:
+    areas = calculate_bbox_area(boxes[is_complex]).tolist()
     n_bbox = len(areas)
     if n_bbox == 0:
         return 0
+    # Summed in order to match the per-detection implementation exactly
     return sum(areas) / n_bbox
 
 
-def is_detection_too_close_to_edge(
-    i: int,
-    predictions: Instances,
-    average_area: float,
-) -> bool:
-    image_height, image_width = predictions.image_size
-    bbox = get_bounding_box(i, predictions)
-    is_near_edge = is_bbox_near_edge(bbox, image_height, image_width)
-    is_significantly_smaller_than_average = is_bbox_small(bbox, average_area)
-    return is_near_edge and is_significantly_smaller_than_average
-
-
-def is_bbox_near_edge(bbox: List[float], image_height: int, image_width: int) -> bool:
-    x1, y1, x2, y2 = bbox
-    is_near_edge = any(
-        [
-            x1 < CLOSE_TO_EDGE_DISTANCE,
-            y1 < CLOSE_TO_EDGE_DISTANCE,
-            image_width - x2 < CLOSE_TO_EDGE_DISTANCE,
-            image_height - y2 < CLOSE_TO_EDGE_DISTANCE,
-        ]
+def is_bbox_near_edge(
+    boxes: torch.Tensor,
+    image_height: int,
+    image_width: int,
+) -> torch.Tensor:
+    x1, y1, x2, y2 = boxes.unbind(dim=1)
+    is_near_edge = (
+        (x1 < CLOSE_TO_EDGE_DISTANCE)
+        | (y1 < CLOSE_TO_EDGE_DISTANCE)
+        | (image_width - x2 < CLOSE_TO_EDGE_DISTANCE)
+        | (image_height - y2 < CLOSE_TO_EDGE_DISTANCE)
     )
     return is_near_edge
 
 
-def is_bbox_small(bbox: List[float], average_area: float) -> bool:
-    threshold_area = CLOSE_TO_EDGE_SIZE_THRESHOLD * average_area
-    bbox_area = calculate_bbox_area(bbox)
-    return bbox_area < threshold_area
-
-
-def calculate_bbox_area(bbox: List[float]) -> float:
-    width = abs(bbox[2] - bbox[0])
-    height = abs(bbox[3] - bbox[1])
+def calculate_bbox_area(boxes: torch.Tensor) -> torch.Tensor:
+    width = (boxes[:, 2] - boxes[:, 0]).abs()
+    height = (boxes[:, 3] - boxes[:, 1]).abs()
     return width * height
 
 
-def remove_extremely_small_detections(
-    predictions: Instances,
-    removed_predictions: Instances,
-) -> Instances:
-    valid_indices, invalid_indices = [], []
-    average_area = calculate_average_bbox_area(predictions)
-    for i, bbox_i in enumerate(predictions.pred_boxes):
-        if is_stomata_complex(i, predictions):
-            if is_bbox_extremely_small(bbox_i, average_area):
-                invalid_indices.append(i)
-            else:
-                valid_indices.append(i)
-        else:
-            valid_indices.append(i)
-    invalid = select_predictions(predictions, invalid_indices, inplace=False)
-    select_predictions(predictions, valid_indices)
-    return Instances.cat([removed_predictions, invalid])
-
-
-def is_bbox_extremely_small(bbox: List[float], average_area: float) -> bool:
-    return calculate_bbox_area(bbox) < average_area * SIZE_THRESHOLD
-
-
-def remove_orphan_detections(
-    predictions: Instances,
-    removed_predictions: Instances,
-) -> Instances:
-    valid_indices, invalid_indices = [], []
-    for i in range(len(predictions.pred_boxes)):
-        if not is_stomata_complex(i, predictions):
-            bbox = get_bounding_box(i, predictions)
-            if is_orphan(i, bbox, predictions):
-                invalid_indices.append(i)
-            else:
-                valid_indices.append(i)
-        else:
-            valid_indices.append(i)
-    invalid = select_predictions(predictions, invalid_indices, inplace=False)
-    select_predictions(predictions, valid_indices)
-    return Instances.cat([removed_predictions, invalid])
-
-
-def is_orphan(i: int, bbox: List[float], predictions: Instances) -> bool:
-    for j in range(len(predictions.pred_boxes)):
-        if is_stomata_complex(j, predictions):
-            stomata_bbox = get_bounding_box(j, predictions)
-            if is_stomatal_pore(i, predictions):
-                if is_bbox_a_in_bbox_b(bbox, stomata_bbox):
-                    return False
-            else:
-                if _is_bbox_a_mostly_in_bbox_b(bbox, stomata_bbox):
-                    return False
-    return True
-
-
-def _is_bbox_a_mostly_in_bbox_b(bbox_a: List[float], bbox_b: List[float]) -> bool:
-    return is_bbox_a_mostly_in_bbox_b(bbox_a, bbox_b, ORPHAN_AREA_THRESHOLD)
+def find_extremely_small_detections(
+    boxes: torch.Tensor,
+    is_complex: torch.Tensor,
+) -> torch.Tensor:
+    average_area = calculate_average_bbox_area(boxes, is_complex)
+    is_extremely_small = calculate_bbox_area(boxes) < average_area * SIZE_THRESHOLD
+    return is_complex & is_extremely_small
+
+
+def find_orphan_detections(
+    boxes: torch.Tensor,
+    is_complex: torch.Tensor,
+    is_pore: torch.Tensor,
+    valid: torch.Tensor,
+) -> torch.Tensor:
+    # Pores must sit inside a complex, other structures mostly inside one
+    is_structure = valid & ~is_complex
+    structures, complexes = boxes[is_structure], boxes[is_complex]
+    is_contained = pairwise_is_bbox_a_in_bbox_b(structures, complexes)
+    is_mostly_contained = pairwise_is_bbox_a_mostly_in_bbox_b(
+        structures, complexes, ORPHAN_AREA_THRESHOLD
+    )
+    is_structure_pore = is_pore[is_structure][:, None]
+    has_parent = torch.where(is_structure_pore, is_contained, is_mostly_contained)
+    orphans = torch.zeros_like(valid)
+    orphans[is_structure] = ~has_parent.any(dim=1)
+    return orphans
@@ -0,0 +1,114 @@
+from fractions import Fraction
+from typing import Tuple
+
+import numpy as np
+
+# Bound on the rounding error of an orientation determinant computed in double
+# precision, relative to the sum of its terms' magnitudes (Shewchuk, 1997)
+EPSILON = np.finfo(np.float64).eps / 2
+ORIENTATION_ERROR_BOUND = (3 + 16 * EPSILON) * EPSILON
+# Crossings this close to the end of a line may fall either side of it
+LINE_END_TOLERANCE = 1e-9
+
+
+def find_outermost_crossings(
+    lines: np.ndarray,
+    vertices: np.ndarray,
+    ring_lengths: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Intersects each line segment, an (n, 2, 2) array of end points, with the
+    # edges of its own ring, all at once. The rings' vertices are concatenated
+    # in an (m, 2) array, each ring's first vertex not repeated at its end,
+    # with the number of vertices of each ring in ring_lengths. Returns
+    # the two crossings furthest apart along each line, the number of
+    # crossings, and whether a line is degenerate: it runs along an edge,
+    # ends on its ring, has no length or non-finite coordinates, or its ring
+    # has too few vertices. Degenerate lines should be intersected by other
+    # means.
+    n_lines = len(lines)
+    outermost = np.full((n_lines, 2, 2), np.nan)
+    is_degenerate = ring_lengths < 3
+    is_degenerate |= ~np.isfinite(lines).all(axis=(1, 2))
+    direction = lines[:, 1] - lines[:, 0]
+    is_degenerate |= (direction == 0).all(axis=1)
+    if ring_lengths.sum() == 0:
+        return outermost, np.zeros(n_lines, dtype=np.int64), is_degenerate
+    line_indices = np.repeat(np.arange(n_lines), ring_lengths)
+    next_vertices = get_next_vertex_indices(ring_lengths)
+    # Which side of its line each vertex lies on, decided exactly when
+    # rounding could change the sign
+    start = lines[line_indices, 0]
+    d = direction[line_indices]
+    relative = vertices - start
+    left_term = d[:, 0] * relative[:, 1]
+    right_term = d[:, 1] * relative[:, 0]
+    determinant = left_term - right_term
+    error_bound = ORIENTATION_ERROR_BOUND * (np.abs(left_term) + np.abs(right_term))
+    side = np.sign(determinant)
+    for k in np.flatnonzero(~(np.abs(determinant) > error_bound)):
+        side[k] = calculate_exact_side(lines[line_indices[k]], vertices[k])
+    is_degenerate[np.unique(line_indices[np.isnan(side)])] = True
+    next_side = side[next_vertices]
+    is_degenerate[np.unique(line_indices[(side == 0) & (next_side == 0)])] = True
+    # Crossings are found along the line, so a horizontal line's crossings
+    # share its height exactly
+    is_crossing = side * next_side < 0
+    edges = vertices[next_vertices[is_crossing]] - vertices[is_crossing]
+    crossing_d = d[is_crossing]
+    crossing_relative = relative[is_crossing]
+    crossing_t = (
+        crossing_relative[:, 0] * edges[:, 1] - crossing_relative[:, 1] * edges[:, 0]
+    ) / (crossing_d[:, 0] * edges[:, 1] - crossing_d[:, 1] * edges[:, 0])
+    crossing_points = lines[line_indices[is_crossing], 0]
+    crossing_points = crossing_points + crossing_t[:, None] * crossing_d
+    # A vertex on the line is a single crossing, at the vertex itself
+    is_on_line = side == 0
+    on_line_d = d[is_on_line]
+    on_line_t = (relative[is_on_line] * on_line_d).sum(axis=1) / (
+        on_line_d * on_line_d
+    ).sum(axis=1)
+    crossing_lines = np.concatenate(
+        [line_indices[is_crossing], line_indices[is_on_line]]
+    )
+    t = np.concatenate([crossing_t, on_line_t])
+    points = np.concatenate([crossing_points, vertices[is_on_line]])
+    is_near_end = (np.abs(t) < LINE_END_TOLERANCE) | (
+        np.abs(t - 1) < LINE_END_TOLERANCE
+    )
+    is_degenerate[crossing_lines[is_near_end]] = True
+    is_within = (t >= 0) & (t <= 1)
+    crossing_lines, t, points = (
+        crossing_lines[is_within],
+        t[is_within],
+        points[is_within],
+    )
+    n_crossings = np.bincount(crossing_lines, minlength=n_lines)
+    # The first and last crossing of each line, ordered along it
+    order = np.lexsort((t, crossing_lines))
+    first = np.cumsum(n_crossings) - n_crossings
+    has_crossings = n_crossings > 0
+    first_indices = order[first[has_crossings]]
+    last_indices = order[first[has_crossings] + n_crossings[has_crossings] - 1]
+    outermost[has_crossings, 0] = points[first_indices]
+    outermost[has_crossings, 1] = points[last_indices]
+    return outermost, n_crossings, is_degenerate
+
+
+def calculate_exact_side(line: np.ndarray, vertex: np.ndarray) -> float:
+    # The sign of the orientation determinant in exact rational arithmetic,
+    # or NaN for non-finite coordinates
+    if not (np.isfinite(line).all() and np.isfinite(vertex).all()):
+        return np.nan
+    (x_1, y_1), (x_2, y_2) = [[Fraction(value) for value in point] for point in line]
+    x, y = [Fraction(value) for value in vertex]
+    determinant = (x_2 - x_1) * (y - y_1) - (y_2 - y_1) * (x - x_1)
+    return float((determinant > 0) - (determinant < 0))
+
+
+def get_next_vertex_indices(ring_lengths: np.ndarray) -> np.ndarray:
+    # Each ring's last vertex is joined to its first
+    ends = np.cumsum(ring_lengths)
+    next_indices = np.arange(1, ends[-1] + 1)
+    is_last = ring_lengths > 0
+    next_indices[ends[is_last] - 1] = (ends - ring_lengths)[is_last]
+    return next_indices
@@ -0,0 +1,247 @@
+import itertools
+from typing import List, Tuple, Union
+
+import numpy as np
+import shapely.geometry as shapes
+from shapely import affinity
+
+from inference.intersection import find_outermost_crossings
+
+NO_KEYPOINTS = [-1, -1, 1, -1, -1, 1]
+# Keypoint lines are scaled so they extend beyond the polygon
+LINE_SCALE_FACTOR = 10
+# Crossings closer in y are ordered as shapely orders them
+LEVEL_TOLERANCE = 1e-9
+
+
+def extract_AB_from_polygon(
+    x_values: List[float],
+    y_values: List[float],
+) -> List[float]:
+    x_min, x_max = min(x_values), max(x_values)
+    y_min, y_max = min(y_values), max(y_values)
+    x_extent = x_max - x_min
+    y_extent = y_max - y_min
+    # Enables pores of arbitrary orientation
+    if x_extent > y_extent:
+        major_axis_values = x_values
+        minor_axis_values = y_values
+        maximum_major_value = x_max
+        minimum_major_value = x_min
+    else:
+        major_axis_values = y_values
+        minor_axis_values = x_values
+        maximum_major_value = y_max
+        minimum_major_value = y_min
+    # Left/Right along major axis
+    left_hand_values, right_hand_values = [], []
+    for i, minor_value in enumerate(minor_axis_values):
+        if maximum_major_value == major_axis_values[i]:
+            right_hand_values.append(minor_value)
+        if minimum_major_value == major_axis_values[i]:
+            left_hand_values.append(minor_value)
+    # Use midpoint of extreme values as keypoint value
+    right_hand_value = (right_hand_values[0] + right_hand_values[-1]) / 2
+    left_hand_value = (left_hand_values[0] + left_hand_values[-1]) / 2
+
+    if x_extent > y_extent:
+        keypoints = [
+            minimum_major_value,
+            left_hand_value,
+            1,
+            maximum_major_value,
+            right_hand_value,
+            1,
+        ]
+    else:
+        keypoints = [
+            left_hand_value,
+            minimum_major_value,
+            1,
+            right_hand_value,
+            maximum_major_value,
+            1,
+        ]
+    return keypoints
+
+
+def find_CD(
+    polygon: List[float],
+    keypoints: Union[List[float], None] = None,
+) -> List[float]:
+    return find_keypoints(polygon, keypoints, flip_line=True)
+
+
+def find_AB(
+    polygon: List[float],
+    keypoints: Union[List[float], None] = None,
+) -> List[float]:
+    return find_keypoints(polygon, keypoints, flip_line=False)
+
+
+def find_CD_batch(
+    polygons: List[List[float]],
+    keypoints: List[Union[List[float], None]],
+) -> List[List[float]]:
+    return find_keypoints_batch(polygons, keypoints, flip_line=True)
+
+
+def find_AB_batch(
+    polygons: List[List[float]],
+    keypoints: List[Union[List[float], None]],
+) -> List[List[float]]:
+    return find_keypoints_batch(polygons, keypoints, flip_line=False)
+
+
+def find_keypoints_batch(
+    polygons: List[List[float]],
+    keypoints: List[Union[List[float], None]],
+    flip_line: bool,
+) -> List[List[float]]:
+    # Intersects every polygon with its line at once, lines the kernel cannot
+    # intersect exactly, or whose crossings are level, are left to shapely
+    results = [list(NO_KEYPOINTS) for _ in polygons]
+    # If no mask is predicted, there are no keypoints
+    indices = [i for i, polygon in enumerate(polygons) if len(polygon) > 0]
+    if len(indices) == 0:
+        return results
+    keypoints_AB = []
+    for i in indices:
+        polygon_keypoints = keypoints[i]
+        if polygon_keypoints is None:
+            polygon = polygons[i]
+            polygon_keypoints = extract_AB_from_polygon(polygon[0::2], polygon[1::2])
+        keypoints_AB.append([polygon_keypoints[k] for k in [0, 1, 3, 4]])
+    lines = get_keypoint_lines(np.array(keypoints_AB).reshape(-1, 2, 2), flip_line)
+    vertices, ring_lengths = concatenate_rings([polygons[i] for i in indices])
+    outermost, n_crossings, is_degenerate = find_outermost_crossings(
+        lines, vertices, ring_lengths
+    )
+    for j, i in enumerate(indices):
+        (x_1, y_1), (x_2, y_2) = outermost[j].tolist()
+        if not is_degenerate[j] and n_crossings[j] < 2:
+            continue
+        if is_degenerate[j] or is_level(y_1, y_2):
+            results[i] = find_keypoints(polygons[i], keypoints[i], flip_line)
+        # C is the crossing with the smaller y value
+        elif y_1 > y_2:
+            results[i] = [x_2, y_2, 1, x_1, y_1, 1]
+        else:
+            results[i] = [x_1, y_1, 1, x_2, y_2, 1]
+    return results
+
+
+def concatenate_rings(polygons: List[List[float]]) -> Tuple[np.ndarray, np.ndarray]:
+    # Vertices of all polygons in one array, without closing vertices
+    ring_lengths = np.array([len(polygon) // 2 for polygon in polygons])
+    coordinates = np.fromiter(itertools.chain.from_iterable(polygons), dtype=np.float64)
+    vertices = coordinates.reshape(-1, 2)
+    ends = np.cumsum(ring_lengths)
+    starts = ends - ring_lengths
+    is_closed = ring_lengths > 1
+    is_closed[is_closed] = (
+        vertices[starts[is_closed]] == vertices[ends[is_closed] - 1]
+    ).all(axis=1)
+    is_kept = np.ones(len(vertices), dtype=bool)
+    is_kept[ends[is_closed] - 1] = False
+    return vertices[is_kept], ring_lengths - is_closed
+
+
+def get_keypoint_lines(keypoints_AB: np.ndarray, flip_line: bool) -> np.ndarray:
+    # The line through A and B, or its perpendicular, scaled tenfold about its
+    # centre, with the arithmetic of shapely's affinity module
+    lines = keypoints_AB
+    if flip_line:
+        x_0, y_0 = get_line_centres(lines)
+        cos, sin = 0.0, 1.0
+        x_offset = x_0 - x_0 * cos + y_0 * sin
+        y_offset = y_0 - x_0 * sin - y_0 * cos
+        lines = transform_lines(lines, [[cos, -sin], [sin, cos]], x_offset, y_offset)
+    x_0, y_0 = get_line_centres(lines)
+    factor = float(LINE_SCALE_FACTOR)
+    x_offset = x_0 - x_0 * factor
+    y_offset = y_0 - y_0 * factor
+    return transform_lines(lines, [[factor, 0.0], [0.0, factor]], x_offset, y_offset)
+
+
+def get_line_centres(lines: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Centres of the lines' bounding boxes, for each line an (x, y) column
+    centres = (lines.max(axis=1) + lines.min(axis=1)) / 2.0
+    return centres[:, 0:1], centres[:, 1:2]
+
+
+def transform_lines(
+    lines: np.ndarray,
+    matrix: List[List[float]],
+    x_offset: np.ndarray,
+    y_offset: np.ndarray,
+) -> np.ndarray:
+    (a, b), (d, e) = matrix
+    x, y = lines[:, :, 0], lines[:, :, 1]
+    return np.stack([a * x + b * y + x_offset, d * x + e * y + y_offset], axis=2)
+
+
+def is_level(y_1: float, y_2: float) -> bool:
+    # Which of two level crossings is C depends on the order shapely finds them
+    tolerance = LEVEL_TOLERANCE * max(1.0, abs(y_1), abs(y_2))
+    return abs(y_1 - y_2) <= tolerance
+
+
+def find_keypoints(
+    polygon: List[float],
+    keypoints: Union[List[float], None],
+    flip_line: bool,
+) -> List[float]:
+    # If no mask is predicted
+    if len(polygon) < 1:
+        #    counter += 1
+        return [-1, -1, 1, -1, -1, 1]
+
+    x_points = [x for x in polygon[0::2]]
+    y_points = [y for y in polygon[1::2]]
+
+    if keypoints is None:
+        keypoints = extract_AB_from_polygon(x_points, y_points)
+    # Convert to shapely linear ring
+    polygon = [[x, y] for x, y in zip(x_points, y_points)]
+    mask = shapes.LinearRing(polygon)
+    # Find line perpendicular to AB
+    A = shapes.Point(keypoints[0], keypoints[1])
+    B = shapes.Point(keypoints[3], keypoints[4])
+
+    l_AB = shapes.LineString([A, B])
+    if flip_line:
+        l_perp = affinity.rotate(l_AB, 90)
+    else:
+        l_perp = l_AB
+    l_perp = affinity.scale(l_perp, LINE_SCALE_FACTOR, LINE_SCALE_FACTOR)
+    # Find intersection with polygon
+    try:
+        intersections = l_perp.intersection(mask)
+    except Exception:
+        intersections = shapes.collection.GeometryCollection()
+    # If there is no intersection or only one point of intersection
+    if intersections.is_empty or type(intersections) is shapes.Point:
+        return [-1, -1, 1, -1, -1, 1]
+    # If there are multiple intersections, pick the largest
+    if len(intersections.geoms) > 2:
+        intersections = select_longest_line(intersections)
+
+    if intersections.geoms[0].coords.xy[1] > intersections.geoms[1].coords.xy[1]:
+        D = intersections.geoms[0].coords.xy
+        C = intersections.geoms[1].coords.xy
+    else:
+        D = intersections.geoms[1].coords.xy
+        C = intersections.geoms[0].coords.xy
+    return [C[0][0], C[1][0], 1, D[0][0], D[1][0], 1]
+
+
+def select_longest_line(multipoint):
+    lines, lengths = [], []
+    for i, point_1 in enumerate(multipoint.geoms):
+        for point_2 in multipoint.geoms[i + 1 :].geoms:
+            lines.append(shapes.LineString([point_1, point_2]))
+            lengths.append(lines[-1].length)
+    longest_line_idx = max(range(len(lengths)), key=lambda i: lengths[i])
+    longest_line = lines[longest_line_idx]
+    return shapes.MultiPoint(list(longest_line.coords))
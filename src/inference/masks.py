@@ -0,0 +1,240 @@
+from typing import List, Tuple
+
+import numpy as np
+import shapely
+import torch
+from detectron2.layers.mask_ops import _do_paste_mask
+from detectron2.structures import Instances
+from detectron2.utils.visualizer import GenericMask
+
+from inference.utils import build_polygons
+
+MASK_THRESHOLD = 0.5
+
+
+class CroppedMasks:
+    """
+    Instance masks stored as patches covering each detection's bounding box,
+    along with the (x, y) offset of every patch within the full image.
+    Supports the indexing and concatenation Instances needs, so it can be used
+    as the pred_masks field without pasting masks to the full image size.
+    """
+
+    def __init__(
+        self,
+        patches: List[np.ndarray],
+        offsets: List[Tuple[int, int]],
+        image_size: Tuple[int, int],
+    ):
+        self.patches = patches
+        self.offsets = offsets
+        self.image_size = image_size
+
+    def __len__(self) -> int:
+        return len(self.patches)
+
+    def __getitem__(self, item) -> "CroppedMasks":
+        indices = to_indices(item, len(self))
+        return CroppedMasks(
+            [self.patches[i] for i in indices],
+            [self.offsets[i] for i in indices],
+            self.image_size,
+        )
+
+    @classmethod
+    def cat(cls, masks_list: List["CroppedMasks"]) -> "CroppedMasks":
+        patches, offsets = [], []
+        for masks in masks_list:
+            patches.extend(masks.patches)
+            offsets.extend(masks.offsets)
+        return cls(patches, offsets, masks_list[0].image_size)
+
+    def get_generic_mask(self, i: int) -> GenericMask:
+        return get_generic_mask(self.patches[i], self.offsets[i])
+
+
+class LowResolutionMasks:
+    """
+    Mask head outputs kept at their native resolution (M x M probabilities)
+    along with the box each is pasted into. A mask is only rasterised into a
+    patch covering its box when its polygons are needed, so an image's masks
+    take a few MB instead of N full image sized masks.
+    """
+
+    def __init__(
+        self,
+        masks: torch.Tensor,
+        boxes: torch.Tensor,
+        image_size: Tuple[int, int],
+    ):
+        self.masks = masks
+        self.boxes = boxes
+        self.image_size = image_size
+
+    def __len__(self) -> int:
+        return len(self.masks)
+
+    def __getitem__(self, item) -> "LowResolutionMasks":
+        indices = torch.as_tensor(to_indices(item, len(self)), dtype=torch.long)
+        return LowResolutionMasks(
+            self.masks[indices], self.boxes[indices], self.image_size
+        )
+
+    @classmethod
+    def cat(cls, masks_list: List["LowResolutionMasks"]) -> "LowResolutionMasks":
+        masks = torch.cat([masks.masks for masks in masks_list])
+        boxes = torch.cat([masks.boxes for masks in masks_list])
+        return cls(masks, boxes, masks_list[0].image_size)
+
+    def get_generic_mask(self, i: int) -> GenericMask:
+        patch, offset = paste_mask_in_box(self.masks[i], self.boxes[i], self.image_size)
+        return get_generic_mask(patch, offset)
+
+    def translate(
+        self,
+        offset: Tuple[int, int],
+        image_size: Tuple[int, int],
+    ) -> "LowResolutionMasks":
+        x, y = offset
+        boxes = self.boxes + torch.tensor([x, y, x, y], dtype=self.boxes.dtype)
+        return LowResolutionMasks(self.masks, boxes, image_size)
+
+
+class DecodedMask:
+    """
+    Area and polygons of a single instance mask, in image coordinates, along
+    with the index of its largest polygon. Decoding happens once, so a mask
+    shared by several stoma complexes is only converted to polygons once.
+    The shapely polygons and the largest polygon are only known once the
+    mask has been measured, along with the other masks of its image, by
+    measure_decoded_masks.
+    """
+
+    def __init__(self, mask: GenericMask):
+        self.area = mask.area()
+        self.polygons = [polygon.tolist() for polygon in mask.polygons]
+        self.shapely_polygons = None
+        self.i_largest = None
+
+    @property
+    def largest_polygon(self) -> List[float]:
+        return self.polygons[self.i_largest]
+
+
+def measure_decoded_masks(masks: List[DecodedMask]):
+    # The polygons of all the masks are built, and their areas found, in
+    # single calls to shapely. Each mask is given its slice of the polygons
+    polygons = [polygon for mask in masks for polygon in mask.polygons]
+    shapely_polygons = build_polygons(polygons)
+    areas = shapely.area(shapely_polygons)
+    start = 0
+    for mask in masks:
+        end = start + len(mask.polygons)
+        mask.shapely_polygons = shapely_polygons[start:end]
+        mask.i_largest = int(np.argmax(areas[start:end]))
+        start = end
+
+
+def decode_mask(masks, i: int, box: List[float]) -> DecodedMask:
+    if isinstance(masks, (CroppedMasks, LowResolutionMasks)):
+        return DecodedMask(masks.get_generic_mask(i))
+    # Masks are pasted within their box, so the rest of the frame is empty
+    x1, y1, x2, y2 = get_crop_window(box, tuple(masks.shape[1:]))
+    patch = masks[i, y1:y2, x1:x2].cpu().numpy()
+    return DecodedMask(get_generic_mask(patch, (x1, y1)))
+
+
+def get_generic_mask(patch: np.ndarray, offset: Tuple[int, int]) -> GenericMask:
+    mask = GenericMask(patch, *patch.shape)
+    shift_polygons(mask.polygons, offset)
+    return mask
+
+
+def to_indices(item, length: int) -> List[int]:
+    if isinstance(item, slice):
+        return list(range(length))[item]
+    if isinstance(item, torch.Tensor):
+        if item.dtype == torch.bool:
+            item = torch.nonzero(item).flatten()
+        return item.tolist()
+    if isinstance(item, np.ndarray) and item.dtype == bool:
+        return np.flatnonzero(item).tolist()
+    return [int(i) for i in item]
+
+
+def shift_polygons(polygons: List[np.ndarray], offset: Tuple[int, int]):
+    # Polygons are flat [x1, y1, x2, y2, ...] arrays, shifted in place
+    for polygon in polygons:
+        polygon[0::2] += offset[0]
+        polygon[1::2] += offset[1]
+
+
+def crop_masks_to_boxes(masks: torch.Tensor, boxes: torch.Tensor) -> CroppedMasks:
+    image_size = tuple(masks.shape[1:])
+    patches, offsets = [], []
+    for mask, box in zip(masks, boxes.tolist()):
+        x1, y1, x2, y2 = get_crop_window(box, image_size)
+        patches.append(mask[y1:y2, x1:x2].cpu().numpy())
+        offsets.append((x1, y1))
+    return CroppedMasks(patches, offsets, image_size)
+
+
+def get_crop_window(box: List[float], image_size: Tuple[int, int]) -> List[int]:
+    # Pad by a pixel so contours are never clipped by the edge of the patch
+    height, width = image_size
+    x1 = min(max(int(np.floor(box[0])) - 1, 0), width - 1)
+    y1 = min(max(int(np.floor(box[1])) - 1, 0), height - 1)
+    x2 = min(max(int(np.ceil(box[2])) + 1, x1 + 1), width)
+    y2 = min(max(int(np.ceil(box[3])) + 1, y1 + 1), height)
+    return [x1, y1, x2, y2]
+
+
+def move_masks(
+    masks,
+    boxes: torch.Tensor,
+    offset: Tuple[int, int],
+    image_size: Tuple[int, int],
+):
+    # Places masks predicted on a crop of the image into the full image
+    if isinstance(masks, LowResolutionMasks):
+        return masks.translate(offset, image_size)
+    masks = crop_masks_to_boxes(masks, boxes)
+    masks.offsets = [(x + offset[0], y + offset[1]) for x, y in masks.offsets]
+    masks.image_size = image_size
+    return masks
+
+
+def paste_mask_in_box(
+    mask: torch.Tensor,
+    box: torch.Tensor,
+    image_size: Tuple[int, int],
+) -> Tuple[np.ndarray, Tuple[int, int]]:
+    # The sampling detectron2 uses to paste masks, restricted to the box
+    height, width = image_size
+    pasted, (rows, columns) = _do_paste_mask(
+        mask[None, None], box[None], height, width, skip_empty=True
+    )
+    patch = (pasted[0] >= MASK_THRESHOLD).numpy()
+    return patch, (int(columns.start), int(rows.start))
+
+
+def postprocess_with_compact_masks(
+    results: Instances,
+    height: int,
+    width: int,
+) -> Instances:
+    # detector_postprocess, without pasting the masks to the full image size
+    scale_x, scale_y = width / results.image_size[1], height / results.image_size[0]
+    results = Instances((height, width), **results.get_fields())
+    results.pred_boxes.scale(scale_x, scale_y)
+    results.pred_boxes.clip(results.image_size)
+    results = results[results.pred_boxes.nonempty()]
+    # Counting stomata only keeps the boxes
+    if results.has("pred_masks"):
+        boxes = results.pred_boxes.tensor.clone()
+        masks = LowResolutionMasks(results.pred_masks[:, 0], boxes, (height, width))
+        results.pred_masks = masks
+    if results.has("pred_keypoints"):
+        results.pred_keypoints[:, :, 0] *= scale_x
+        results.pred_keypoints[:, :, 1] *= scale_y
+    return results
@@ -0,0 +1,107 @@
+from typing import List
+
+import numpy as np
+
+from inference.intersection import get_next_vertex_indices
+from inference.keypoints import concatenate_rings
+
+
+class EquivalentEllipses:
+    """
+    For each of a list of polygons, the ellipse with the same area, centroid
+    and second moments, computed for all polygons at once from their edges
+    with Green's theorem. An ellipse's axes are four times the square roots
+    of the principal values of its second moments, so a polygon's length
+    and width are read without intersecting lines with its edges. Polygons
+    with no area have no length or width, and are centred on their first
+    vertex.
+    """
+
+    def __init__(self, polygons: List[List[float]]):
+        n_polygons = len(polygons)
+        self.centres = np.zeros((n_polygons, 2))
+        self.directions = np.zeros((n_polygons, 2))
+        self.directions[:, 0] = 1.0
+        self.lengths = np.zeros(n_polygons)
+        self.widths = np.zeros(n_polygons)
+        vertices, ring_lengths = concatenate_rings(polygons)
+        if len(vertices) == 0:
+            return
+        ring_indices = np.repeat(np.arange(n_polygons), ring_lengths)
+        starts = np.cumsum(ring_lengths) - ring_lengths
+        has_vertices = ring_lengths > 0
+        self.centres[has_vertices] = vertices[starts[has_vertices]]
+        # Moments are taken about each ring's first vertex, so coordinates far
+        # from the image origin lose no precision
+        p = vertices - self.centres[ring_indices]
+        q = p[get_next_vertex_indices(ring_lengths)]
+        cross = p[:, 0] * q[:, 1] - q[:, 0] * p[:, 1]
+
+        def sum_rings(terms: np.ndarray) -> np.ndarray:
+            return np.bincount(
+                ring_indices, weights=terms * cross, minlength=n_polygons
+            )
+
+        double_area = sum_rings(np.ones(len(p)))
+        x_sum = sum_rings(p[:, 0] + q[:, 0])
+        y_sum = sum_rings(p[:, 1] + q[:, 1])
+        xx_sum = sum_rings(p[:, 0] ** 2 + p[:, 0] * q[:, 0] + q[:, 0] ** 2)
+        yy_sum = sum_rings(p[:, 1] ** 2 + p[:, 1] * q[:, 1] + q[:, 1] ** 2)
+        xy_sum = sum_rings(
+            p[:, 0] * q[:, 1]
+            + 2 * p[:, 0] * p[:, 1]
+            + 2 * q[:, 0] * q[:, 1]
+            + q[:, 0] * p[:, 1]
+        )
+        is_valid = double_area != 0
+        double_area = double_area[is_valid]
+        x_centroid = x_sum[is_valid] / (3 * double_area)
+        y_centroid = y_sum[is_valid] / (3 * double_area)
+        xx_moment = xx_sum[is_valid] / (6 * double_area) - x_centroid**2
+        yy_moment = yy_sum[is_valid] / (6 * double_area) - y_centroid**2
+        xy_moment = xy_sum[is_valid] / (12 * double_area) - x_centroid * y_centroid
+        mean = (xx_moment + yy_moment) / 2
+        spread = np.hypot((xx_moment - yy_moment) / 2, xy_moment)
+        self.lengths[is_valid] = 4 * np.sqrt(np.maximum(mean + spread, 0))
+        self.widths[is_valid] = 4 * np.sqrt(np.maximum(mean - spread, 0))
+        angles = np.arctan2(2 * xy_moment, xx_moment - yy_moment) / 2
+        self.directions[is_valid] = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+        self.centres[is_valid] += np.stack([x_centroid, y_centroid], axis=1)
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def get_length_keypoints(self) -> List[List[float]]:
+        # Ends of each major axis
+        return get_axis_keypoints(self.centres, self.directions, self.lengths)
+
+    def get_width_keypoints(self) -> List[List[float]]:
+        # Ends of each minor axis, the one with the smaller y value first as
+        # with CD keypoints
+        x, y = self.directions[:, 0], self.directions[:, 1]
+        directions = np.stack([-y, x], axis=1)
+        directions[directions[:, 1] < 0] *= -1
+        return get_axis_keypoints(self.centres, directions, self.widths)
+
+
+def get_axis_keypoints(
+    centres: np.ndarray,
+    directions: np.ndarray,
+    lengths: np.ndarray,
+) -> List[List[float]]:
+    offsets = directions * lengths[:, None] / 2
+    keypoints = np.ones((len(centres), 6))
+    keypoints[:, [0, 1]] = centres - offsets
+    keypoints[:, [3, 4]] = centres + offsets
+    return keypoints.tolist()
+
+
+def order_keypoints_like(keypoints: List[float], reference: List[float]) -> List[float]:
+    # Swaps the two keypoints if that puts each nearer its reference keypoint
+    x_1, y_1, _, x_2, y_2, _ = keypoints
+    a_x, a_y, _, b_x, b_y, _ = reference
+    in_order = (x_1 - a_x) ** 2 + (y_1 - a_y) ** 2 + (x_2 - b_x) ** 2 + (y_2 - b_y) ** 2
+    swapped = (x_2 - a_x) ** 2 + (y_2 - a_y) ** 2 + (x_1 - b_x) ** 2 + (y_1 - b_y) ** 2
+    if swapped < in_order:
+        return [*keypoints[3:], *keypoints[:3]]
+    return keypoints
@@ -0,0 +1,192 @@
+import hashlib
+import inspect
+import io
+import os
+from typing import Dict, List, Tuple, Union
+
+import torch
+from detectron2.engine.defaults import DefaultPredictor
+from detectron2.export import TracingAdapter
+from detectron2.export.torchscript_patch import patch_builtin_len
+from detectron2.structures import Boxes, Instances
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+ONNX_OPSET_VERSION = 16
+EXPORTED_FIELDS = [
+    "pred_boxes",
+    "scores",
+    "pred_classes",
+    "pred_masks",
+    "pred_keypoints",
+    "pred_keypoint_heatmaps",
+]
+# Largest acceptable difference between ONNX Runtime and PyTorch outputs
+EXPORT_TOLERANCE = 1e-3
+
+
+class OnnxModel:
+    """
+    Mask R-CNN exported to ONNX and run by ONNX Runtime on the CPU. Like
+    model.inference(inputs, do_postprocess=False), returns each image's raw
+    Instances in the coordinates of the resized model input. The model is
+    exported on first use, tracing it with that input, and reused afterwards.
+    """
+
+    def __init__(self, model_config):
+        if onnxruntime is None:
+            raise ImportError(
+                "The ONNX backend needs ONNX Runtime,"
+                " install it with: pip3 install onnx onnxruntime"
+            )
+        self.model_config = get_cpu_model_config(model_config)
+        self.filepath = get_onnx_model_filepath(self.model_config)
+        self.session = None
+        if not is_export_outdated(self.filepath, self.model_config.MODEL.WEIGHTS):
+            self.session = create_session(self.filepath)
+
+    def inference(self, inputs: List[Dict]) -> List[Instances]:
+        if self.session is None:
+            export_model(self.model_config, inputs[0]["image"], self.filepath)
+            self.session = create_session(self.filepath)
+        return [self._run(model_input["image"]) for model_input in inputs]
+
+    def _run(self, image: torch.Tensor) -> Instances:
+        outputs = self.session.run(None, {"image": image.numpy()})
+        instances = Instances(tuple(image.shape[1:]))
+        for field, output in zip(EXPORTED_FIELDS, outputs):
+            instances.set(field, torch.from_numpy(output))
+        instances.pred_boxes = Boxes(instances.pred_boxes)
+        return instances
+
+
+def get_cpu_model_config(model_config):
+    model_config = model_config.clone()
+    model_config.defrost()
+    model_config.MODEL.DEVICE = "cpu"
+    model_config.freeze()
+    return model_config
+
+
+def get_onnx_model_filepath(model_config) -> str:
+    # Thresholds are part of the exported graph, so each config has its own export
+    config_digest = hashlib.sha256(model_config.dump().encode()).hexdigest()[:12]
+    directory = os.path.dirname(model_config.MODEL.WEIGHTS)
+    return os.path.join(directory, f"model-{config_digest}.onnx")
+
+
+def is_export_outdated(filepath: str, weights_filepath: str) -> bool:
+    # Downloading new weights invalidates an earlier export
+    if not os.path.exists(filepath):
+        return True
+    return os.path.getmtime(weights_filepath) > os.path.getmtime(filepath)
+
+
+def create_session(model: Union[str, bytes]):
+    # From the file of an export, or the exported model itself
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = torch.get_num_threads()
+    return onnxruntime.InferenceSession(
+        model, options, providers=["CPUExecutionProvider"]
+    )
+
+
+def export_model(model_config, image: torch.Tensor, filepath: str):
+    # Traced with detectron2's adapter, and with len() patched so the number
+    # of detections stays a tensor rather than a constant of the first image
+    model = DefaultPredictor(model_config).model.eval()
+    traceable_model = TracingAdapter(model, [{"image": image}], get_exported_fields)
+    n_instances = {0: "n_instances"}
+    exported = io.BytesIO()
+    with torch.no_grad(), patch_builtin_len():
+        torch.onnx.export(
+            traceable_model,
+            (image,),
+            exported,
+            input_names=["image"],
+            output_names=EXPORTED_FIELDS,
+            dynamic_axes={
+                "image": {1: "height", 2: "width"},
+                **{field: n_instances for field in EXPORTED_FIELDS},
+            },
+            opset_version=ONNX_OPSET_VERSION,
+            **get_tracing_export_options(),
+        )
+    check_export(model, exported.getvalue(), image)
+    # Written under a temporary name so an interrupted export is not reused
+    temporary_filepath = f"{filepath}.{os.getpid()}.tmp"
+    with open(temporary_filepath, "wb") as file:
+        file.write(exported.getvalue())
+    os.replace(temporary_filepath, filepath)
+
+
+def get_exported_fields(
+    model: torch.nn.Module,
+    inputs: List[Dict],
+) -> Tuple[torch.Tensor, ...]:
+    # The instances predicted for a single pre-processed image, as a tuple of
+    # tensors in the order of EXPORTED_FIELDS
+    instances = model.inference(inputs, do_postprocess=False)[0]
+    fields = [instances.get(field) for field in EXPORTED_FIELDS]
+    fields[0] = fields[0].tensor
+    return tuple(fields)
+
+
+def check_export(model: torch.nn.Module, exported: bytes, image: torch.Tensor):
+    # An export is only saved once ONNX Runtime agrees with PyTorch on an
+    # input other than the one it was traced with
+    check_image, expected = find_check_input(model, image)
+    outputs = create_session(exported).run(None, {"image": check_image.numpy()})
+    for field, output, expected_output in zip(EXPORTED_FIELDS, outputs, expected):
+        if not is_matching_output(torch.from_numpy(output), expected_output):
+            raise RuntimeError(
+                f"The ONNX export's {field} differ from PyTorch's,"
+                " use the PyTorch backend instead"
+            )
+
+
+def find_check_input(
+    model: torch.nn.Module,
+    image: torch.Tensor,
+) -> Tuple[torch.Tensor, Tuple[torch.Tensor, ...]]:
+    # Parts of the traced image, the first with a different number of
+    # detections, which a graph with frozen sizes would not reproduce
+    height, width = image.shape[1:]
+    crops = [
+        image[:, : height // 2],
+        image[:, :, : width // 2],
+        image[:, height // 2 :, width // 2 :],
+        image[:, : height // 2, : width // 2],
+    ]
+    with torch.no_grad():
+        n_traced = len(get_exported_fields(model, [{"image": image}])[1])
+        checks = []
+        for crop in crops:
+            crop = crop.contiguous()
+            expected = get_exported_fields(model, [{"image": crop}])
+            if len(expected[1]) != n_traced:
+                return crop, expected
+            checks.append((crop, expected))
+    # Every part has as many detections, which still checks the image size
+    return checks[0]
+
+
+def is_matching_output(output: torch.Tensor, expected: torch.Tensor) -> bool:
+    if output.shape != expected.shape:
+        return False
+    if not expected.is_floating_point():
+        return torch.equal(output, expected)
+    return torch.allclose(
+        output, expected.float(), rtol=EXPORT_TOLERANCE, atol=EXPORT_TOLERANCE
+    )
+
+
+def get_tracing_export_options() -> Dict:
+    # Detectron2 models are exported by tracing, newer PyTorch defaults to dynamo
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        return {"dynamo": False}
+    return {}
@@ -1,9 +1,11 @@
 import os
 import math
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, List, Tuple, Union
 
 from interface.upload_single import convert_to_SIU_length
 from inference.constants import (
+    COUNT_KEYS,
+    COUNT_OUTPUT_COLUMNS,
     DENSITY_KEYS,
     DENSITY_OUTPUT_COLUMNS,
     DIFFUSIVITY_OF_WATER_IN_AIR_25C,
@@ -13,100 +15,236 @@ from inference.constants import (
 )
 from tools.state import Option_State
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
-def create_output_csvs() -> Tuple[str, str]:
-    predictions = Option_State["folder_inference"]["predictions"]
-    formatted_predictions = format_predictions(predictions)
-    measurement_csv_filename = write_measurements_to_csv(formatted_predictions)
-    densities = format_densities(predictions)
-    density_csv_filename = write_density_csv(densities)
-    return density_csv_filename, measurement_csv_filename
+# Parquet columns are named after the keys, with these types
+MEASUREMENT_KEY_TYPES = {
+    "stoma_id": "int64",
+    "image_name": "string",
+    "class": "string",
+    "pore_length": "float64",
+    "pore_width": "float64",
+    "pore_area": "float64",
+    "pore_width_to_length_ratio": "float64",
+    "subsidiary_cell_area": "float64",
+    "guard_cell_area": "float64",
+    "confidence": "float64",
+}
+DENSITY_KEY_TYPES = {
+    "image_name": "string",
+    "n_stomata": "int64",
+    "density": "float64",
+    "g_max": "float64",
+}
+PARQUET_ROW_GROUP_SIZE = 10000
 
 
-def format_predictions(predictions: List[Dict]) -> List[Dict]:
+class OutputTableWriter:
+    """
+    Appends the rows of one output table to its CSV, flushing them after
+    each image so an interrupted run keeps the images written so far.
+    Optionally also writes the rows to a Parquet file in row groups, which
+    only becomes readable once the writer is closed. Staged writers write to
+    temporary files that replace the table when closed, so an earlier table
+    of the same name stays whole until the new one is complete.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        column_names: List[str],
+        column_keys: List[str],
+        key_types: Dict[str, str],
+        write_parquet: bool = False,
+        staged: bool = False,
+    ):
+        self.filename = get_output_filename(name, "csv")
+        self._column_keys = column_keys
+        self._staged, self._staged_filepaths = staged, []
+        self._file = open(self._get_writing_filepath(self.filename), "w")
+        self._file.write(",".join(column_names) + "\n")
+        self._parquet_writer, self._parquet_rows = None, []
+        if write_parquet:
+            self._open_parquet_writer(name, key_types)
+
+    def _open_parquet_writer(self, name: str, key_types: Dict[str, str]):
+        if pyarrow is None:
+            raise ImportError(
+                "Parquet output needs PyArrow, install it with: pip3 install pyarrow"
+            )
+        self._schema = pyarrow.schema(
+            [(key, key_types[key]) for key in self._column_keys]
+        )
+        filepath = self._get_writing_filepath(get_output_filename(name, "parquet"))
+        self._parquet_writer = pyarrow.parquet.ParquetWriter(filepath, self._schema)
+
+    def _get_writing_filepath(self, filename: str) -> str:
+        filepath = get_output_filepath(filename)
+        if not self._staged:
+            return filepath
+        self._staged_filepaths.append((f"{filepath}.tmp", filepath))
+        return f"{filepath}.tmp"
+
+    def write_rows(self, rows: List[Dict]):
+        self._file.writelines(
+            [
+                ",".join([str(row[key]) for key in self._column_keys]) + "\n"
+                for row in rows
+            ]
+        )
+        self._file.flush()
+        if self._parquet_writer is not None:
+            self._parquet_rows.extend(rows)
+            if len(self._parquet_rows) >= PARQUET_ROW_GROUP_SIZE:
+                self._write_row_group()
+
+    def _write_row_group(self):
+        columns = {
+            key: [row[key] for row in self._parquet_rows] for key in self._column_keys
+        }
+        table = pyarrow.Table.from_pydict(columns, schema=self._schema)
+        self._parquet_writer.write_table(table)
+        self._parquet_rows = []
+
+    def close(self):
+        if self._parquet_writer is not None:
+            if len(self._parquet_rows) > 0:
+                self._write_row_group()
+            self._parquet_writer.close()
+        self._file.close()
+        for temporary_filepath, filepath in self._staged_filepaths:
+            os.replace(temporary_filepath, filepath)
+
+
+class OutputWriter:
+    """
+    Writes the pore measurement and density tables of a folder one image at
+    a time, so only the rows of the current image are held in memory. Runs
+    that only count stomata have no measurements, and their density table
+    has no g max.
+    """
+
+    def __init__(
+        self,
+        write_parquet: bool = False,
+        density_only: bool = False,
+        staged: bool = False,
+    ):
+        self.measurements = None
+        if density_only:
+            self.densities = OutputTableWriter(
+                "density",
+                COUNT_OUTPUT_COLUMNS,
+                COUNT_KEYS,
+                DENSITY_KEY_TYPES,
+                write_parquet,
+                staged,
+            )
+            return
+        self.measurements = OutputTableWriter(
+            "pore_measurements",
+            MEASUREMENT_OUTPUT_COLUMN_NAMES,
+            MEASUREMENT_KEYS,
+            MEASUREMENT_KEY_TYPES,
+            write_parquet,
+            staged,
+        )
+        self.densities = OutputTableWriter(
+            "density",
+            DENSITY_OUTPUT_COLUMNS,
+            DENSITY_KEYS,
+            DENSITY_KEY_TYPES,
+            write_parquet,
+            staged,
+        )
+
+    def write_image(self, prediction: Dict):
+        if self.measurements is None:
+            self.densities.write_rows([format_count(prediction)])
+            return
+        self.measurements.write_rows(format_measurements(prediction))
+        self.densities.write_rows([format_density(prediction)])
+
+    def close(self):
+        if self.measurements is not None:
+            self.measurements.close()
+        self.densities.close()
+
+    def __enter__(self) -> "OutputWriter":
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+def create_output_csvs(predictions: Iterable[Dict]) -> Tuple[str, Union[str, None]]:
+    # Predictions may be a generator, such as records loaded one at a time.
+    # Runs that only count stomata write no measurements CSV. The tables
+    # replace any written as images were measured once they are complete
+    with OutputWriter(
+        Option_State["parquet_output"], Option_State["density_only"], staged=True
+    ) as writer:
+        for prediction in predictions:
+            writer.write_image(prediction)
+    if writer.measurements is None:
+        return writer.densities.filename, None
+    return writer.densities.filename, writer.measurements.filename
+
+
+def format_measurements(prediction: Dict) -> List[Dict]:
     stoma_measurements = []
-    for prediction in predictions:
-        image_name = prediction["image_name"]
-        detections = prediction["detections"]
-        for detection in detections:
-            measurements = {
-                "stoma_id": detection["stoma_id"],
-                "pore_width": detection["pore_width"],
-                "pore_length": detection["pore_length"],
-                "pore_area": detection["pore_area"],
-                "subsidiary_cell_area": detection["subsidiary_cell_area"],
-                "guard_cell_area": detection["guard_cell_area"],
-                "class": "open" if detection["category_id"] else "closed",
-                "confidence": detection["confidence"],
-                "image_name": image_name,
-                "pore_width_to_length_ratio": detection["width_over_length"],
-            }
-            stoma_measurements.append(measurements)
+    image_name = prediction["image_name"]
+    for detection in prediction["detections"]:
+        measurements = {
+            "stoma_id": detection["stoma_id"],
+            "pore_width": detection["pore_width"],
+            "pore_length": detection["pore_length"],
+            "pore_area": detection["pore_area"],
+            "subsidiary_cell_area": detection["subsidiary_cell_area"],
+            "guard_cell_area": detection["guard_cell_area"],
+            "class": "open" if detection["category_id"] else "closed",
+            "confidence": detection["confidence"],
+            "image_name": image_name,
+            "pore_width_to_length_ratio": detection["width_over_length"],
+        }
+        stoma_measurements.append(measurements)
     return stoma_measurements
 
 
-def write_measurements_to_csv(measurements: List[Dict]) -> str:
-    measurement_csv_filepath = write_output_csv(
-        measurements,
-        MEASUREMENT_OUTPUT_COLUMN_NAMES,
-        MEASUREMENT_KEYS,
-        "pore_measurements",
-    )
-    return measurement_csv_filepath
-
-
-def format_densities(predictions: List[Dict]) -> List[Dict]:
-    densities = []
-    for prediction in predictions:
-        detections = prediction["detections"]
-        invalid_detections = prediction["invalid_detections"]
-        area = calculate_image_area(prediction["image_size"])
-        n_stomata = len(detections) + len(invalid_detections)
-        density = n_stomata / area  # pores/mm^2
-        g_max = calculate_g_max(density, prediction["detections"])
-        density = {
-            "image_name": prediction["image_name"],
-            "n_stomata": n_stomata,
-            "density": density,
-            "g_max": g_max,
-        }
-        densities.append(density)
-    return densities
+def format_density(prediction: Dict) -> Dict:
+    density = format_count(prediction)
+    density["g_max"] = calculate_g_max(density["density"], prediction["detections"])
+    return density
 
 
-def write_density_csv(densities: List[Dict]) -> str:
-    density_csv_filepath = write_output_csv(
-        densities,
-        DENSITY_OUTPUT_COLUMNS,
-        DENSITY_KEYS,
-        "density",
-    )
-    return density_csv_filepath
-
-
-def write_output_csv(
-    measurements: List[Dict],
-    column_names: List[str],
-    column_keys: List[str],
-    name: str,
-) -> str:
-    csv = ",".join(column_names) + "\n"
-    for measurement in measurements:
-        values = []
-        for key in column_keys:
-            values.append(measurement[key])
-        values = [str(x) for x in values]
-        csv += ",".join(values) + "\n"
+def format_count(prediction: Dict) -> Dict:
+    detections = prediction["detections"]
+    invalid_detections = prediction["invalid_detections"]
+    area = calculate_image_area(prediction["image_size"])
+    n_stomata = len(detections) + len(invalid_detections)
+    density = n_stomata / area  # pores/mm^2
+    return {
+        "image_name": prediction["image_name"],
+        "n_stomata": n_stomata,
+        "density": density,
+    }
 
+
+def get_output_filename(name: str, extension: str) -> str:
     path = Option_State["folder_path"]
     if os.path.basename(path) == "":
         directory_name = os.path.basename(os.path.dirname(path))
     else:
         directory_name = os.path.basename(path)
-    filename = f"{name}_{directory_name}.csv"
-    with open(f"./output/temp/{filename}", "w") as file:
-        file.write(csv)
-    return filename
+    return f"{name}_{directory_name}.{extension}"
+
+
+def get_output_filepath(filename: str) -> str:
+    return os.path.join(Option_State["output_path"], filename)
 
 
 def calculate_image_area(image_size: List[float]) -> float:
@@ -1,57 +1,91 @@
-import os
+from typing import Dict, List
 
 import streamlit as st
-import numpy as np
-from scipy.stats import iqr
 
+from inference.quantiles import QuantileSketch, calculate_whiskers
+from inference.result_store import IMAGES_PER_READ, get_result_store
 from inference.utils import (
     calculate_bbox_height,
     calculate_bbox_width,
+    split_into_batches,
 )
-from app.utils import load_json, write_to_json
 
-Predicted_Pore_Lengths, Bounding_Boxes = [], []
+
+class PopulationStatistics:
+    """
+    Sketches of the pore lengths and bounding box sizes of every stoma
+    measured in a run, from which the limits of outliers are derived. Held
+    in constant memory, and statistics of parts of a run can be merged.
+    """
+
+    def __init__(self):
+        self.pore_lengths = QuantileSketch()
+        self.bbox_heights = QuantileSketch()
+        self.bbox_widths = QuantileSketch()
+
+    def add_result(self, result: Dict):
+        dimensions = result["bounding_box_dimensions"]
+        self.pore_lengths.extend(result["pore_lengths"])
+        self.bbox_heights.extend([box["height"] for box in dimensions])
+        self.bbox_widths.extend([box["width"] for box in dimensions])
+
+    def merge(self, other: "PopulationStatistics"):
+        self.pore_lengths.merge(other.pore_lengths)
+        self.bbox_heights.merge(other.bbox_heights)
+        self.bbox_widths.merge(other.bbox_widths)
+
+    def clear(self):
+        self.pore_lengths.clear()
+        self.bbox_heights.clear()
+        self.bbox_widths.clear()
+
+    def calculate_limits(self) -> Dict[str, List[float]]:
+        limits = {
+            "bbox_height": calculate_whiskers(self.bbox_heights),
+            "bbox_width": calculate_whiskers(self.bbox_widths),
+        }
+        # Runs that only count stomata measure no pores
+        if self.pore_lengths.n_values > 0:
+            limits["pore_length"] = calculate_whiskers(self.pore_lengths)
+        return limits
+
+
+# Cleared, rather than replaced, at the start of each run as it is imported
+# by name
+Population_Statistics = PopulationStatistics()
 
 
 def remove_outliers_from_records():
-    path = "./output/temp/"
-    for filename in os.listdir(path):
-        if ".json" in filename:
-            if "-gt" in filename:
-                continue
-            filepath = os.path.join(path, filename)
-            record = load_json(filepath)
-            remove_outliers(record)
-            write_to_json(record, filepath)
+    # The limits are fixed before the one pass over the run's records
+    limits = Population_Statistics.calculate_limits()
+    store = get_result_store()
+    records = store.iterate_records(include_geometry=False)
+    for batch in split_into_batches(records, IMAGES_PER_READ):
+        for record in batch:
+            remove_outliers(record, limits)
+        store.update_detections(batch)
 
 
-def remove_outliers(record):
-    remove_pore_length_outliers(record)
-    remove_bounding_box_outliers(record)
+def remove_outliers(record, limits):
+    if "pore_length" in limits:
+        remove_pore_length_outliers(record, limits["pore_length"][0])
+    remove_bounding_box_outliers(record, limits)
 
 
-def remove_pore_length_outliers(record):
+def remove_pore_length_outliers(record, lower_bound):
     indices, length_predictions = extract_pore_lengths(record)
-    to_remove = find_outlier_indices(indices, length_predictions)
+    to_remove = find_outlier_indices(indices, length_predictions, lower_bound)
     remove_outlier_records(record, to_remove)
 
 
-def find_outlier_indices(indices, lengths):
-    to_remove = []
-    lower_bound = calculate_length_limit()
+def find_outlier_indices(indices, lengths, lower_bound):
+    to_remove = set()
     for i, length in enumerate(lengths):
         if length < lower_bound:
-            to_remove.append(indices[i])
+            to_remove.add(indices[i])
     return to_remove
 
 
-def calculate_length_limit():
-    inter_quartile_range = iqr(Predicted_Pore_Lengths, interpolation="midpoint")
-    median = np.median(Predicted_Pore_Lengths)
-    lower_whisker = median - 2.0 * inter_quartile_range
-    return lower_whisker
-
-
 def extract_pore_lengths(record):
     indices, lengths = [], []
     predictions = record["detections"]
@@ -61,21 +95,21 @@ def extract_pore_lengths(record):
     return indices, lengths
 
 
-def remove_bounding_box_outliers(record):
-    remove_bounding_box_height_outliers(record)
-    remove_bounding_box_width_outliers(record)
+def remove_bounding_box_outliers(record, limits):
+    remove_bounding_box_height_outliers(record, limits["bbox_height"])
+    remove_bounding_box_width_outliers(record, limits["bbox_width"])
 
 
-def remove_bounding_box_height_outliers(record):
+def remove_bounding_box_height_outliers(record, height_limits):
     heights = extract_bbox_heights(record)
-    minimum, maximum = calculate_bbox_height_limits()
+    minimum, maximum = height_limits
     to_remove = find_outlier_bbox_indices(heights, minimum, maximum)
     remove_outlier_records(record, to_remove)
 
 
-def remove_bounding_box_width_outliers(record):
+def remove_bounding_box_width_outliers(record, width_limits):
     widths = extract_bbox_widths(record)
-    minimum, maximum = calculate_bbox_width_limits()
+    minimum, maximum = width_limits
     to_remove = find_outlier_bbox_indices(widths, minimum, maximum)
     remove_outlier_records(record, to_remove)
 
@@ -104,24 +138,6 @@ def find_outlier_bbox_indices(sizes, lower_bound, upper_bound):
     return to_remove
 
 
-def calculate_bbox_height_limits():
-    heights = [bbox["height"] for bbox in Bounding_Boxes]
-    inter_quartile_range = iqr(heights, interpolation="midpoint")
-    median = np.median(heights)
-    lower_whisker = median - 2.0 * inter_quartile_range
-    upper_whisker = median + 2.0 * inter_quartile_range
-    return lower_whisker, upper_whisker
-
-
-def calculate_bbox_width_limits():
-    widths = [bbox["width"] for bbox in Bounding_Boxes]
-    inter_quartile_range = iqr(widths, interpolation="midpoint")
-    median = np.median(widths)
-    lower_whisker = median - 2.0 * inter_quartile_range
-    upper_whisker = median + 2.0 * inter_quartile_range
-    return lower_whisker, upper_whisker
-
-
 def remove_outlier_records(record, to_remove):
     predictions = record["detections"]
     removed = []
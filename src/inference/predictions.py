@@ -1,36 +1,35 @@
-import copy
-from typing import Dict, List, Union
+from typing import Dict, List, Tuple, Union
 
 import numpy as np
 import shapely
 from detectron2.structures import Instances
-from detectron2.utils.visualizer import GenericMask
-from shapely.geometry import Polygon
 
+from inference.association import BoundingBoxIndex
 from inference.constants import (
     NAMES_TO_CATEGORY_ID,
     MINIMUM_LENGTH,
     WIDTH_OVER_LENGTH_THRESHOLD,
-    ORPHAN_AREA_THRESHOLD,
 )
-from inference.initial_filter import (
-    filter_invalid_predictions,
-    is_stomatal_pore,
+from inference.masks import DecodedMask, decode_mask, measure_decoded_masks
+from inference.initial_filter import filter_invalid_predictions
+from inference.keypoints import (
+    extract_AB_from_polygon,
+    find_AB_batch,
+    find_CD,
+    find_CD_batch,
 )
+from inference.moments import EquivalentEllipses, order_keypoints_like
+from inference.timing import time_stage
 from inference.utils import (
     calculate_bbox_height,
     calculate_bbox_width,
     calculate_midpoint_of_keypoints,
     calulate_width_over_length,
-    extract_AB_from_polygon,
-    find_AB,
-    find_CD,
+    get_class_masks,
     is_stomata_complex,
-    is_bbox_a_in_bbox_b,
-    is_bbox_a_mostly_in_bbox_b,
     l2_dist,
 )
-from tools.draw import format_polygon_coordinates
+from tools.state import Option_State
 
 
 class ModelOutput:
@@ -41,10 +40,12 @@ class ModelOutput:
         self.pore_lengths = []
         self.bounding_box_dimensions = []
         self._n_stoma_processed = n_stoma
+        self._decoded_masks = {}
         self._process_predictions()
 
     def _process_predictions(self):
         self._invalid_predictions = filter_invalid_predictions(self._predictions)
+        self._build_structure_indices()
         self._format_predictions()
         self._format_invalid_predictions()
 
@@ -68,30 +69,76 @@ class ModelOutput:
     def _n_invalid_predictions(self) -> int:
         return len(self._invalid_predictions.pred_boxes)
 
+    def _build_structure_indices(self):
+        bboxes = self._predictions.pred_boxes.tensor.tolist()
+        _, is_pore, is_subsidiary_cell = get_class_masks(self._predictions)
+        self._pores = self._build_structure_index(bboxes, is_pore.tolist())
+        self._subsidiary_cells = self._build_structure_index(
+            bboxes, is_subsidiary_cell.tolist()
+        )
+
+    def _build_structure_index(
+        self,
+        bboxes: List[List[float]],
+        is_structure: List[bool],
+    ) -> BoundingBoxIndex:
+        indices = [i for i, is_selected in enumerate(is_structure) if is_selected]
+        return BoundingBoxIndex([bboxes[i] for i in indices], indices)
+
     def _format_predictions(self):
-        for i in range(self._n_predictions):
-            if self._is_stomata_complex(i):
-                self._format_prediction(i)
+        # Keypoints of all stomata are found together, then stomata are kept
+        # and numbered in order
+        complexes = [
+            i for i in range(self._n_predictions) if self._is_stomata_complex(i)
+        ]
+        self._decode_masks(complexes)
+        predictions = [(i, self._format_structures(i)) for i in complexes]
+        self._add_guard_cell_interiors(predictions)
+        with time_stage("geometry"):
+            if Option_State["measurement_mode"] == "Fast":
+                self._add_moment_measurements(predictions)
+            else:
+                self._add_pore_keypoints(predictions)
+                self._add_guard_cell_keypoints(predictions)
+        for _, prediction in predictions:
+            self._add_width_over_length(prediction)
+            if prediction["width_over_length"] > WIDTH_OVER_LENGTH_THRESHOLD:
+                continue
+            prediction["stoma_id"] = self._n_stoma_processed
+            self._n_stoma_processed += 1
+            self._formatted_predictions.append(prediction)
+            self.pore_lengths.append(prediction["pore_length"])
+            self._add_bounding_box_dimensions(prediction["bbox"])
 
     def _is_stomata_complex(self, i: int) -> bool:
         return is_stomata_complex(i, self._predictions)
 
-    def _format_prediction(self, i: int):
+    def _decode_masks(self, complexes: List[int]):
+        # Each complex's pore and subsidiary cells are found first, so the masks
+        # of every structure of the image are measured together
+        open_stomata_id = NAMES_TO_CATEGORY_ID["Open Stomata"]
+        self._complex_pores = {
+            i: self._find_pore(i)
+            for i in complexes
+            if self._get_class(i) == open_stomata_id
+        }
+        self._complex_subsidiary_cells = {
+            i: self._find_subsidiary_cells(i) for i in complexes
+        }
+        indices = list(complexes)
+        indices += [pore for pore in self._complex_pores.values() if pore is not None]
+        for subsidiary_cells in self._complex_subsidiary_cells.values():
+            indices += subsidiary_cells or []
+        masks = [self._get_mask(i) for i in dict.fromkeys(indices)]
+        measure_decoded_masks([mask for mask in masks if mask.i_largest is None])
+
+    def _format_structures(self, i: int) -> Dict:
         prediction = {}
         self._add_complex_detction(i, prediction)
         self._add_guard_cells(i, prediction)
         self._add_pore(i, prediction)
         self._add_subsidiary_cells(i, prediction)
-        self._add_pore_keypoints(i, prediction)
-        self._add_guard_cell_keypoints(i, prediction)
-        self._add_width_over_length(prediction)
-        if prediction["width_over_length"] > WIDTH_OVER_LENGTH_THRESHOLD:
-            return
-        prediction["stoma_id"] = self._n_stoma_processed
-        self._n_stoma_processed += 1
-        self._formatted_predictions.append(prediction)
-        self.pore_lengths.append(prediction["pore_length"])
-        self._add_bounding_box_dimensions(prediction["bbox"])
+        return prediction
 
     def _add_complex_detction(self, i: int, prediction: Dict):
         prediction["category_id"] = self._get_class(i)
@@ -99,28 +146,32 @@ class ModelOutput:
         prediction["confidence"] = self._get_confidence(i)
 
     def _add_guard_cells(self, i: int, prediction: Dict):
-        interior = []
         guard_cell_mask = self._get_mask(i)
-        guard_cell_polygons = copy.deepcopy(guard_cell_mask.polygons)
-        exterior_polygon = self._select_largest_polygon(guard_cell_polygons)
-        shapely_exterior = Polygon(format_polygon_coordinates(exterior_polygon))
-        for guard_cell_polygon in guard_cell_polygons:
-            polygon = Polygon(format_polygon_coordinates(guard_cell_polygon))
-            if shapely.within(polygon, shapely_exterior):
-                interior = guard_cell_polygon.tolist()
         guard_cell = {
-            "guard_cell_area": guard_cell_mask.area(),
+            "guard_cell_area": guard_cell_mask.area,
             "guard_cell_polygon": {
-                "exterior": exterior_polygon,
-                "interior": interior,
+                "exterior": guard_cell_mask.largest_polygon,
+                "interior": [],
             },
         }
         prediction.update(guard_cell)
 
-    def _select_largest_polygon(self, polygons: List[GenericMask]) -> GenericMask:
-        tmp_polygons = [format_polygon_coordinates(polygon) for polygon in polygons]
-        i_max = np.argmax([Polygon(polygon).area for polygon in tmp_polygons])
-        return polygons.pop(i_max).tolist()
+    def _add_guard_cell_interiors(self, predictions: List[Tuple[int, Dict]]):
+        # A guard cell's interior is the last of its mask's other polygons that
+        # is within its largest, tested for every guard cell at once
+        if len(predictions) == 0:
+            return
+        masks = [self._get_mask(i) for i, _ in predictions]
+        n_polygons = np.array([len(mask.polygons) for mask in masks])
+        starts = np.cumsum(n_polygons) - n_polygons
+        largest = starts + [mask.i_largest for mask in masks]
+        owners = np.repeat(np.arange(len(masks)), n_polygons)
+        others = np.flatnonzero(np.arange(len(owners)) != largest[owners])
+        polygons = np.concatenate([mask.shapely_polygons for mask in masks])
+        is_within = shapely.within(polygons[others], polygons[largest[owners[others]]])
+        for k, j in zip(owners[others][is_within], others[is_within]):
+            guard_cell_polygon = predictions[k][1]["guard_cell_polygon"]
+            guard_cell_polygon["interior"] = masks[k].polygons[j - starts[k]]
 
     def _add_pore(self, i: int, prediction: Dict):
         if self._is_open_stomata(prediction):
@@ -138,36 +189,74 @@ class ModelOutput:
         return prediction["category_id"] == NAMES_TO_CATEGORY_ID["Open Stomata"]
 
     def _maybe_find_pore(self, i: int) -> Union[Dict, None]:
-        pore_index = self._find_pore(i)
+        pore_index = self._complex_pores[i]
         if pore_index is not None:
             return self._format_pore_prediction(pore_index)
         return None
 
     def _find_pore(self, i: int) -> Union[int, None]:
         stomata_bbox = self._get_bounding_box(i)
-        for j in range(self._n_predictions):
-            if is_stomatal_pore(j, self._predictions):
-                pore_bbox = self._get_bounding_box(j)
-                if is_bbox_a_in_bbox_b(pore_bbox, stomata_bbox):
-                    return j
+        pore_indices = self._pores.find_contained_in(stomata_bbox)
+        if len(pore_indices) > 0:
+            return pore_indices[0]
         return None
 
     def _format_pore_prediction(self, i: int) -> Dict:
         mask = self._get_mask(i)
         pore = {
-            "pore_area": mask.area(),
-            "pore_polygon": self._select_largest_polygon(mask.polygons),
+            "pore_area": mask.area,
+            "pore_polygon": mask.largest_polygon,
         }
         return pore
 
-    def _add_guard_cell_keypoints(self, i: int, prediction: Dict):
-        self._add_guard_cell_width_keypoints(prediction)
-        self._add_guard_cell_groove_keypoints(prediction)
-
-    def _add_guard_cell_groove_keypoints(self, prediction: Dict):
-        guard_cell_polygon = prediction["guard_cell_polygon"]["exterior"]
+    def _add_moment_measurements(self, predictions: List[Tuple[int, Dict]]):
+        # Pores and guard cells are measured along the axes of the ellipses
+        # with their masks' moments, rather than intersecting keypoint lines
+        open_stomata = [(i, p) for i, p in predictions if self._is_open_stomata(p)]
+        pores = EquivalentEllipses([p["pore_polygon"] for _, p in open_stomata])
+        for (_, prediction), AB, CD, length, width in zip(
+            open_stomata,
+            pores.get_length_keypoints(),
+            pores.get_width_keypoints(),
+            pores.lengths.tolist(),
+            pores.widths.tolist(),
+        ):
+            self._set_pore_keypoints(prediction, AB, CD, length, width)
+        for i, prediction in predictions:
+            if not self._is_open_stomata(prediction):
+                keypoints_AB = self._get_keypoints(i)
+                keypoints_CD = [-1, -1, 1, -1, -1, 1]
+                pore_length = l2_dist(keypoints_AB)
+                self._set_pore_keypoints(
+                    prediction, keypoints_AB, keypoints_CD, pore_length, 0
+                )
+        exteriors = EquivalentEllipses(
+            [p["guard_cell_polygon"]["exterior"] for _, p in predictions]
+        )
+        for (_, prediction), width, groove in zip(
+            predictions,
+            exteriors.get_width_keypoints(),
+            exteriors.get_length_keypoints(),
+        ):
+            groove = order_keypoints_like(groove, prediction["AB_keypoints"])
+            self._add_guard_cell_width_keypoints(prediction, width)
+            self._add_guard_cell_groove_keypoints(prediction, groove)
+
+    def _add_guard_cell_keypoints(self, predictions: List[Tuple[int, Dict]]):
+        polygons = [p["guard_cell_polygon"]["exterior"] for _, p in predictions]
+        keypoints_AB = [prediction["AB_keypoints"] for _, prediction in predictions]
+        width_keypoints = find_CD_batch(polygons, keypoints_AB)
+        groove_keypoints = find_AB_batch(polygons, keypoints_AB)
+        for (_, prediction), width, groove in zip(
+            predictions, width_keypoints, groove_keypoints
+        ):
+            self._add_guard_cell_width_keypoints(prediction, width)
+            self._add_guard_cell_groove_keypoints(prediction, groove)
+
+    def _add_guard_cell_groove_keypoints(
+        self, prediction: Dict, keypoints: List[float]
+    ):
         keypoints_AB = prediction["AB_keypoints"]
-        keypoints = find_AB(guard_cell_polygon, keypoints_AB)
         keypoint_1 = [*keypoints[:3], *keypoints_AB[:3]]
         keypoint_2 = [*keypoints_AB[3:], *keypoints[3:]]
         length = (l2_dist(keypoint_1) + l2_dist(keypoint_2)) / 2
@@ -177,10 +266,8 @@ class ModelOutput:
         }
         prediction.update(guard_cell_grooves)
 
-    def _add_guard_cell_width_keypoints(self, prediction: Dict):
-        guard_cell_polygon = prediction["guard_cell_polygon"]["exterior"]
+    def _add_guard_cell_width_keypoints(self, prediction: Dict, keypoints: List[float]):
         keypoints_AB = prediction["AB_keypoints"]
-        keypoints = find_CD(guard_cell_polygon, keypoints_AB)
         keypoints_CD = prediction["CD_keypoints"]
         if keypoints_CD == [-1, -1, 1, -1, -1, 1]:
             midpoint = calculate_midpoint_of_keypoints(keypoints_AB)
@@ -194,32 +281,64 @@ class ModelOutput:
         }
         prediction.update(guard_cell_width)
 
-    def _add_pore_keypoints(self, i: int, prediction: Dict):
-        keypoints_AB = self._get_keypoints(i)
-        pore_length = l2_dist(keypoints_AB)
-        if self._is_open_stomata(prediction):
-            pore_polygon = prediction["pore_polygon"]
-            # Sanity check for keypoint prediction
-            if self._is_pore_length_extremly_small(i):
-                keypoints_AB = self._extract_AB_from_polygon(pore_polygon)
+    def _add_pore_keypoints(self, predictions: List[Tuple[int, Dict]]):
+        # The first attempt at every open stoma's CD keypoints is made at once
+        open_stomata = [(i, p) for i, p in predictions if self._is_open_stomata(p)]
+        keypoints_AB = [
+            self._get_pore_keypoints(i, prediction) for i, prediction in open_stomata
+        ]
+        pore_polygons = [prediction["pore_polygon"] for _, prediction in open_stomata]
+        keypoints_CD = find_CD_batch(pore_polygons, keypoints_AB)
+        for (_, prediction), AB, CD in zip(open_stomata, keypoints_AB, keypoints_CD):
+            self._add_open_pore_keypoints(prediction, AB, CD)
+        for i, prediction in predictions:
+            if not self._is_open_stomata(prediction):
+                keypoints_AB = self._get_keypoints(i)
+                keypoints_CD = [-1, -1, 1, -1, -1, 1]
                 pore_length = l2_dist(keypoints_AB)
+                self._set_pore_keypoints(
+                    prediction, keypoints_AB, keypoints_CD, pore_length, 0
+                )
+
+    def _get_pore_keypoints(self, i: int, prediction: Dict) -> List[float]:
+        # Sanity check for keypoint prediction
+        if self._is_pore_length_extremly_small(i):
+            return self._extract_AB_from_polygon(prediction["pore_polygon"])
+        return self._get_keypoints(i)
+
+    def _add_open_pore_keypoints(
+        self,
+        prediction: Dict,
+        keypoints_AB: List[float],
+        keypoints_CD: List[float],
+    ):
+        pore_polygon = prediction["pore_polygon"]
+        pore_length = l2_dist(keypoints_AB)
+        # Retry using polygon keypoints
+        if keypoints_CD == [-1, -1, 1, -1, -1, 1]:
+            keypoints_AB = self._extract_AB_from_polygon(pore_polygon)
             keypoints_CD = find_CD(pore_polygon, keypoints_AB)
-            # Retry using polygon keypoints
-            if keypoints_CD == [-1, -1, 1, -1, -1, 1]:
-                keypoints_AB = self._extract_AB_from_polygon(pore_polygon)
-                keypoints_CD = find_CD(pore_polygon, keypoints_AB)
-                pore_length = l2_dist(keypoints_AB)
-            pore_width = l2_dist(keypoints_CD)
-            width_length_ratio = calulate_width_over_length(pore_length, pore_width)
-            if width_length_ratio > WIDTH_OVER_LENGTH_THRESHOLD:
-                keypoints_AB = self._extract_AB_from_polygon(pore_polygon)
-                keypoints_CD = find_CD(pore_polygon, keypoints_AB)
-                pore_length = l2_dist(keypoints_AB)
-
-            pore_width = l2_dist(keypoints_CD)
-        else:
-            keypoints_CD = [-1, -1, 1, -1, -1, 1]
-            pore_width = 0
+            pore_length = l2_dist(keypoints_AB)
+        pore_width = l2_dist(keypoints_CD)
+        width_length_ratio = calulate_width_over_length(pore_length, pore_width)
+        if width_length_ratio > WIDTH_OVER_LENGTH_THRESHOLD:
+            keypoints_AB = self._extract_AB_from_polygon(pore_polygon)
+            keypoints_CD = find_CD(pore_polygon, keypoints_AB)
+            pore_length = l2_dist(keypoints_AB)
+
+        pore_width = l2_dist(keypoints_CD)
+        self._set_pore_keypoints(
+            prediction, keypoints_AB, keypoints_CD, pore_length, pore_width
+        )
+
+    def _set_pore_keypoints(
+        self,
+        prediction: Dict,
+        keypoints_AB: List[float],
+        keypoints_CD: List[float],
+        pore_length: float,
+        pore_width: float,
+    ):
         # Stoma length is always the longest measurement
         if pore_width > pore_length:
             keypoints_AB, keypoints_CD = keypoints_CD, keypoints_AB
@@ -246,9 +365,8 @@ class ModelOutput:
         subsidiary_polygons = []
         subsidiary_area = 0.0
         for subsidiary_cell in self._get_subsidiary_cells(i):
-            polygon = self._select_largest_polygon(subsidiary_cell.polygons)
-            subsidiary_area += subsidiary_cell.area()
-            subsidiary_polygons.append(polygon)
+            subsidiary_area += subsidiary_cell.area
+            subsidiary_polygons.append(subsidiary_cell.largest_polygon)
         # If only one cell was detected estimate total area as double
         if len(subsidiary_polygons) == 1:
             subsidiary_area *= 2
@@ -258,9 +376,9 @@ class ModelOutput:
         }
         prediction.update(subsidiary_cell)
 
-    def _get_subsidiary_cells(self, i: int) -> List[GenericMask]:
+    def _get_subsidiary_cells(self, i: int) -> List[DecodedMask]:
         subsidiary_cells = []
-        subsidiary_cell_indices = self._find_subsidiary_cells(i)
+        subsidiary_cell_indices = self._complex_subsidiary_cells[i]
         if subsidiary_cell_indices is not None:
             if len(subsidiary_cell_indices) > 0:
                 for index in subsidiary_cell_indices:
@@ -268,21 +386,8 @@ class ModelOutput:
         return subsidiary_cells
 
     def _find_subsidiary_cells(self, i: int) -> Union[List[int], None]:
-        subsidiary_cell_indices = []
         stomata_bbox = self._get_bounding_box(i)
-        for j in range(self._n_predictions):
-            if self._is_subsidiary_cell(j):
-                cell_bbox = self._get_bounding_box(j)
-                if is_bbox_a_mostly_in_bbox_b(
-                    cell_bbox,
-                    stomata_bbox,
-                    ORPHAN_AREA_THRESHOLD,
-                ):
-                    subsidiary_cell_indices.append(j)
-        return subsidiary_cell_indices
-
-    def _is_subsidiary_cell(self, i) -> bool:
-        return self._get_class(i) == NAMES_TO_CATEGORY_ID["Subsidiary cells"]
+        return self._subsidiary_cells.find_mostly_in(stomata_bbox)
 
     def _add_width_over_length(self, prediction: Dict):
         length, width = prediction["pore_length"], prediction["pore_width"]
@@ -328,9 +433,11 @@ class ModelOutput:
     def _get_class(self, i: int) -> int:
         return self._predictions.pred_classes[i].item()
 
-    def _get_mask(self, i: int) -> GenericMask:
-        mask = self._predictions.pred_masks[i].cpu().numpy()
-        return GenericMask(mask, *mask.shape)
+    def _get_mask(self, i: int) -> DecodedMask:
+        if i not in self._decoded_masks:
+            masks, bbox = self._predictions.pred_masks, self._get_bounding_box(i)
+            self._decoded_masks[i] = decode_mask(masks, i, bbox)
+        return self._decoded_masks[i]
 
     def _get_keypoints(self, i: int) -> List[float]:
         return self._predictions.pred_keypoints[i].flatten().tolist()
@@ -340,3 +447,31 @@ class ModelOutput:
 
     def _get_confidence(self, i: int) -> float:
         return self._predictions.scores[i].item()
+
+
+class CountOutput(ModelOutput):
+    """
+    Stomata found from the model's boxes alone, for runs that only count
+    stomata. Nothing is measured, so the pore of an open stoma is not
+    checked and no stoma is removed for being wider than it is long.
+    """
+
+    def _build_structure_indices(self):
+        pass
+
+    def _format_predictions(self):
+        for i in range(self._n_predictions):
+            if not self._is_stomata_complex(i):
+                continue
+            prediction = {}
+            self._add_complex_detction(i, prediction)
+            prediction["stoma_id"] = self._n_stoma_processed
+            self._n_stoma_processed += 1
+            self._formatted_predictions.append(prediction)
+            self._add_bounding_box_dimensions(prediction["bbox"])
+
+
+def format_model_output(predictions: Instances, n_stoma: int) -> ModelOutput:
+    if Option_State["density_only"]:
+        return CountOutput(predictions, n_stoma)
+    return ModelOutput(predictions, n_stoma)
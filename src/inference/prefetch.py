@@ -0,0 +1,84 @@
+import collections
+import itertools
+import time
+from concurrent import futures
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from inference.timing import record_stage_time
+from tools.load import load_image_from_folder
+
+
+class ImagePrefetcher:
+    """
+    Decodes up to `depth` images ahead of the one currently being measured
+    on a thread pool, so that at most `depth` decoded images wait in memory.
+    A depth of zero decodes each image when it is requested.
+    """
+
+    def __init__(self, directory: str, filenames: List[str], depth: int):
+        self._directory = directory
+        self._filenames = filenames
+        self._depth = depth
+        self.decode_time = 0.0
+        self.wait_time = 0.0
+
+    def __iter__(self) -> Iterator[Tuple[str, np.ndarray]]:
+        if self._depth < 1:
+            yield from self._iterate_without_prefetching()
+            return
+        with futures.ThreadPoolExecutor(max_workers=self._depth) as executor:
+            filenames = iter(self._filenames)
+            pending = collections.deque(
+                self._submit(executor, filename)
+                for filename in itertools.islice(filenames, self._depth)
+            )
+            while pending:
+                decoded = self._wait_for(pending.popleft())
+                for filename in itertools.islice(filenames, 1):
+                    pending.append(self._submit(executor, filename))
+                yield decoded
+
+    @property
+    def overlap_time(self) -> float:
+        # Decoding that happened while the caller was busy measuring
+        return max(0.0, self.decode_time - self.wait_time)
+
+    @property
+    def overlap_fraction(self) -> float:
+        if self.decode_time > 0:
+            return self.overlap_time / self.decode_time
+        return 0.0
+
+    def summary(self) -> str:
+        return (
+            f"{self.overlap_time:.2f}s of {self.decode_time:.2f}s spent decoding"
+            f" images overlapped with measurement ({self.overlap_fraction:.0%})"
+        )
+
+    def _iterate_without_prefetching(self) -> Iterator[Tuple[str, np.ndarray]]:
+        for filename in self._filenames:
+            start_time = time.time()
+            _, image, decode_time = self._decode(filename)
+            self.wait_time += time.time() - start_time
+            self.decode_time += decode_time
+            record_stage_time("decode", decode_time)
+            yield filename, image
+
+    def _submit(self, executor: futures.Executor, filename: str) -> futures.Future:
+        return executor.submit(self._decode, filename)
+
+    def _wait_for(self, future: futures.Future) -> Tuple[str, np.ndarray]:
+        start_time = time.time()
+        filename, image, decode_time = future.result()
+        self.wait_time += time.time() - start_time
+        self.decode_time += decode_time
+        # Attributed to the measuring thread, whichever thread decoded the image
+        record_stage_time("decode", decode_time)
+        return filename, image
+
+    def _decode(self, filename: str) -> Tuple[str, np.ndarray, float]:
+        start_time = time.time()
+        image = load_image_from_folder(self._directory, filename)
+        return filename, image, time.time() - start_time
@@ -0,0 +1,82 @@
+import os
+import threading
+from typing import List, Union
+
+import numpy as np
+
+from inference.infer import (
+    Engine_Setup_Locks,
+    Inference_Engines,
+    maybe_setup_species_inference_engine,
+)
+from tools.constants import PLANT_OPTIONS
+
+# Comma separated species, or "all", whose models are loaded at server start
+PRELOAD_VARIABLE = "SAI_PRELOAD_MODELS"
+WARM_UP_IMAGE_SIZE = (1024, 1024)
+Preload_Status = {}
+Preload_Lock = threading.Lock()
+
+
+def maybe_start_preloading():
+    # Streamlit re-runs the app script on every interaction, start only once
+    with Preload_Lock:
+        if len(Preload_Status) > 0:
+            return
+        species_to_preload = get_species_to_preload()
+        for species in species_to_preload:
+            Preload_Status[species] = "waiting to load"
+    if len(species_to_preload) > 0:
+        thread = threading.Thread(
+            target=preload_engines,
+            args=(species_to_preload,),
+            name="model-preload",
+            daemon=True,
+        )
+        thread.start()
+
+
+def get_species_to_preload() -> List[str]:
+    requested = os.environ.get(PRELOAD_VARIABLE, "").strip()
+    if requested.lower() == "all":
+        return list(PLANT_OPTIONS)
+    species_to_preload = []
+    for name in requested.split(","):
+        matches = [
+            species
+            for species in PLANT_OPTIONS
+            if species.lower() == name.strip().lower()
+        ]
+        if len(matches) > 0:
+            species_to_preload.append(matches[0])
+        elif name.strip() != "":
+            print(f"{PRELOAD_VARIABLE}: no model for {name.strip()}")
+    return species_to_preload
+
+
+def preload_engines(species_to_preload: List[str]):
+    for species in species_to_preload:
+        try:
+            Preload_Status[species] = "loading"
+            maybe_setup_species_inference_engine(species)
+            Preload_Status[species] = "warming up"
+            # Measurements wait for the warm-up rather than competing with it
+            with Engine_Setup_Locks[species]:
+                warm_up_engine(Inference_Engines[species])
+        except Exception as error:
+            Preload_Status[species] = "failed to load"
+            print(f"Preloading the {species} model failed: {error}")
+            continue
+        Preload_Status[species] = "ready"
+
+
+def warm_up_engine(engine):
+    # The first forward pass pays for allocator and kernel initialisation
+    height, width = WARM_UP_IMAGE_SIZE
+    random_generator = np.random.default_rng(0)
+    image = random_generator.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    engine.run_on_image(image)
+
+
+def get_preload_status(species: str) -> Union[str, None]:
+    return Preload_Status.get(species)
@@ -0,0 +1,117 @@
+import math
+from typing import Iterable, List
+
+import numpy as np
+from scipy.stats import iqr
+
+# Values kept exactly before the sketch starts compacting them, its rank
+# error afterwards is of the order of 1 / SKETCH_SIZE
+SKETCH_SIZE = 8192
+MINIMUM_LEVEL_CAPACITY = 8
+
+
+class QuantileSketch:
+    """
+    A KLL sketch of a stream of values, which answers quantile queries in
+    memory that only grows with the logarithm of the number of values. Level
+    h holds values standing for 2**h of the original ones: when a level
+    overflows, it is sorted and every other value is promoted to the level
+    above. Until the first overflow every value is kept, and quantiles are
+    exact. Sketches of parts of a stream can be merged.
+    """
+
+    def __init__(self, size: int = SKETCH_SIZE):
+        self.size = size
+        self.n_values = 0
+        self._levels = [[]]
+        # Alternating which half of a level is promoted keeps it unbiased,
+        # while the sketch stays deterministic
+        self._offsets = [0]
+
+    def add(self, value: float):
+        self.extend([value])
+
+    def extend(self, values: Iterable[float]):
+        level = self._levels[0]
+        n_values = len(level)
+        level.extend(values)
+        self.n_values += len(level) - n_values
+        if len(level) > self._get_capacity(0):
+            self._compress()
+
+    def merge(self, other: "QuantileSketch"):
+        for height, level in enumerate(other._levels):
+            if height == len(self._levels):
+                self._add_level()
+            self._levels[height].extend(level)
+        self.n_values += other.n_values
+        self._compress()
+
+    def clear(self):
+        self.__init__(self.size)
+
+    @property
+    def is_exact(self) -> bool:
+        return len(self._levels) == 1
+
+    @property
+    def n_retained(self) -> int:
+        return sum([len(level) for level in self._levels])
+
+    def median(self) -> float:
+        if self.is_exact:
+            return float(np.median(self._levels[0]))
+        return self.quantile(0.5)
+
+    def interquartile_range(self) -> float:
+        if self.is_exact:
+            return float(iqr(self._levels[0], interpolation="midpoint"))
+        return self.quantile(0.75) - self.quantile(0.25)
+
+    def quantile(self, q: float) -> float:
+        if self.n_values == 0:
+            return math.nan
+        values, weights = [], []
+        for height, level in enumerate(self._levels):
+            values.extend(level)
+            weights.extend([2**height] * len(level))
+        order = np.argsort(values, kind="stable")
+        cumulative_weights = np.cumsum(np.array(weights)[order])
+        rank = q * cumulative_weights[-1]
+        i = min(np.searchsorted(cumulative_weights, rank), len(values) - 1)
+        return float(np.array(values)[order][i])
+
+    def _get_capacity(self, height: int) -> int:
+        depth = len(self._levels) - height - 1
+        return max(MINIMUM_LEVEL_CAPACITY, math.ceil(self.size * (2 / 3) ** depth))
+
+    def _add_level(self):
+        self._levels.append([])
+        self._offsets.append(0)
+
+    def _compress(self):
+        height = 0
+        while height < len(self._levels):
+            if len(self._levels[height]) > self._get_capacity(height):
+                if height + 1 == len(self._levels):
+                    self._add_level()
+                self._compact_level(height)
+            height += 1
+
+    def _compact_level(self, height: int):
+        level = sorted(self._levels[height])
+        # With an odd number of values, the largest stays on this level
+        remainder = level[-1:] if len(level) % 2 == 1 else []
+        paired = level[: len(level) - len(remainder)]
+        offset = self._offsets[height]
+        self._offsets[height] = 1 - offset
+        self._levels[height + 1].extend(paired[offset::2])
+        self._levels[height] = remainder
+
+
+def calculate_whiskers(sketch: QuantileSketch) -> List[float]:
+    inter_quartile_range = sketch.interquartile_range()
+    median = sketch.median()
+    lower_whisker = median - 2.0 * inter_quartile_range
+    upper_whisker = median + 2.0 * inter_quartile_range
+    return [lower_whisker, upper_whisker]
@@ -0,0 +1,41 @@
+import math
+from typing import Tuple
+
+from tools.constants import CAMERA_CALIBRATION, IMAGE_AREA
+from tools.state import Option_State
+
+MINIMUM_TEST_RESOLUTION = 128
+
+
+def get_test_resolution(image_size: Tuple[int, int], default_resolution: int) -> int:
+    # The shortest edge the image is resized to before the model, outputs are
+    # scaled back to the image's own pixels by post-processing
+    selected_species = Option_State["plant_type"]
+    if Option_State["calibrated_resolution"]:
+        return get_calibrated_resolution(
+            image_size, default_resolution, selected_species
+        )
+    resolution = Option_State["inference_resolution"].get(selected_species, 0)
+    if resolution > 0:
+        return resolution
+    return default_resolution
+
+
+def get_calibrated_resolution(
+    image_size: Tuple[int, int],
+    default_resolution: int,
+    selected_species: str,
+) -> int:
+    # Stomata appear as large to the model as in the species' example images,
+    # resized to default_resolution. Only ever downscales high resolution images
+    camera_calibration = Option_State["camera_calibration"]
+    if camera_calibration is None or camera_calibration <= 0:
+        return default_resolution
+    training_calibration = CAMERA_CALIBRATION[selected_species]
+    # IMAGE_AREA is in mm^2, calibrations in pixels per micron
+    n_training_pixels = IMAGE_AREA[selected_species] * 1e6 * training_calibration**2
+    relative_size = math.sqrt(image_size[0] * image_size[1] / n_training_pixels)
+    resolution = default_resolution * relative_size
+    resolution *= training_calibration / camera_calibration
+    resolution = max(round(resolution), MINIMUM_TEST_RESOLUTION)
+    return min(resolution, default_resolution)
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterator, List, Union
+
+from app import utils
+from inference.infer import (
+    get_configuration_filepath,
+    get_model_weights_filepath,
+    maybe_download_config_files,
+    maybe_download_model_weights,
+)
+from tools.state import Option_State
+
+# Bump when a change to post-processing alters the measurements of an image
+RESULT_FORMAT_VERSION = 1
+CACHED_FIELDS = [
+    "detections",
+    "invalid_detections",
+    "image_size",
+    "n_predictions",
+    "pore_lengths",
+    "bounding_box_dimensions",
+]
+File_Digests = {}
+
+
+class ResultCache:
+    """
+    Persistent store of each image's measurements, keyed by the content of the
+    image file and a digest of the model and settings that measured it. Folders
+    can then be re-measured by only running the model on images it has not
+    seen, or that were measured by a different model.
+    """
+
+    def __init__(self, directory: str, model_key: str):
+        self.directory = os.path.join(directory, model_key)
+        self.n_hits = 0
+        self.n_misses = 0
+        self._keys = {}
+        self._misses = set()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def find_misses(self, directory: str, image_files: List[str]) -> List[str]:
+        misses = []
+        for filename in image_files:
+            key = calculate_file_digest(os.path.join(directory, filename))
+            self._keys[filename] = key
+            if not self.contains(key):
+                misses.append(filename)
+        self._misses = set(misses)
+        return misses
+
+    def merge(self, image_files: List[str], measured: Iterator[Dict]) -> Iterator[Dict]:
+        # Yields results in the order of image_files, saving newly measured ones
+        measured = iter(measured)
+        for filename in image_files:
+            key = self._keys[filename]
+            if filename in self._misses:
+                result = next(measured)
+                self.save(key, result)
+                yield result
+            else:
+                yield self.load(key, filename)
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(self._get_filepath(key))
+
+    def load(self, key: str, filename: str) -> Dict:
+        with open(self._get_filepath(key), "r") as file:
+            result = json.load(file)
+        result["filename"] = filename
+        result["time_elapsed"] = 0.0
+        self.n_hits += 1
+        return result
+
+    def save(self, key: str, result: Dict):
+        to_save = {field: result[field] for field in CACHED_FIELDS}
+        # Written under a temporary name so an interrupted run leaves no partial entry
+        filepath = self._get_filepath(key)
+        temporary_filepath = f"{filepath}.{os.getpid()}.tmp"
+        utils.write_to_json(to_save, temporary_filepath)
+        os.replace(temporary_filepath, filepath)
+        self.n_misses += 1
+
+    def summary(self) -> str:
+        return (
+            f"{self.n_hits} images loaded from the result cache,"
+            f" {self.n_misses} measured"
+        )
+
+    def _get_filepath(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+
+def maybe_setup_result_cache() -> Union[ResultCache, None]:
+    if not Option_State["use_result_cache"]:
+        return None
+    selected_species = Option_State["plant_type"]
+    maybe_download_config_files(selected_species)
+    maybe_download_model_weights(selected_species)
+    model_key = get_model_key(selected_species)
+    return ResultCache(Option_State["result_cache_path"], model_key)
+
+
+def get_model_key(selected_species: str) -> str:
+    species_name = selected_species.lower()
+    filepaths = [
+        get_configuration_filepath("Base-RCNN-FPN"),
+        get_configuration_filepath(species_name),
+        get_configuration_filepath(f"{species_name}_v2"),
+        get_model_weights_filepath(species_name),
+    ]
+    digest = hashlib.sha256()
+    for filepath in filepaths:
+        digest.update(calculate_file_digest(filepath).encode())
+    # Quantized, ONNX, tiled, fast, count only and rescaled results can differ
+    # from the default. Each setting is kept out of the key at its default, so
+    # adding a setting leaves earlier entries valid
+    settings = [RESULT_FORMAT_VERSION]
+    # Only the PyTorch backend quantizes the model
+    if Option_State["inference_backend"] != "PyTorch":
+        settings.append(Option_State["inference_backend"])
+    elif Option_State["quantize_model"]:
+        settings.append("quantized")
+    if Option_State["tile_size"] > 0:
+        settings += ["tiled", Option_State["tile_size"], Option_State["tile_overlap"]]
+    if Option_State["measurement_mode"] != "Keypoints":
+        settings.append(Option_State["measurement_mode"])
+    if Option_State["density_only"]:
+        settings.append("density_only")
+    settings += get_resolution_settings(selected_species)
+    digest.update(json.dumps(settings).encode())
+    return digest.hexdigest()[:16]
+
+
+def get_resolution_settings(selected_species: str) -> List:
+    if Option_State["calibrated_resolution"]:
+        return ["calibrated", Option_State["camera_calibration"]]
+    resolution = Option_State["inference_resolution"].get(selected_species, 0)
+    return [resolution] if resolution > 0 else []
+
+
+def calculate_file_digest(filepath: str) -> str:
+    # Weights are hundreds of MB, so digests are kept until the file changes
+    status = os.stat(filepath)
+    file_id = (os.path.abspath(filepath), status.st_size, status.st_mtime_ns)
+    if file_id not in File_Digests:
+        digest = hashlib.sha256()
+        with open(filepath, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        File_Digests[file_id] = digest.hexdigest()
+    return File_Digests[file_id]
+
+
+def find_uncached_images(
+    cache: Union[ResultCache, None],
+    directory: str,
+    image_files: List[str],
+) -> List[str]:
+    if cache is None:
+        return image_files
+    return cache.find_misses(directory, image_files)
+
+
+def merge_with_cached_results(
+    cache: Union[ResultCache, None],
+    image_files: List[str],
+    measured: Iterator[Dict],
+) -> Iterator[Dict]:
+    if cache is None:
+        return iter(measured)
+    return cache.merge(image_files, measured)
@@ -0,0 +1,272 @@
+import contextlib
+import itertools
+import json
+import math
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from app.utils import np_encoder
+from inference.utils import split_into_batches
+from tools.state import Option_State
+
+RESULT_STORE_FILENAME = "results.sqlite"
+# Measurements stored as columns of the stomata table, the remaining fields of
+# a detection, such as polygons and keypoints, are stored as JSON
+SCALAR_FIELDS = [
+    "category_id",
+    "confidence",
+    "pore_length",
+    "pore_width",
+    "pore_area",
+    "width_over_length",
+    "guard_cell_area",
+    "guard_cell_width",
+    "guard_cell_groove_length",
+    "subsidiary_cell_area",
+]
+BBOX_COLUMNS = ["bbox_x1", "bbox_y1", "bbox_x2", "bbox_y2"]
+STOMA_COLUMNS = ["stoma_id", "image_name", "is_valid", "position"]
+STOMA_COLUMNS += BBOX_COLUMNS + SCALAR_FIELDS
+IMAGES_PER_READ = 256
+Result_Stores = {}
+
+
+class ResultStore:
+    """
+    The records of a run's images in a single SQLite database. Stoma ids are
+    only unique within an image, as invalid detections are not counted when
+    offsetting them, so stomata are keyed by image and stoma id. Each stoma's
+    measurements are a row of the stomata table, while its polygons and
+    keypoints are kept apart in the geometry table, so that population
+    filtering and the output tables never load them. Measurement columns
+    have no declared type, so values keep the type they were recorded with,
+    except non-finite measurements, which are stored as text since SQLite
+    would store NaN as NULL.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        # One connection, used by the app's threads one transaction at a time
+        self._connection = sqlite3.connect(filepath, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        # Each commit survives the process crashing, without waiting for a sync
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        with self._transaction() as connection:
+            create_tables(connection)
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock, self._connection:
+            yield self._connection
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def add_record(self, image_name: str, record: Dict):
+        # Replaces an earlier record of an image with the same name
+        stomata, geometries = [], []
+        for is_valid, key in [(1, "detections"), (0, "invalid_detections")]:
+            for position, detection in enumerate(record[key]):
+                scalars, geometry = split_detection(detection)
+                scalars.update(image_name=image_name, is_valid=is_valid)
+                scalars["position"] = position
+                stomata.append([scalars.get(column) for column in STOMA_COLUMNS])
+                if len(geometry) > 0:
+                    geometry_json = json.dumps(geometry, default=np_encoder)
+                    stoma_id = scalars["stoma_id"]
+                    geometries.append((image_name, stoma_id, geometry_json))
+        height, width = record["image_size"][:2]
+        with self._transaction() as connection:
+            delete_image(connection, image_name)
+            connection.execute(
+                "INSERT INTO images (image_name, height, width) VALUES (?, ?, ?)",
+                (image_name, int(height), int(width)),
+            )
+            placeholders = ", ".join(["?"] * len(STOMA_COLUMNS))
+            connection.executemany(
+                f"INSERT INTO stomata ({', '.join(STOMA_COLUMNS)})"
+                f" VALUES ({placeholders})",
+                stomata,
+            )
+            connection.executemany(
+                "INSERT INTO geometry (image_name, stoma_id, data) VALUES (?, ?, ?)",
+                geometries,
+            )
+
+    def iterate_records(self, include_geometry: bool = True) -> Iterator[Dict]:
+        # Records are read IMAGES_PER_READ images at a time, in the order they
+        # were added, so callers may update the store between records
+        with self._transaction() as connection:
+            rows = connection.execute("SELECT image_id FROM images ORDER BY image_id")
+            image_ids = [row["image_id"] for row in rows]
+        for batch in split_into_batches(image_ids, IMAGES_PER_READ):
+            placeholders = ", ".join(["?"] * len(batch))
+            condition = f"images.image_id IN ({placeholders})"
+            yield from self._read_records(condition, batch, include_geometry)
+
+    def load_record(self, image_name: str) -> Dict:
+        records = list(self._read_records("images.image_name = ?", [image_name], True))
+        if len(records) == 0:
+            raise KeyError(f"There is no record of {image_name}")
+        return records[0]
+
+    def _read_records(
+        self,
+        condition: str,
+        parameters: List,
+        include_geometry: bool,
+    ) -> List[Dict]:
+        stoma_columns = ", ".join([f"stomata.{c}" for c in STOMA_COLUMNS[2:]])
+        stoma_columns = f"stomata.stoma_id, {stoma_columns}"
+        geometry_column, geometry_join = "NULL", ""
+        if include_geometry:
+            geometry_column = "geometry.data"
+            geometry_join = (
+                "LEFT JOIN geometry ON geometry.image_name = stomata.image_name"
+                " AND geometry.stoma_id = stomata.stoma_id"
+            )
+        query = f"""
+            SELECT images.image_id, images.image_name, images.height,
+                images.width, {stoma_columns}, {geometry_column} AS geometry
+            FROM images
+            LEFT JOIN stomata ON stomata.image_name = images.image_name
+            {geometry_join}
+            WHERE {condition}
+            ORDER BY images.image_id, stomata.is_valid DESC, stomata.position
+        """
+        with self._transaction() as connection:
+            rows = connection.execute(query, parameters).fetchall()
+        records = []
+        for _, image_rows in itertools.groupby(rows, lambda row: row["image_id"]):
+            image_rows = list(image_rows)
+            record = {"detections": [], "invalid_detections": []}
+            for row in image_rows:
+                if row["stoma_id"] is None:
+                    continue
+                key = "detections" if row["is_valid"] else "invalid_detections"
+                record[key].append(join_detection(row))
+            record["image_size"] = [image_rows[0]["height"], image_rows[0]["width"]]
+            record["image_name"] = image_rows[0]["image_name"]
+            records.append(record)
+        return records
+
+    def update_detections(self, records: List[Dict]):
+        # Saves which detections of each record are valid, and their order
+        updates = []
+        for record in records:
+            for is_valid, key in [(1, "detections"), (0, "invalid_detections")]:
+                for position, detection in enumerate(record[key]):
+                    stoma_id = detection["stoma_id"]
+                    updates.append((is_valid, position, record["image_name"], stoma_id))
+        with self._transaction() as connection:
+            connection.executemany(
+                "UPDATE stomata SET is_valid = ?, position = ?"
+                " WHERE image_name = ? AND stoma_id = ?",
+                updates,
+            )
+
+
+def get_result_store() -> ResultStore:
+    # One store per output folder, opened again if its database was deleted,
+    # as the app does when clearing the output folder before measuring
+    filepath = os.path.join(Option_State["output_path"], RESULT_STORE_FILENAME)
+    store = Result_Stores.get(filepath)
+    if store is None or not os.path.exists(filepath):
+        if store is not None:
+            store.close()
+        store = Result_Stores[filepath] = ResultStore(filepath)
+    return store
+
+
+def create_tables(connection: sqlite3.Connection):
+    measurement_columns = ", ".join(BBOX_COLUMNS + SCALAR_FIELDS)
+    connection.executescript(f"""
+        CREATE TABLE IF NOT EXISTS images (
+            image_id INTEGER PRIMARY KEY,
+            image_name TEXT UNIQUE NOT NULL,
+            height INTEGER NOT NULL,
+            width INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS stomata (
+            stoma_id INTEGER NOT NULL,
+            image_name TEXT NOT NULL,
+            is_valid INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            {measurement_columns},
+            PRIMARY KEY (image_name, stoma_id)
+        );
+        CREATE TABLE IF NOT EXISTS geometry (
+            image_name TEXT NOT NULL,
+            stoma_id INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (image_name, stoma_id)
+        );
+        """)
+
+
+def delete_image(connection: sqlite3.Connection, image_name: str):
+    connection.execute("DELETE FROM geometry WHERE image_name = ?", (image_name,))
+    connection.execute("DELETE FROM stomata WHERE image_name = ?", (image_name,))
+    connection.execute("DELETE FROM images WHERE image_name = ?", (image_name,))
+
+
+def split_detection(detection: Dict) -> Tuple[Dict, Dict]:
+    scalars, geometry = {"stoma_id": int(detection["stoma_id"])}, {}
+    for key, value in detection.items():
+        if key == "stoma_id":
+            continue
+        if key in SCALAR_FIELDS and is_storable_number(value):
+            scalars[key] = to_column_value(value)
+        elif key == "bbox" and is_storable_bbox(value):
+            scalars.update(zip(BBOX_COLUMNS, map(to_column_value, value)))
+        else:
+            geometry[key] = value
+    return scalars, geometry
+
+
+def join_detection(row: sqlite3.Row) -> Dict:
+    detection = {"stoma_id": row["stoma_id"]}
+    bbox = [row[column] for column in BBOX_COLUMNS]
+    if None not in bbox:
+        detection["bbox"] = list(map(from_column_value, bbox))
+    for field in SCALAR_FIELDS:
+        if row[field] is not None:
+            detection[field] = from_column_value(row[field])
+    if row["geometry"] is not None:
+        detection.update(json.loads(row["geometry"]))
+    return detection
+
+
+def is_storable_bbox(bbox) -> bool:
+    if len(bbox) != len(BBOX_COLUMNS):
+        return False
+    return all([is_storable_number(value) for value in bbox])
+
+
+def is_storable_number(value) -> bool:
+    if isinstance(value, (bool, np.bool_)):
+        return False
+    return isinstance(value, (int, np.integer, float, np.floating))
+
+
+def to_column_value(value):
+    # SQLite stores NaN as NULL, which marks a missing measurement, so
+    # non-finite values are stored as "nan", "inf" or "-inf"
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return str(value)
+    return value
+
+
+def from_column_value(value):
+    if isinstance(value, str):
+        return float(value)
+    return value
@@ -0,0 +1,142 @@
+from typing import List, Tuple
+
+import numpy as np
+import torch
+from detectron2.structures import Boxes, Instances
+
+from inference.constants import CLOSE_TO_EDGE_DISTANCE
+from inference.initial_filter import select_predictions
+from inference.masks import move_masks
+from inference.utils import (
+    find_touching_pairs,
+    rowwise_is_overlapping,
+    split_into_batches,
+)
+from tools.state import Option_State
+
+
+def is_tiling_required(image: np.ndarray) -> bool:
+    tile_size = Option_State["tile_size"]
+    if tile_size < 1:
+        return False
+    height, width = image.shape[:2]
+    return height > tile_size or width > tile_size
+
+
+def run_on_tiles(engine, image: np.ndarray) -> Instances:
+    tile_size, overlap = Option_State["tile_size"], Option_State["tile_overlap"]
+    image_size = image.shape[:2]
+    tiles = get_tile_windows(image_size, tile_size, overlap)
+    tile_predictions = []
+    for windows in split_into_batches(tiles, Option_State["batch_size"]):
+        images = [image[y1:y2, x1:x2] for x1, y1, x2, y2 in windows]
+        for window, predictions in zip(windows, engine.run_on_batch(images)):
+            predictions = move_to_image_coordinates(predictions, window, image_size)
+            remove_detections_cut_by_tile(predictions, window, image_size)
+            tile_predictions.append(predictions)
+    predictions = Instances.cat(tile_predictions)
+    remove_duplicate_tile_predictions(predictions)
+    return predictions
+
+
+def get_tile_windows(
+    image_size: Tuple[int, int],
+    tile_size: int,
+    overlap: int,
+) -> List[List[int]]:
+    height, width = image_size
+    windows = []
+    for y in get_tile_starts(height, tile_size, overlap):
+        for x in get_tile_starts(width, tile_size, overlap):
+            windows.append(
+                [x, y, min(x + tile_size, width), min(y + tile_size, height)]
+            )
+    return windows
+
+
+def get_tile_starts(length: int, tile_size: int, overlap: int) -> List[int]:
+    if overlap >= tile_size:
+        raise ValueError(
+            f"Tile overlap ({overlap}px) must be smaller than the tile size"
+            f" ({tile_size}px)"
+        )
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, length - tile_size, stride))
+    starts.append(length - tile_size)
+    return starts
+
+
+def move_to_image_coordinates(
+    predictions: Instances,
+    window: List[int],
+    image_size: Tuple[int, int],
+) -> Instances:
+    x_offset, y_offset = window[:2]
+    boxes = predictions.pred_boxes.tensor
+    offset = torch.tensor([x_offset, y_offset, x_offset, y_offset], dtype=boxes.dtype)
+    moved = Instances(image_size)
+    moved.pred_boxes = Boxes(boxes + offset)
+    moved.scores = predictions.scores
+    moved.pred_classes = predictions.pred_classes
+    # Runs that only count stomata have no masks or keypoints
+    if not predictions.has("pred_masks"):
+        return moved
+    moved.pred_masks = move_masks(
+        predictions.pred_masks, boxes, (x_offset, y_offset), image_size
+    )
+    keypoints = predictions.pred_keypoints.clone()
+    keypoints[..., 0] += x_offset
+    keypoints[..., 1] += y_offset
+    moved.pred_keypoints = keypoints
+    return moved
+
+
+def remove_detections_cut_by_tile(
+    predictions: Instances,
+    window: List[int],
+    image_size: Tuple[int, int],
+):
+    # Objects cut by an edge shared with another tile are whole in that tile
+    indices = [
+        i
+        for i, bbox in enumerate(predictions.pred_boxes.tensor.tolist())
+        if not is_near_shared_tile_edge(bbox, window, image_size)
+    ]
+    select_predictions(predictions, indices)
+
+
+def is_near_shared_tile_edge(
+    bbox: List[float],
+    window: List[int],
+    image_size: Tuple[int, int],
+) -> bool:
+    height, width = image_size
+    x1, y1, x2, y2 = window
+    is_near_edge = any(
+        [
+            x1 > 0 and bbox[0] - x1 < CLOSE_TO_EDGE_DISTANCE,
+            y1 > 0 and bbox[1] - y1 < CLOSE_TO_EDGE_DISTANCE,
+            x2 < width and x2 - bbox[2] < CLOSE_TO_EDGE_DISTANCE,
+            y2 < height and y2 - bbox[3] < CLOSE_TO_EDGE_DISTANCE,
+        ]
+    )
+    return is_near_edge
+
+
+def remove_duplicate_tile_predictions(predictions: Instances):
+    # The overlap test remove_intersecting_predictions uses, within each class,
+    # for the pairs of boxes that touch rather than every pair in the scan
+    boxes = predictions.pred_boxes.tensor.double()
+    classes, scores = predictions.pred_classes, predictions.scores
+    i, j = find_touching_pairs(boxes)
+    is_same_class = classes[i] == classes[j]
+    i, j = i[is_same_class], j[is_same_class]
+    is_overlapping = rowwise_is_overlapping(boxes[i], boxes[j])
+    i, j = i[is_overlapping], j[is_overlapping]
+    # Neighbouring tiles can score an object identically, keep the first
+    is_beaten = (scores[i] < scores[j]) | ((scores[i] == scores[j]) & (i > j))
+    is_best = torch.ones(len(scores), dtype=torch.bool)
+    is_best[i[is_beaten]] = False
+    select_predictions(predictions, is_best)
@@ -0,0 +1,222 @@
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterator, List
+
+import numpy as np
+import torch
+
+from tools.state import Option_State
+
+# Submodules of the detectron2 model timed as stages of their own
+MODEL_STAGES = {
+    "backbone": "backbone",
+    "proposal_generator": "proposals",
+    "roi_heads": "roi_heads",
+}
+PERCENTILES = {"p50": 50, "p95": 95}
+PROMETHEUS_FILENAME = "sai_stage_timings.prom"
+PROMETHEUS_PREFIX = "sai"
+# Seconds each thread spent in each stage since they were last collected
+Thread_Stage_Times = threading.local()
+
+
+class RunTimings:
+    """
+    Seconds spent in each processing stage of a run, per image for the
+    stages applied to every image and once for the stages applied to the
+    whole folder. Stages may be nested, the model's stages contain those of
+    its backbone and heads, so they do not add up to the run time.
+    """
+
+    def __init__(self):
+        self.image_stage_times = collections.defaultdict(list)
+        self.run_stage_times = collections.defaultdict(float)
+        self.n_images = 0
+
+    def add_image(self, stage_times: Dict[str, float]):
+        self.n_images += 1
+        for stage, seconds in stage_times.items():
+            self.image_stage_times[stage].append(seconds)
+
+    def add_run_stages(self, stage_times: Dict[str, float]):
+        for stage, seconds in stage_times.items():
+            self.run_stage_times[stage] += seconds
+
+    def clear(self):
+        self.image_stage_times.clear()
+        self.run_stage_times.clear()
+        self.n_images = 0
+
+    def summary(self) -> Dict:
+        image_stages = {
+            stage: summarise_stage_times(times)
+            for stage, times in self.image_stage_times.items()
+        }
+        return {
+            "n_images": self.n_images,
+            "image_stages": image_stages,
+            "run_stages": dict(self.run_stage_times),
+        }
+
+
+Run_Timings = RunTimings()
+
+
+def is_stage_timing_enabled() -> bool:
+    return Option_State["stage_timing"]
+
+
+@contextlib.contextmanager
+def time_stage(stage: str) -> Iterator[None]:
+    if not is_stage_timing_enabled():
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage_time(stage, time.perf_counter() - start_time)
+
+
+def record_stage_time(stage: str, seconds: float):
+    if not is_stage_timing_enabled():
+        return
+    stage_times = get_thread_stage_times()
+    stage_times[stage] = stage_times.get(stage, 0.0) + seconds
+
+
+def get_thread_stage_times() -> Dict[str, float]:
+    if not hasattr(Thread_Stage_Times, "stage_times"):
+        Thread_Stage_Times.stage_times = {}
+    return Thread_Stage_Times.stage_times
+
+
+def collect_stage_times() -> Dict[str, float]:
+    stage_times = dict(get_thread_stage_times())
+    get_thread_stage_times().clear()
+    return stage_times
+
+
+def split_stage_times(stage_times: Dict[str, float], n_images: int) -> Dict:
+    # Images measured together share the time of their batch equally
+    return {stage: seconds / n_images for stage, seconds in stage_times.items()}
+
+
+def add_stage_timing_hooks(model: torch.nn.Module) -> List:
+    handles = []
+    for attribute, stage in MODEL_STAGES.items():
+        module = getattr(model, attribute, None)
+        if module is not None:
+            handles += add_module_timing_hooks(module, stage)
+    return handles
+
+
+def add_module_timing_hooks(module: torch.nn.Module, stage: str) -> List:
+    start_times = []
+
+    def start(module, inputs):
+        start_times.append(get_synchronised_time())
+
+    def stop(module, inputs, outputs):
+        record_stage_time(stage, get_synchronised_time() - start_times.pop())
+
+    return [
+        module.register_forward_pre_hook(start),
+        module.register_forward_hook(stop),
+    ]
+
+
+def get_synchronised_time() -> float:
+    # CUDA kernels run asynchronously, so wait for them to finish
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter()
+
+
+def start_run_timings():
+    Run_Timings.clear()
+    get_thread_stage_times().clear()
+
+
+def record_image_stage_times(result: Dict):
+    # Adds the stages measured with the image to those of recording it
+    if not is_stage_timing_enabled():
+        return
+    stage_times = result.get("stage_times", {}).copy()
+    for stage, seconds in collect_stage_times().items():
+        stage_times[stage] = stage_times.get(stage, 0.0) + seconds
+    Run_Timings.add_image(stage_times)
+
+
+def record_run_stage_times():
+    if is_stage_timing_enabled():
+        Run_Timings.add_run_stages(collect_stage_times())
+
+
+def summarise_stage_times(times: List[float]) -> Dict:
+    summary = {"count": len(times), "total": float(np.sum(times))}
+    for name, percentile in PERCENTILES.items():
+        summary[name] = float(np.percentile(times, percentile))
+    summary["max"] = float(np.max(times))
+    return summary
+
+
+def save_timing_report(run_name: str) -> str:
+    # A JSON report for each run, and a Prometheus textfile of the latest run
+    directory = Option_State["timing_report_path"]
+    os.makedirs(directory, exist_ok=True)
+    timestamp = time.strftime("%Y%m%d-%H%M%S")
+    report = {"run": run_name, "date": timestamp, **Run_Timings.summary()}
+    report_filepath = os.path.join(directory, f"{run_name}_{timestamp}.json")
+    write_atomically(json.dumps(report, indent=2), report_filepath)
+    prometheus_filepath = os.path.join(directory, PROMETHEUS_FILENAME)
+    write_atomically(format_prometheus_metrics(report), prometheus_filepath)
+    return report_filepath
+
+
+def format_prometheus_metrics(report: Dict) -> str:
+    name = f"{PROMETHEUS_PREFIX}_image_stage_seconds"
+    lines = [
+        f"# HELP {name} Seconds spent in each stage per image.",
+        f"# TYPE {name} summary",
+    ]
+    for stage, summary in sorted(report["image_stages"].items()):
+        for percentile_name, percentile in PERCENTILES.items():
+            labels = f'stage="{stage}",quantile="{percentile / 100}"'
+            lines.append(f"{name}{{{labels}}} {summary[percentile_name]}")
+        lines.append(f'{name}_sum{{stage="{stage}"}} {summary["total"]}')
+        lines.append(f'{name}_count{{stage="{stage}"}} {summary["count"]}')
+    name = f"{PROMETHEUS_PREFIX}_image_stage_max_seconds"
+    lines += [
+        f"# HELP {name} Longest time an image spent in each stage.",
+        f"# TYPE {name} gauge",
+    ]
+    for stage, summary in sorted(report["image_stages"].items()):
+        lines.append(f'{name}{{stage="{stage}"}} {summary["max"]}')
+    name = f"{PROMETHEUS_PREFIX}_run_stage_seconds"
+    lines += [
+        f"# HELP {name} Seconds spent in each stage applied to the whole folder.",
+        f"# TYPE {name} gauge",
+    ]
+    for stage, seconds in sorted(report["run_stages"].items()):
+        lines.append(f'{name}{{stage="{stage}"}} {seconds}')
+    name = f"{PROMETHEUS_PREFIX}_images_measured"
+    lines += [
+        f"# HELP {name} Number of images in the latest run.",
+        f"# TYPE {name} gauge",
+        f"{name} {report['n_images']}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def write_atomically(text: str, filepath: str):
+    # Readers, such as the node exporter's textfile collector, never see a
+    # partially written file
+    temporary_filepath = f"{filepath}.tmp"
+    with open(temporary_filepath, "w") as file:
+        file.write(text)
+    os.replace(temporary_filepath, filepath)
@@ -1,8 +1,10 @@
+import itertools
 import os
-from typing import Dict, List, Union
+from typing import Dict, Iterable, Iterator, List, Tuple
 
-import shapely.geometry as shapes
-from shapely import affinity
+import numpy as np
+import shapely
+import torch
 
 from inference.constants import IOU_THRESHOLD, NAMES_TO_CATEGORY_ID
 from interface.upload_single import convert_to_SIU_length, convert_to_SIU_area
@@ -14,13 +16,22 @@ def get_list_of_images_in_folder(folder_path):
     image_files = [
         filename for filename in filenames if is_supported_image_file(filename)
     ]
-    return image_files
+    # Sorted so stoma ids, assigned in file order, do not depend on the filesystem
+    return sorted(image_files)
 
 
 def is_supported_image_file(filename):
     return filename.split(".")[-1] in OPENCV_FILE_SUPPORT
 
 
+def split_into_batches(items: Iterable, batch_size: int) -> Iterator[List]:
+    items = iter(items)
+    batch = list(itertools.islice(items, batch_size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(items, batch_size))
+
+
 def is_stomatal_pore(i, predictions) -> bool:
     class_label = get_class(i, predictions)
     return class_label == NAMES_TO_CATEGORY_ID["Stomatal Pore"]
@@ -39,6 +50,16 @@ def get_class(i, predictions) -> int:
     return predictions.pred_classes[i].item()
 
 
+def get_class_masks(predictions) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    classes = predictions.pred_classes
+    is_complex = (classes == NAMES_TO_CATEGORY_ID["Closed Stomata"]) | (
+        classes == NAMES_TO_CATEGORY_ID["Open Stomata"]
+    )
+    is_pore = classes == NAMES_TO_CATEGORY_ID["Stomatal Pore"]
+    is_subsidiary_cell = classes == NAMES_TO_CATEGORY_ID["Subsidiary cells"]
+    return is_complex, is_pore, is_subsidiary_cell
+
+
 def get_bounding_box(i, predictions) -> List[float]:
     return predictions.pred_boxes[i].tensor.tolist()[0]
 
@@ -99,140 +120,146 @@ def is_bbox_a_mostly_in_bbox_b(
     return intersecting_area / bbox_a_area > threshold
 
 
+# Pairwise versions of the above, comparing every box in a against every box in b
+def pairwise_intersects(boxes_a: torch.Tensor, boxes_b: torch.Tensor) -> torch.Tensor:
+    a, b = boxes_a[:, None, :], boxes_b[None, :, :]
+    is_overlap = ~(
+        (b[..., 0] > a[..., 2])
+        | (b[..., 2] < a[..., 0])
+        | (b[..., 1] > a[..., 3])
+        | (b[..., 3] < a[..., 1])
+    )
+    return is_overlap
+
+
+def pairwise_is_overlapping(
+    boxes_a: torch.Tensor,
+    boxes_b: torch.Tensor,
+) -> torch.Tensor:
+    is_overlap = pairwise_intersection_over_union(boxes_a, boxes_b) > IOU_THRESHOLD
+    return pairwise_intersects(boxes_a, boxes_b) & is_overlap
+
+
+def pairwise_intersection_over_union(
+    boxes_a: torch.Tensor,
+    boxes_b: torch.Tensor,
+) -> torch.Tensor:
+    intersecting_area = pairwise_area_of_intersection(boxes_a, boxes_b)
+    areas_a = calculate_area_of_bboxes(boxes_a)[:, None]
+    areas_b = calculate_area_of_bboxes(boxes_b)[None, :]
+    return intersecting_area / (areas_a + areas_b - intersecting_area)
+
+
+def pairwise_area_of_intersection(
+    boxes_a: torch.Tensor,
+    boxes_b: torch.Tensor,
+) -> torch.Tensor:
+    a, b = boxes_a[:, None, :], boxes_b[None, :, :]
+    x_max = torch.maximum(a[..., 0], b[..., 0])
+    y_max = torch.maximum(a[..., 1], b[..., 1])
+    x_min = torch.minimum(a[..., 2], b[..., 2])
+    y_min = torch.minimum(a[..., 3], b[..., 3])
+    width = (x_min - x_max + 1).clamp(min=0)
+    height = (y_min - y_max + 1).clamp(min=0)
+    return width * height
+
+
+# Versions comparing boxes pair by pair, each box in a with the box in b of the
+# same row, for candidate pairs found with find_touching_pairs
+def rowwise_is_overlapping(
+    boxes_a: torch.Tensor,
+    boxes_b: torch.Tensor,
+) -> torch.Tensor:
+    is_overlap = rowwise_intersection_over_union(boxes_a, boxes_b) > IOU_THRESHOLD
+    return rowwise_intersects(boxes_a, boxes_b) & is_overlap
+
+
+def rowwise_intersects(boxes_a: torch.Tensor, boxes_b: torch.Tensor) -> torch.Tensor:
+    a, b = boxes_a, boxes_b
+    return ~(
+        (b[:, 0] > a[:, 2])
+        | (b[:, 2] < a[:, 0])
+        | (b[:, 1] > a[:, 3])
+        | (b[:, 3] < a[:, 1])
+    )
+
+
+def rowwise_intersection_over_union(
+    boxes_a: torch.Tensor,
+    boxes_b: torch.Tensor,
+) -> torch.Tensor:
+    a, b = boxes_a, boxes_b
+    x_max = torch.maximum(a[:, 0], b[:, 0])
+    y_max = torch.maximum(a[:, 1], b[:, 1])
+    x_min = torch.minimum(a[:, 2], b[:, 2])
+    y_min = torch.minimum(a[:, 3], b[:, 3])
+    width = (x_min - x_max + 1).clamp(min=0)
+    height = (y_min - y_max + 1).clamp(min=0)
+    intersecting_area = width * height
+    areas_a = calculate_area_of_bboxes(boxes_a)
+    areas_b = calculate_area_of_bboxes(boxes_b)
+    return intersecting_area / (areas_a + areas_b - intersecting_area)
+
+
+def find_touching_pairs(boxes: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # Indices of every ordered pair of different boxes that touch or overlap,
+    # from a spatial index, so memory grows with the number of such pairs
+    # rather than with the square of the number of boxes
+    coordinates = boxes.cpu().double().numpy()
+    tree = shapely.STRtree(shapely.box(*coordinates.T))
+    indices_a, indices_b = tree.query(shapely.box(*coordinates.T))
+    is_pair = indices_a != indices_b
+    return (
+        torch.from_numpy(indices_a[is_pair]).long(),
+        torch.from_numpy(indices_b[is_pair]).long(),
+    )
+
+
+def calculate_area_of_bboxes(boxes: torch.Tensor) -> torch.Tensor:
+    return (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+
+
+def pairwise_is_bbox_a_in_bbox_b(
+    boxes_a: torch.Tensor,
+    boxes_b: torch.Tensor,
+) -> torch.Tensor:
+    a, b = boxes_a[:, None, :], boxes_b[None, :, :]
+    return (
+        (a[..., 0] >= b[..., 0])
+        & (a[..., 1] >= b[..., 1])
+        & (a[..., 2] <= b[..., 2])
+        & (a[..., 3] <= b[..., 3])
+    )
+
+
+def pairwise_is_bbox_a_mostly_in_bbox_b(
+    boxes_a: torch.Tensor,
+    boxes_b: torch.Tensor,
+    threshold: float,
+) -> torch.Tensor:
+    intersecting_area = pairwise_area_of_intersection(boxes_a, boxes_b)
+    areas_a = calculate_area_of_bboxes(boxes_a)[:, None]
+    return intersecting_area / areas_a > threshold
+
+
 def l2_dist(keypoints):
     A, B = [keypoints[0], keypoints[1]], [keypoints[3], keypoints[4]]
     return pow((A[0] - B[0]) ** 2 + (A[1] - B[1]) ** 2, 0.5)
 
 
-def extract_AB_from_polygon(
-    x_values: List[float],
-    y_values: List[float],
-) -> List[float]:
-    x_min, x_max = min(x_values), max(x_values)
-    y_min, y_max = min(y_values), max(y_values)
-    x_extent = x_max - x_min
-    y_extent = y_max - y_min
-    # Enables pores of arbitrary orientation
-    if x_extent > y_extent:
-        major_axis_values = x_values
-        minor_axis_values = y_values
-        maximum_major_value = x_max
-        minimum_major_value = x_min
-    else:
-        major_axis_values = y_values
-        minor_axis_values = x_values
-        maximum_major_value = y_max
-        minimum_major_value = y_min
-    # Left/Right along major axis
-    left_hand_values, right_hand_values = [], []
-    for i, minor_value in enumerate(minor_axis_values):
-        if maximum_major_value == major_axis_values[i]:
-            right_hand_values.append(minor_value)
-        if minimum_major_value == major_axis_values[i]:
-            left_hand_values.append(minor_value)
-    # Use midpoint of extreme values as keypoint value
-    right_hand_value = (right_hand_values[0] + right_hand_values[-1]) / 2
-    left_hand_value = (left_hand_values[0] + left_hand_values[-1]) / 2
-
-    if x_extent > y_extent:
-        keypoints = [
-            minimum_major_value,
-            left_hand_value,
-            1,
-            maximum_major_value,
-            right_hand_value,
-            1,
-        ]
-    else:
-        keypoints = [
-            left_hand_value,
-            minimum_major_value,
-            1,
-            right_hand_value,
-            maximum_major_value,
-            1,
-        ]
-    return keypoints
-
-
 def calculate_midpoint_of_keypoints(points: List[float]) -> List[float]:
     x = (points[0] + points[3]) / 2
     y = (points[1] + points[4]) / 2
     return [x, y]
 
 
-def find_CD(
-    polygon: List[float],
-    keypoints: Union[List[float], None] = None,
-) -> List[float]:
-    return find_keypoints(polygon, keypoints, flip_line=True)
-
-
-def find_AB(
-    polygon: List[float],
-    keypoints: Union[List[float], None] = None,
-) -> List[float]:
-    return find_keypoints(polygon, keypoints, flip_line=False)
-
-
-def find_keypoints(
-    polygon: List[float],
-    keypoints: Union[List[float], None],
-    flip_line: bool,
-) -> List[float]:
-    # If no mask is predicted
-    if len(polygon) < 1:
-        #    counter += 1
-        return [-1, -1, 1, -1, -1, 1]
-
-    x_points = [x for x in polygon[0::2]]
-    y_points = [y for y in polygon[1::2]]
-
-    if keypoints is None:
-        keypoints = extract_AB_from_polygon(x_points, y_points)
-    # Convert to shapely linear ring
-    polygon = [[x, y] for x, y in zip(x_points, y_points)]
-    mask = shapes.LinearRing(polygon)
-    # Find line perpendicular to AB
-    A = shapes.Point(keypoints[0], keypoints[1])
-    B = shapes.Point(keypoints[3], keypoints[4])
-
-    l_AB = shapes.LineString([A, B])
-    if flip_line:
-        l_perp = affinity.rotate(l_AB, 90)
-    else:
-        l_perp = l_AB
-    l_perp = affinity.scale(l_perp, 10, 10)
-    # Find intersection with polygon
-    try:
-        intersections = l_perp.intersection(mask)
-    except Exception:
-        intersections = shapes.collection.GeometryCollection()
-    # If there is no intersection or only one point of intersection
-    if intersections.is_empty or type(intersections) is shapes.Point:
-        return [-1, -1, 1, -1, -1, 1]
-    # If there are multiple intersections, pick the largest
-    if len(intersections.geoms) > 2:
-        intersections = select_longest_line(intersections)
-
-    if intersections.geoms[0].coords.xy[1] > intersections.geoms[1].coords.xy[1]:
-        D = intersections.geoms[0].coords.xy
-        C = intersections.geoms[1].coords.xy
-    else:
-        D = intersections.geoms[1].coords.xy
-        C = intersections.geoms[0].coords.xy
-    return [C[0][0], C[1][0], 1, D[0][0], D[1][0], 1]
-
-
-def select_longest_line(multipoint):
-    lines, lengths = [], []
-    for i, point_1 in enumerate(multipoint.geoms):
-        for point_2 in multipoint.geoms[i + 1 :].geoms:
-            lines.append(shapes.LineString([point_1, point_2]))
-            lengths.append(lines[-1].length)
-    longest_line_idx = max(range(len(lengths)), key=lambda i: lengths[i])
-    longest_line = lines[longest_line_idx]
-    return shapes.MultiPoint(list(longest_line.coords))
+def build_polygons(polygons: List[List[float]]) -> np.ndarray:
+    # Shapely polygons of flat [x1, y1, x2, y2, ...] lists, built in one call
+    ring_lengths = [len(polygon) // 2 for polygon in polygons]
+    coordinates = np.fromiter(itertools.chain.from_iterable(polygons), dtype=np.float64)
+    ring_indices = np.repeat(np.arange(len(polygons)), ring_lengths)
+    rings = shapely.linearrings(coordinates.reshape(-1, 2), indices=ring_indices)
+    return shapely.polygons(rings)
 
 
 def calulate_width_over_length(length, width):
@@ -9,7 +9,7 @@ from app.example_images import (
     draw_measurements,
     setup_plot,
 )
-from app import utils
+from inference.result_store import get_result_store
 from inference.utils import get_list_of_images_in_folder
 from tools import draw
 from tools.load import maybe_create_visualisation_folder
@@ -59,9 +59,7 @@ def draw_and_save_visualisation(image_name):
     # Create matplot lib axis
     fig, ax = setup_plot(image)
     # Load images measurements
-    predictions_filename = image_name.split(".")[0] + ".json"
-    prediction_path = os.path.join("./output/temp/", predictions_filename)
-    record = utils.load_json(prediction_path)
+    record = get_result_store().load_record(image_name.split(".")[0])
     # Draw onto axis
     draw_measurements(ax, record["detections"])
     draw_bounding_boxes(ax, record["detections"])
@@ -0,0 +1,89 @@
+import multiprocessing
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+import torch
+
+from inference.infer import maybe_setup_inference_engine, run_on_batch
+from inference.timing import collect_stage_times, split_stage_times, time_stage
+from inference.utils import split_into_batches
+from tools.load import load_image_from_folder
+from tools.state import Option_State
+
+# Settings copied into each worker process' Option_State
+WORKER_SETTINGS = [
+    "plant_type",
+    "folder_path",
+    "batch_size",
+    "tile_size",
+    "tile_overlap",
+    "inference_resolution",
+    "calibrated_resolution",
+    "camera_calibration",
+    "compact_masks",
+    "quantize_model",
+    "inference_backend",
+    "measurement_mode",
+    "density_only",
+    "stage_timing",
+]
+
+
+def measure_decoded_batches(
+    batches: Iterator[List[Tuple[str, np.ndarray]]],
+) -> Iterator[Dict]:
+    for batch in batches:
+        yield from measure_decoded_batch(batch)
+
+
+def measure_decoded_batch(batch: List[Tuple[str, np.ndarray]]) -> List[Dict]:
+    filenames, images = zip(*batch)
+    batch_predictions, time_elapsed = run_on_batch(images)
+    stage_times = split_stage_times(collect_stage_times(), len(images))
+    results = []
+    for filename, image, predictions in zip(filenames, images, batch_predictions):
+        result = {
+            "filename": filename,
+            "detections": predictions.detections,
+            "invalid_detections": predictions.invalid_detections,
+            "image_size": image.shape[:-1],
+            "n_predictions": predictions.n_predictions,
+            "pore_lengths": predictions.pore_lengths,
+            "bounding_box_dimensions": predictions.bounding_box_dimensions,
+            "time_elapsed": time_elapsed / len(images),
+            "stage_times": dict(stage_times),
+        }
+        results.append(result)
+    return results
+
+
+def measure_in_pool(image_files: List[str], n_workers: int) -> Iterator[Dict]:
+    # Workers take batches as they become free, results are yielded in the
+    # order of image_files so stoma ids do not depend on the number of workers
+    n_threads = max(1, torch.get_num_threads() // n_workers)
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(
+        n_workers,
+        initializer=setup_worker,
+        initargs=(get_worker_settings(), n_threads),
+    ) as pool:
+        batches = split_into_batches(image_files, Option_State["batch_size"])
+        for results in pool.imap(measure_batch, batches):
+            yield from results
+
+
+def get_worker_settings() -> Dict:
+    return {key: Option_State[key] for key in WORKER_SETTINGS}
+
+
+def setup_worker(settings: Dict, n_threads: int):
+    Option_State.update(settings)
+    torch.set_num_threads(n_threads)
+    maybe_setup_inference_engine()
+
+
+def measure_batch(filenames: List[str]) -> List[Dict]:
+    directory = Option_State["folder_path"]
+    with time_stage("decode"):
+        images = [load_image_from_folder(directory, filename) for filename in filenames]
+    return measure_decoded_batch(list(zip(filenames, images)))
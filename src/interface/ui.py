@@ -2,6 +2,7 @@ import base64
 
 import streamlit as st
 
+from inference.preload import get_preload_status
 from tools.state import Option_State
 from .landing import display_instructions
 from .upload_single import display_upload_image
@@ -20,6 +21,8 @@ ENABLED_MODES = [
     "Upload Multiple Images",
 ]
 
+MEASUREMENT_MODES = ["Upload An Image", "Upload Multiple Images"]
+
 MODE_METHODS = {
     "Instructions": display_instructions,
     "Upload An Image": display_upload_image,
@@ -82,9 +85,19 @@ def draw_title():
 def setup_sidebar():
     mode_selection()
     MODE_METHODS[Option_State["mode"]]()
+    maybe_show_model_status()
 
 
 def mode_selection():
     Option_State["mode"] = st.sidebar.selectbox(
         "Select Application Mode:", ENABLED_MODES
     )
+
+
+def maybe_show_model_status():
+    if Option_State["mode"] not in MEASUREMENT_MODES:
+        return
+    species = Option_State["plant_type"]
+    status = get_preload_status(species)
+    if status is not None:
+        st.sidebar.caption(f"{species} model: {status}")
@@ -1,4 +1,5 @@
 import os
+import multiprocessing
 
 import streamlit as st
 
@@ -21,6 +22,13 @@ def display_upload_zip():
         else:
             image_folder_text_box()
             setup_upload_sidebar()
+            batch_size_selection()
+            worker_count_selection()
+            prefetch_depth_selection()
+            compact_masks_checkbox()
+            density_only_checkbox()
+            result_cache_checkbox()
+            stage_timing_checkbox()
 
 
 def image_folder_text_box():
@@ -43,6 +51,71 @@ def image_folder_text_box():
         st.warning("There are no images in the currently selected folder")
 
 
+def batch_size_selection():
+    Option_State["batch_size"] = st.sidebar.number_input(
+        "Images Measured Together:",
+        min_value=1,
+        value=1,
+        step=1,
+        help="Larger batches make better use of the CPU but need more memory",
+    )
+
+
+def worker_count_selection():
+    Option_State["n_workers"] = st.sidebar.number_input(
+        "Worker Processes:",
+        min_value=1,
+        max_value=multiprocessing.cpu_count(),
+        value=1,
+        step=1,
+        help="Each worker loads its own model and measures a share of the images",
+    )
+
+
+def prefetch_depth_selection():
+    Option_State["prefetch_depth"] = st.sidebar.number_input(
+        "Images Decoded Ahead:",
+        min_value=0,
+        value=2,
+        step=1,
+        help="Images are loaded in the background while others are measured",
+    )
+
+
+def compact_masks_checkbox():
+    Option_State["compact_masks"] = st.sidebar.checkbox(
+        "Compact Masks",
+        value=False,
+        help="Keep masks at low resolution until measured, reducing memory use",
+    )
+
+
+def density_only_checkbox():
+    Option_State["density_only"] = st.sidebar.checkbox(
+        "Count and Density Only",
+        value=False,
+        help="Skip masks and keypoints to count stomata faster, only the density"
+        " CSV is written",
+    )
+
+
+def result_cache_checkbox():
+    Option_State["use_result_cache"] = st.sidebar.checkbox(
+        "Reuse Previous Measurements",
+        value=True,
+        help="Only measure images that have not been measured by this model before",
+    )
+
+
+def stage_timing_checkbox():
+    Option_State["stage_timing"] = st.sidebar.checkbox(
+        "Time Processing Stages",
+        value=False,
+        help="Save how long each stage of measuring the folder took to"
+        f" {Option_State['timing_report_path']}",
+    )
+
+
 def set_mode_to_folder_selection():
     Option_State["select_folder"] = True
 
@@ -1,4 +1,5 @@
 import streamlit as st
+import torch
 
 from interface.example_images import (
     plant_type_selection,
@@ -8,7 +9,10 @@ from interface.example_images import (
 from tools.load import decode_downloaded_image
 from tools.state import Option_State
 from tools.constants import (
+    DEFAULT_TILE_OVERLAP,
+    INFERENCE_BACKENDS,
     IS_ONLINE,
+    MEASUREMENT_MODES,
     OPENCV_FILE_SUPPORT,
 )
 
@@ -19,6 +23,8 @@ def display_upload_image():
     else:
         single_image_uploader()
         setup_upload_sidebar()
+        # Single images are always measured, whatever was chosen for folders
+        Option_State["density_only"] = False
 
 
 def print_unavilable_message():
@@ -48,6 +54,11 @@ def setup_upload_sidebar():
     confidence_sliderbar()
     camera_calibration_textbox()
     immature_stomata_threshold()
+    tile_size_selection()
+    inference_resolution_selection()
+    quantize_model_checkbox()
+    inference_backend_selection()
+    measurement_mode_selection()
 
 
 def camera_calibration_textbox():
@@ -68,6 +79,53 @@ def camera_calibration_textbox():
         Option_State["image_area"] = width * height
 
 
+def tile_size_selection():
+    Option_State["tile_size"] = st.sidebar.number_input(
+        "Tile Size (px):",
+        min_value=0,
+        value=0,
+        step=128,
+        help="Measure large images in overlapping tiles of this size, 0 to disable",
+    )
+    if Option_State["tile_size"] > 0:
+        tile_overlap_selection(Option_State["tile_size"])
+
+
+def tile_overlap_selection(tile_size: int):
+    # Tiles step by at least half their size, so small tiles stay few
+    max_overlap = tile_size // 2
+    Option_State["tile_overlap"] = st.sidebar.number_input(
+        "Tile Overlap (px):",
+        min_value=0,
+        max_value=max_overlap,
+        value=min(DEFAULT_TILE_OVERLAP, max_overlap),
+        step=32,
+        help="Overlap between tiles, should exceed the size of a stoma",
+    )
+
+
+def inference_resolution_selection():
+    Option_State["calibrated_resolution"] = st.sidebar.checkbox(
+        "Resolution From Calibration",
+        value=False,
+        help="Downscale images sampled more finely than the example images,"
+        " using the camera calibration",
+    )
+    if not Option_State["calibrated_resolution"]:
+        # Keyed by species, so each keeps its own resolution when switching
+        plant_type = Option_State["plant_type"]
+        resolution = st.sidebar.number_input(
+            "Inference Resolution (px):",
+            min_value=0,
+            value=Option_State["inference_resolution"].get(plant_type, 0),
+            step=64,
+            help="Shortest edge images are resized to before the model,"
+            " 0 uses the model's default",
+            key=f"inference_resolution_{plant_type}",
+        )
+        Option_State["inference_resolution"][plant_type] = resolution
+
+
 def convert_to_SIU_length(pixel_length):
     if Option_State["camera_calibration"] > 0:
         length = pixel_length / Option_State["camera_calibration"]
@@ -82,3 +140,33 @@ def convert_to_SIU_area(pixel_area):
     else:
         area = pixel_area
     return area
+
+
+def quantize_model_checkbox():
+    is_quantized = st.sidebar.checkbox(
+        "Quantized Model (CPU)",
+        value=False,
+        help="Faster measurement on the CPU using int8 weights, see the README",
+    )
+    # The model runs on the GPU whenever one is available
+    if is_quantized and torch.cuda.is_available():
+        st.sidebar.warning("Quantized inference is only available on the CPU")
+        is_quantized = False
+    Option_State["quantize_model"] = is_quantized
+
+
+def inference_backend_selection():
+    Option_State["inference_backend"] = st.sidebar.selectbox(
+        "Inference Backend:",
+        INFERENCE_BACKENDS,
+        help="ONNX Runtime exports the model on first use, see the README",
+    )
+
+
+def measurement_mode_selection():
+    Option_State["measurement_mode"] = st.sidebar.selectbox(
+        "Measurement Mode:",
+        MEASUREMENT_MODES,
+        help="Fast measures from the ellipses matching each mask's moments,"
+        " suited to population averages, see the README",
+    )
@@ -7,6 +7,7 @@ from app.example_images import maybe_draw_example
 from app.example_output import maybe_show_slide_output_example
 from app.inference import maybe_do_inference
 from app.summary_statistics import maybe_display_summary_statistics
+from inference.preload import maybe_start_preloading
 
 Is_Setup = False
 
@@ -33,6 +34,7 @@ if __name__ == "__main__":
             from inference.modeling.stoma_head import KRCNNConvHead, KPROIHeads
         except Exception as e:
             print(e)
+        maybe_start_preloading()
         Is_Setup = True
 
     main()
@@ -0,0 +1,351 @@
+import argparse
+import copy
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import torch
+from detectron2.structures import Boxes, Instances
+
+from app.inference import offset_stoma_ids, record_result
+from inference import population_filtering
+from inference.columnar import ColumnarResults, write_output_csv
+from inference.initial_filter import filter_invalid_predictions
+from inference.keypoints import extract_AB_from_polygon, find_CD_batch
+from inference.output import create_output_csvs
+from inference.predictions import ModelOutput
+from tools.ground_truth import process_ground_truth
+from tools.load import clean_temporary_folder
+from tools.state import Option_State
+from tools.synthetic import SyntheticImage, get_ellipse_points
+
+BENCHMARK_DENSITIES = [10, 100, 500]
+BENCHMARK_IMAGE_SIZES = [(768, 1024), (1536, 2048)]
+# Image size masks take as much memory as the whole model output, so larger
+# fixtures are only measured with compact masks
+MAX_FULL_MASK_BYTES = 1 << 30
+N_FOLDER_IMAGES = 10
+REGRESSION_THRESHOLD = 0.2
+
+# Each benchmark's setup builds the inputs of one run, and returns the run
+Setup = Callable[[], Callable[[], object]]
+
+
+def main():
+    args = parse_arguments()
+    Option_State["camera_calibration"] = 0.0
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        benchmarks = iterate_benchmarks(args.densities, args.filter, directory)
+        for name, setup in benchmarks:
+            results[name] = time_benchmark(setup, args.repeats)
+            print(f"{name}: {results[name]['median'] * 1000:.1f} ms")
+    report = {"environment": get_environment(args.repeats), "results": results}
+    save_report(report, args.output)
+    print(f"Results saved to {args.output}")
+    if args.baseline is not None:
+        regressions = compare_with_baseline(results, args.baseline, args.threshold)
+        sys.exit(1 if len(regressions) > 0 else 0)
+
+
+def iterate_benchmarks(
+    densities: List[int],
+    name_filter: str,
+    directory: str,
+) -> Iterator[Tuple[str, Setup]]:
+    # Fixtures are only built for the benchmarks selected by name_filter
+    def select(*names: str) -> List[str]:
+        return [name for name in names if name_filter in name]
+
+    for density in densities:
+        for image_size in BENCHMARK_IMAGE_SIZES:
+            image = SyntheticImage(density, image_size, seed=0)
+            suffix = f"{density}/{image_size[1]}x{image_size[0]}"
+            names = select(
+                f"model_output_compact_masks/{suffix}",
+                f"fast_measurement_compact_masks/{suffix}",
+            )
+            instances = image.to_instances(True) if len(names) > 0 else None
+            for name in names:
+                mode = "Fast" if name.startswith("fast") else "Keypoints"
+                yield name, model_output(instances, mode)
+            if density * image_size[0] * image_size[1] > MAX_FULL_MASK_BYTES:
+                continue
+            names = select(
+                f"model_output/{suffix}", f"filter_invalid_predictions/{suffix}"
+            )
+            instances = image.to_instances() if len(names) > 0 else None
+            for name in names:
+                if name.startswith("model_output"):
+                    yield name, model_output(instances)
+                else:
+                    yield name, filter_predictions(instances)
+        image = SyntheticImage(density, BENCHMARK_IMAGE_SIZES[0], seed=0)
+        for name in select(f"find_keypoints/{density}"):
+            yield name, find_pore_keypoints(image)
+        for name in select(f"process_ground_truth/{density}"):
+            yield name, ground_truth(image)
+        names = select(
+            f"remove_outliers_from_records/{density}",
+            f"create_output_csvs/{density}",
+            f"columnar_output_tables/{density}",
+        )
+        if len(names) > 0:
+            records = measure_folder(density, image.image_size, N_FOLDER_IMAGES)
+        for name in names:
+            output_path = os.path.join(directory, name.replace("/", "_"))
+            os.makedirs(output_path)
+            if name.startswith("remove_outliers"):
+                yield name, remove_outliers(records, output_path)
+            elif name.startswith("create_output_csvs"):
+                yield name, output_csvs(records, output_path)
+            else:
+                yield name, columnar_output_tables(records, output_path)
+
+
+def model_output(instances: Instances, mode: str = "Keypoints") -> Setup:
+    def setup():
+        Option_State["measurement_mode"] = mode
+        return lambda: ModelOutput(copy_instances(instances), 0)
+
+    return setup
+
+
+def filter_predictions(instances: Instances) -> Setup:
+    return lambda: lambda: filter_invalid_predictions(copy_instances(instances))
+
+
+def copy_instances(instances: Instances) -> Instances:
+    # Filtering replaces fields rather than modifying tensors, so sharing is safe
+    copied = Instances(instances.image_size, **instances.get_fields())
+    copied.pred_boxes = Boxes(instances.pred_boxes.tensor)
+    return copied
+
+
+def find_pore_keypoints(image: SyntheticImage) -> Setup:
+    pores = [
+        (get_pore_polygon(structure), structure["keypoints"])
+        for structure in image.structures
+        if structure["hole_axes"] is not None
+    ]
+
+    polygons = [polygon for polygon, _ in pores]
+    keypoints = [keypoints_AB for _, keypoints_AB in pores]
+
+    def run():
+        for polygon in polygons:
+            extract_AB_from_polygon(polygon[0::2], polygon[1::2])
+        find_CD_batch(polygons, keypoints)
+
+    return lambda: run
+
+
+def get_pore_polygon(structure: Dict) -> List[float]:
+    center, axes, angle = (
+        structure["center"],
+        structure["hole_axes"],
+        structure["angle"],
+    )
+    return get_ellipse_points(center, axes, angle).flatten().tolist()
+
+
+def ground_truth(image: SyntheticImage) -> Setup:
+    raw_ground_truth = image.to_ground_truth()
+
+    def setup():
+        annotations = copy.deepcopy(raw_ground_truth)
+        return lambda: process_ground_truth(annotations)
+
+    return setup
+
+
+def measure_folder(
+    density: int,
+    image_size: Tuple[int, int],
+    n_images: int,
+) -> List[Dict]:
+    records, n_stoma = [], 0
+    for seed in range(n_images):
+        predictions = SyntheticImage(density, image_size, seed).to_instances(True)
+        output = ModelOutput(predictions, 0)
+        record = {
+            "filename": f"image_{seed}.png",
+            "detections": output.detections,
+            "invalid_detections": output.invalid_detections,
+            "image_size": image_size,
+            "pore_lengths": output.pore_lengths,
+            "bounding_box_dimensions": output.bounding_box_dimensions,
+        }
+        offset_stoma_ids(record, n_stoma)
+        n_stoma += output.n_predictions
+        records.append(record)
+    return records
+
+
+def remove_outliers(records: List[Dict], output_path: str) -> Setup:
+    def setup():
+        Option_State["output_path"] = output_path
+        clean_temporary_folder()
+        population_filtering.Population_Statistics.clear()
+        for record in records:
+            record_result(copy.deepcopy(record))
+        return population_filtering.remove_outliers_from_records
+
+    return setup
+
+
+def output_csvs(records: List[Dict], output_path: str) -> Setup:
+    predictions = name_predictions(records)
+
+    def setup():
+        Option_State["output_path"] = output_path
+        Option_State["folder_path"] = output_path
+        return lambda: create_output_csvs(predictions)
+
+    return setup
+
+
+def columnar_output_tables(records: List[Dict], output_path: str) -> Setup:
+    # The tables the app rewrites when a filter setting changes, with the
+    # lines of the current calibration already formatted
+    results = ColumnarResults(name_predictions(records))
+
+    def setup():
+        Option_State["output_path"] = output_path
+        Option_State["folder_path"] = output_path
+        return lambda: (
+            write_output_csv(results.format_densities(), "density"),
+            write_output_csv(results.format_measurements(), "pore_measurements"),
+        )
+
+    return setup
+
+
+def name_predictions(records: List[Dict]) -> List[Dict]:
+    return [
+        {**record, "image_name": os.path.splitext(record["filename"])[0]}
+        for record in records
+    ]
+
+
+def time_benchmark(setup: Setup, n_repeats: int) -> Dict:
+    times = []
+    for _ in range(n_repeats):
+        run = setup()
+        start_time = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start_time)
+    return {
+        "median": statistics.median(times),
+        "min": min(times),
+        "max": max(times),
+        "repeats": n_repeats,
+    }
+
+
+def get_environment(n_repeats: int) -> Dict:
+    return {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "threads": torch.get_num_threads(),
+        "repeats": n_repeats,
+    }
+
+
+def save_report(report: Dict, filepath: str):
+    directory = os.path.dirname(filepath)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+    with open(filepath, "w") as file:
+        json.dump(report, file, indent=2)
+
+
+def compare_with_baseline(
+    results: Dict,
+    baseline_filepath: str,
+    threshold: float,
+) -> List[str]:
+    with open(baseline_filepath, "r") as file:
+        baseline = json.load(file)["results"]
+    regressions = []
+    print(f"\nCompared with {baseline_filepath}:")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"  {name}: not in baseline")
+            continue
+        ratio = result["median"] / baseline[name]["median"]
+        status = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            status = "  REGRESSION"
+        print(f"  {name}: {ratio:.2f}x baseline time{status}")
+    print(
+        f"{len(regressions)} of {len(results)} benchmarks regressed by more than {threshold:.0%}"
+    )
+    return regressions
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m tools.benchmark",
+        description="Time post-processing on synthetic detections, without model"
+        " weights or network access, optionally flagging regressions against an"
+        " earlier run.",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="JSON file to save results to"
+        " (default: ./output/benchmarks/benchmark_<timestamp>.json)",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="Results of an earlier run, exits with an error if any benchmark"
+        " is slower by more than --threshold",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=REGRESSION_THRESHOLD,
+        help="Largest acceptable relative slowdown compared with the baseline",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=5,
+        help="Number of timed runs of each benchmark, the median is reported",
+    )
+    parser.add_argument(
+        "--densities",
+        nargs="+",
+        type=int,
+        default=BENCHMARK_DENSITIES,
+        help="Numbers of detections per synthetic image",
+    )
+    parser.add_argument(
+        "--filter",
+        default="",
+        help="Only run benchmarks whose name contains this text",
+    )
+    args = parser.parse_args()
+    if args.repeats < 1:
+        parser.error("--repeats must be at least 1")
+    if args.output is None:
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        args.output = os.path.join(
+            ".", "output", "benchmarks", f"benchmark_{timestamp}.json"
+        )
+    return args
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import sys
+import time
+from typing import List, Tuple, Union
+
+import cv2
+import numpy as np
+
+from inference.keypoints import find_keypoints, find_keypoints_batch
+from inference.masks import get_generic_mask
+from tools.synthetic import SyntheticImage, get_bounding_box, get_ellipse_points
+
+# Largest acceptable difference between the coordinates of matching keypoints
+KEYPOINT_TOLERANCE = 1e-9
+
+
+def main():
+    args = parse_arguments()
+    polygons, keypoints = build_polygons(args.density, args.images)
+    n_mismatches = 0
+    for flip_line, name in [(True, "CD"), (False, "AB")]:
+        start_time = time.perf_counter()
+        batched = find_keypoints_batch(polygons, keypoints, flip_line)
+        batch_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        reference = [
+            find_keypoints(polygon, polygon_keypoints, flip_line)
+            for polygon, polygon_keypoints in zip(polygons, keypoints)
+        ]
+        reference_time = time.perf_counter() - start_time
+        mismatches = find_mismatches(batched, reference)
+        print(
+            f"{name}: {len(mismatches)} of {len(polygons)} polygons differ,"
+            f" {reference_time * 1000:.1f} ms with shapely,"
+            f" {batch_time * 1000:.1f} ms batched"
+        )
+        for i in mismatches[: args.show]:
+            print(f"  polygon {i}: {batched[i]} instead of {reference[i]}")
+        n_mismatches += len(mismatches)
+    sys.exit(1 if n_mismatches > 0 else 0)
+
+
+def build_polygons(
+    density: int,
+    n_images: int,
+) -> Tuple[List[List[float]], List[Union[List[float], None]]]:
+    # Pores as smooth ellipses and as traced from masks, which have collinear
+    # edges and vertices on the keypoint lines, each with its keypoints and
+    # without, so they are extracted from the polygon
+    polygons, keypoints = [], []
+    for seed in range(n_images):
+        image = SyntheticImage(density, (768, 1024), seed)
+        for structure in image.structures:
+            if structure["hole_axes"] is None:
+                continue
+            pore = get_ellipse_points(
+                structure["center"], structure["hole_axes"], structure["angle"]
+            )
+            for polygon in [pore.flatten().tolist(), trace_polygon(pore, image)]:
+                polygons += [polygon, polygon]
+                keypoints += [structure["keypoints"], None]
+    return polygons, keypoints
+
+
+def trace_polygon(points: np.ndarray, image: SyntheticImage) -> List[float]:
+    structure = {"polygon": points, "hole_axes": None}
+    x1, y1, x2, y2 = [int(v) for v in get_bounding_box(structure, image.image_size)]
+    patch = np.zeros((y2 - y1 + 2, x2 - x1 + 2), dtype=np.uint8)
+    polygon = np.round(points - [x1 - 1, y1 - 1]).astype(np.int32)
+    cv2.fillPoly(patch, [polygon], 1)
+    mask = get_generic_mask(patch.astype(bool), (x1 - 1, y1 - 1))
+    if len(mask.polygons) == 0:
+        return []
+    return max(mask.polygons, key=len).tolist()
+
+
+def find_mismatches(
+    batched: List[List[float]],
+    reference: List[List[float]],
+) -> List[int]:
+    return [
+        i
+        for i, (keypoints, expected) in enumerate(zip(batched, reference))
+        if not is_matching(keypoints, expected)
+    ]
+
+
+def is_matching(keypoints: List[float], expected: List[float]) -> bool:
+    difference = np.abs(np.subtract(keypoints, expected))
+    return bool((difference <= KEYPOINT_TOLERANCE).all())
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m tools.compare_keypoints",
+        description="Check the batched pore keypoints against shapely on"
+        " synthetic pores, exiting with an error if any keypoint differs.",
+    )
+    parser.add_argument(
+        "--density",
+        type=int,
+        default=500,
+        help="Number of detections per synthetic image",
+    )
+    parser.add_argument(
+        "--images",
+        type=int,
+        default=10,
+        help="Number of synthetic images",
+    )
+    parser.add_argument(
+        "--show",
+        type=int,
+        default=10,
+        help="Number of differing polygons to print for each kind of keypoint",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
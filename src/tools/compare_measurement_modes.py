@@ -0,0 +1,194 @@
+import argparse
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+from detectron2.structures import Instances
+
+from inference.infer import (
+    InferenceEngine,
+    maybe_download_config_files,
+    maybe_download_model_weights,
+    setup_model_configuration,
+)
+from inference.predictions import ModelOutput
+from inference.timing import collect_stage_times
+from tools.benchmark import copy_instances
+from tools.constants import PLANT_OPTIONS
+from tools.mode_comparison import calculate_drift, load_example_images
+from tools.state import Option_State
+from tools.synthetic import SyntheticImage
+
+MODE_MEASUREMENTS = [
+    "pore_length",
+    "pore_width",
+    "guard_cell_width",
+    "guard_cell_groove_length",
+]
+
+
+def main():
+    args = parse_arguments()
+    if args.synthetic > 0:
+        predictions = get_synthetic_predictions(args.synthetic)
+        is_acceptable = compare_modes("Synthetic", predictions, args.tolerance)
+        sys.exit(0 if is_acceptable else 1)
+    is_acceptable = True
+    for species in args.species:
+        Option_State["plant_type"] = species
+        predictions = get_example_predictions(species, args.limit)
+        is_acceptable &= compare_modes(species, predictions, args.tolerance)
+    sys.exit(0 if is_acceptable else 1)
+
+
+def compare_modes(name: str, predictions: List[Instances], tolerance: float) -> bool:
+    reference, reference_times = measure_predictions(predictions, "Keypoints")
+    fast, fast_times = measure_predictions(predictions, "Fast")
+    drift = calculate_drift(reference, fast, MODE_MEASUREMENTS)
+    differences = calculate_mean_differences(reference, fast)
+    print(f"\n{name}, {len(predictions)} images")
+    print_times("Post-processing", reference_times[0], fast_times[0])
+    print_times("Pore and guard cell geometry", reference_times[1], fast_times[1])
+    print_comparison_table(drift, differences)
+    return all([abs(difference) <= tolerance for _, _, difference in differences])
+
+
+def get_example_predictions(species: str, limit: int) -> List[Instances]:
+    maybe_download_config_files(species)
+    maybe_download_model_weights(species)
+    engine = InferenceEngine(setup_model_configuration(species.lower()))
+    images = [image for _, image in load_example_images(species, limit)]
+    return [engine.run_on_image(image) for image in images]
+
+
+def get_synthetic_predictions(n_images: int) -> List[Instances]:
+    return [
+        SyntheticImage(100, (768, 1024), seed).to_instances(compact_masks=True)
+        for seed in range(n_images)
+    ]
+
+
+def measure_predictions(
+    predictions: List[Instances],
+    mode: str,
+) -> Tuple[List[List[Dict]], Tuple[float, float]]:
+    # Both modes measure the same model output, so only post-processing
+    # differs. Returns its time along with that of the stage the modes replace
+    Option_State["measurement_mode"] = mode
+    Option_State["stage_timing"] = True
+    collect_stage_times()
+    detections, time_elapsed = [], 0.0
+    for image_predictions in predictions:
+        image_predictions = copy_instances(image_predictions)
+        start_time = time.perf_counter()
+        detections.append(ModelOutput(image_predictions, 0).detections)
+        time_elapsed += time.perf_counter() - start_time
+    geometry_time = collect_stage_times().get("geometry", 0.0)
+    return detections, (time_elapsed, geometry_time)
+
+
+def calculate_mean_differences(
+    reference: List[List[Dict]],
+    candidate: List[List[Dict]],
+) -> List[Tuple[float, float, float]]:
+    # Relative difference of each measurement's average over all stomata,
+    # the figure population studies report
+    differences = []
+    for measurement in MODE_MEASUREMENTS:
+        reference_mean = calculate_mean(reference, measurement)
+        candidate_mean = calculate_mean(candidate, measurement)
+        difference = candidate_mean / reference_mean - 1 if reference_mean > 0 else 0.0
+        differences.append((reference_mean, candidate_mean, difference))
+    return differences
+
+
+def calculate_mean(detections: List[List[Dict]], measurement: str) -> float:
+    values = [
+        detection[measurement]
+        for image_detections in detections
+        for detection in image_detections
+    ]
+    return float(np.mean(values)) if len(values) > 0 else 0.0
+
+
+def print_times(stage: str, reference_time: float, fast_time: float):
+    speedup = reference_time / fast_time if fast_time > 0 else 0.0
+    print(
+        f"{stage} {reference_time:.3f}s with keypoints,"
+        f" {fast_time:.3f}s fast ({speedup:.2f}x)"
+    )
+
+
+def print_comparison_table(drift: Dict, differences: List[Tuple[float, float, float]]):
+    # Markdown, so the table can be pasted into the README or an issue
+    print(
+        f"Stomata {drift['n_stomata']}, matched {drift['n_matched']},"
+        f" count drift {drift['count_drift']:.2%}\n"
+    )
+    columns = [
+        "Measurement",
+        "Keypoints mean (px)",
+        "Fast mean (px)",
+        "Mean difference",
+        "Per stoma drift",
+        "Max drift",
+    ]
+    print("| " + " | ".join(columns) + " |")
+    print("|" + "---|" * len(columns))
+    for measurement, (reference_mean, fast_mean, difference) in zip(
+        MODE_MEASUREMENTS, differences
+    ):
+        cells = [
+            measurement.replace("_", " "),
+            f"{reference_mean:.2f}",
+            f"{fast_mean:.2f}",
+            f"{difference:+.2%}",
+            f"{drift[f'{measurement}_drift']:.2%}",
+            f"{drift[f'{measurement}_max_drift']:.2%}",
+        ]
+        print("| " + " | ".join(cells) + " |")
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m tools.compare_measurement_modes",
+        description="Compare the fast measurement mode with keypoint measurement"
+        " on the example images, exiting with an error if an average"
+        " measurement differs by more than the tolerance.",
+    )
+    parser.add_argument(
+        "--species", nargs="+", choices=PLANT_OPTIONS, default=PLANT_OPTIONS
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=None,
+        help="Number of example images per species (default: all)",
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        default=0,
+        help="Compare on this many synthetic images instead, without model weights",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.02,
+        help="Largest acceptable relative difference in average measurements",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=torch.get_num_threads(),
+        help="Number of CPU threads used by the model",
+    )
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+    return args
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import sys
+
+import torch
+
+from inference.infer import (
+    InferenceEngine,
+    maybe_download_config_files,
+    maybe_download_model_weights,
+    setup_model_configuration,
+)
+from tools.constants import PLANT_OPTIONS
+from tools.mode_comparison import (
+    calculate_drift,
+    is_within_tolerance,
+    load_example_images,
+    measure_images,
+    print_comparison,
+)
+
+
+def main():
+    args = parse_arguments()
+    is_acceptable = True
+    for species in args.species:
+        images = [image for _, image in load_example_images(species, args.limit)]
+        maybe_download_config_files(species)
+        maybe_download_model_weights(species)
+        configuration = setup_cpu_model_configuration(species)
+        reference, reference_time = measure_images(
+            InferenceEngine(configuration), images
+        )
+        engine = InferenceEngine(configuration, quantize=True)
+        quantized, quantized_time = measure_images(engine, images)
+        drift = calculate_drift(reference, quantized)
+        print_comparison(species, reference_time, quantized_time, drift, args.tolerance)
+        is_acceptable = is_acceptable and is_within_tolerance(drift, args.tolerance)
+    sys.exit(0 if is_acceptable else 1)
+
+
+def setup_cpu_model_configuration(species: str):
+    # Quantized models only run on the CPU, so both modes are compared there
+    configuration = setup_model_configuration(species.lower()).clone()
+    configuration.defrost()
+    configuration.MODEL.DEVICE = "cpu"
+    configuration.freeze()
+    return configuration
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m tools.compare_quantization",
+        description="Compare fp32 and int8 quantized measurements of the"
+        " example images, exiting with an error if drift exceeds the tolerance.",
+    )
+    parser.add_argument(
+        "--species", nargs="+", choices=PLANT_OPTIONS, default=PLANT_OPTIONS
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=None,
+        help="Number of example images per species (default: all)",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.02,
+        help="Largest acceptable relative drift in count, pore length and width",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=torch.get_num_threads(),
+        help="Number of CPU threads used by both models",
+    )
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+    return args
+
+
+if __name__ == "__main__":
+    main()
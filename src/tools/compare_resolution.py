@@ -0,0 +1,123 @@
+import argparse
+from typing import List, Tuple
+
+import torch
+
+from inference.infer import (
+    InferenceEngine,
+    maybe_download_config_files,
+    maybe_download_model_weights,
+    setup_model_configuration,
+)
+from tools.constants import PLANT_OPTIONS
+from tools.mode_comparison import (
+    DRIFT_MEASUREMENTS,
+    calculate_drift,
+    is_within_tolerance,
+    load_example_images,
+    measure_images,
+)
+from tools.state import Option_State
+
+
+def main():
+    args = parse_arguments()
+    for species in args.species:
+        images = [image for _, image in load_example_images(species, args.limit)]
+        maybe_download_config_files(species)
+        maybe_download_model_weights(species)
+        configuration = setup_model_configuration(species.lower())
+        engine = InferenceEngine(configuration)
+        default_resolution = configuration.INPUT.MIN_SIZE_TEST
+        Option_State["plant_type"] = species
+        reference, reference_time = measure_at_resolution(engine, species, images, 0)
+        rows = [
+            (default_resolution, reference_time, calculate_drift(reference, reference))
+        ]
+        for scale in args.scales:
+            resolution = round(default_resolution * scale)
+            detections, time_elapsed = measure_at_resolution(
+                engine, species, images, resolution
+            )
+            rows.append(
+                (resolution, time_elapsed, calculate_drift(reference, detections))
+            )
+        print_resolution_table(species, len(images), rows, args.tolerance)
+
+
+def measure_at_resolution(engine, species: str, images: List, resolution: int):
+    Option_State["inference_resolution"][species] = resolution
+    return measure_images(engine, images)
+
+
+def print_resolution_table(
+    species: str,
+    n_images: int,
+    rows: List[Tuple],
+    tolerance: float,
+):
+    # Markdown, so the table can be pasted into the README or an issue
+    default_resolution, reference_time, _ = rows[0]
+    measurement_names = [name.replace("_", " ") for name in DRIFT_MEASUREMENTS]
+    columns = ["Resolution (px)", "Time / image (s)", "Speedup", "Count drift"]
+    columns += [f"{name} drift" for name in measurement_names]
+    columns += [f"Within {tolerance:.1%}"]
+    print(f"\n{species}, {n_images} images, model default {default_resolution} px\n")
+    print("| " + " | ".join(columns) + " |")
+    print("|" + "---|" * len(columns))
+    for resolution, time_elapsed, drift in rows:
+        speedup = reference_time / time_elapsed if time_elapsed > 0 else 0.0
+        cells = [
+            str(resolution),
+            f"{time_elapsed / n_images:.2f}",
+            f"{speedup:.2f}x",
+            f"{drift['count_drift']:.2%}",
+        ]
+        cells += [
+            f"{drift[f'{measurement}_drift']:.2%}" for measurement in DRIFT_MEASUREMENTS
+        ]
+        cells += ["yes" if is_within_tolerance(drift, tolerance) else "no"]
+        print("| " + " | ".join(cells) + " |")
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m tools.compare_resolution",
+        description="Tabulate speed and agreement with the model's default"
+        " resolution when measuring the example images at smaller resolutions.",
+    )
+    parser.add_argument(
+        "--species", nargs="+", choices=PLANT_OPTIONS, default=PLANT_OPTIONS
+    )
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        type=float,
+        default=[0.75, 0.5, 0.35],
+        help="Resolutions to compare, relative to the model's default",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=None,
+        help="Number of example images per species (default: all)",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.02,
+        help="Largest acceptable relative drift in count, pore length and width",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=torch.get_num_threads(),
+        help="Number of CPU threads used by the model",
+    )
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+    return args
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ CAMERA_CALIBRATION = {
     "Barley": 4.2736,
     "Arabidopsis": 10.25131,
 }
+# In pixels, should exceed the size of a stoma
+DEFAULT_TILE_OVERLAP = 256
 IMAGE_AREA = {
     "Barley": 0.3229496,
     "Arabidopsis": 0.04794822,
@@ -22,3 +24,11 @@ PLANT_OPTIONS = [
     "Arabidopsis",
     "Barley",
 ]
+INFERENCE_BACKENDS = [
+    "PyTorch",
+    "ONNX Runtime",
+]
+MEASUREMENT_MODES = [
+    "Keypoints",
+    "Fast",
+]
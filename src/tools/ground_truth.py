@@ -1,20 +1,19 @@
-from typing import Dict, List, Tuple, Union
+from typing import Callable, Dict, List, Tuple, Union
 
+import numpy as np
+import shapely
 import streamlit as st
-from shapely.geometry import MultiPolygon, Polygon
 
 from app.annotation_retrieval import get_ground_truth
-from inference.constants import NAMES_TO_CATEGORY_ID, ORPHAN_AREA_THRESHOLD
+from inference.association import BoundingBoxIndex
+from inference.constants import NAMES_TO_CATEGORY_ID
+from inference.keypoints import NO_KEYPOINTS, find_AB_batch, find_CD_batch
 from inference.utils import (
+    build_polygons,
     calculate_midpoint_of_keypoints,
     convert_measurements,
-    find_AB,
-    find_CD,
-    is_bbox_a_in_bbox_b,
-    is_bbox_a_mostly_in_bbox_b,
     l2_dist,
 )
-from tools.draw import format_polygon_coordinates
 
 
 def retrieve():
@@ -54,11 +53,25 @@ def separate_annotations(raw_ground_truth: List[Dict]) -> Tuple:
 
 
 def format_annotations(complexes: List[Dict], structures: List[Dict]) -> List[Dict]:
-    formatted_annotation = []
-    for complex_annotation in complexes:
-        annotation = format_annotation(complex_annotation, structures)
-        formatted_annotation.append(annotation)
-    return formatted_annotation
+    pores = build_structure_index(structures, is_stomata_pore)
+    subsidiary_cells = build_structure_index(structures, is_subsidiary_cell)
+    formatted_annotations = [
+        format_annotation(complex_annotation, pores, subsidiary_cells)
+        for complex_annotation in complexes
+    ]
+    # Areas and keypoints of all complexes are found at once
+    add_areas(formatted_annotations)
+    add_pore_keypoints(complexes, formatted_annotations)
+    add_guard_cell_keypoints(formatted_annotations)
+    return formatted_annotations
+
+
+def build_structure_index(
+    structures: List[Dict],
+    is_structure: Callable[[Dict], bool],
+) -> BoundingBoxIndex:
+    selected = [structure for structure in structures if is_structure(structure)]
+    return BoundingBoxIndex([structure["bbox"] for structure in selected], selected)
 
 
 def is_stomata_complex(annotation: Dict) -> bool:
@@ -70,76 +83,66 @@ def is_stomata_complex(annotation: Dict) -> bool:
     return class_label in complex_categories
 
 
-def format_annotation(annotation: Dict, structures: List[Dict]) -> Dict:
+def format_annotation(
+    annotation: Dict,
+    pores: BoundingBoxIndex,
+    subsidiary_cells: BoundingBoxIndex,
+) -> Dict:
     formatted = {}
     add_guard_cells(annotation, formatted)
-    maybe_add_subsidiary_cells(annotation, formatted, structures)
-    maybe_add_stomata_pore(annotation, formatted, structures)
-    add_pore_keypoints(annotation, formatted)
-    add_guard_cell_keypoints(formatted)
+    maybe_add_subsidiary_cells(annotation, formatted, subsidiary_cells)
+    maybe_add_stomata_pore(annotation, formatted, pores)
     return formatted
 
 
 def add_guard_cells(annotation: Dict, formatted: Dict):
-    guard_cell_polygon = get_guard_cell_polygon(annotation["segmentation"])
     guard_cell = {
         "bbox": annotation["bbox"],
         "category_id": annotation["category_id"],
-        "guard_cell_area": guard_cell_polygon.area,
         "guard_cell_polygons": annotation["segmentation"],
     }
     formatted.update(guard_cell)
 
 
-def get_guard_cell_polygon(polygons: List) -> MultiPolygon:
-    guard_cell_polygon = MultiPolygon(
-        [
-            Polygon(format_polygon_coordinates(polygons[0])),
-            Polygon(format_polygon_coordinates(polygons[1])),
-        ]
-    )
-    return guard_cell_polygon
-
-
-def flatten_shapely_coords(coords: List) -> List[float]:
-    flat_coords = []
-    for coord in coords:
-        flat_coords.extend(coord)
-    return flat_coords
+def add_areas(formatted_annotations: List[Dict]):
+    # Areas of the two guard cells, subsidiary cells and pore of every
+    # complex, from one call to shapely
+    polygons = []
+    for formatted in formatted_annotations:
+        polygons += formatted["guard_cell_polygons"][:2]
+        polygons += formatted["subsidiary_cell_polygons"]
+        if len(formatted["pore_polygon"]) > 0:
+            polygons.append(formatted["pore_polygon"])
+    areas = iter(shapely.area(build_polygons(polygons)).tolist())
+    for formatted in formatted_annotations:
+        formatted["guard_cell_area"] = next(areas) + next(areas)
+        subsidiary_area = 0.0
+        for _ in formatted["subsidiary_cell_polygons"]:
+            subsidiary_area += next(areas)
+        formatted["subsidiary_cell_area"] = subsidiary_area
+        pore_area = 0.0
+        if len(formatted["pore_polygon"]) > 0:
+            pore_area = next(areas)
+        formatted["pore_area"] = pore_area
 
 
 def maybe_add_subsidiary_cells(
     annotation: Dict,
     formatted: Dict,
-    structures: List[Dict],
+    subsidiary_cell_index: BoundingBoxIndex,
 ):
-    subsidiary_area, subsidiary_cell_polygons = 0.0, []
-    subsidiary_cells = find_subsidiary_cells(annotation, structures)
-
-    for subsidiary_cell in subsidiary_cells:
-        subsidiary_cell_polygon = subsidiary_cell["segmentation"][0]
-        subsidiary_area += get_polygon_area(subsidiary_cell_polygon)
-        subsidiary_cell_polygons.append(subsidiary_cell_polygon)
-    subsidiary_cells = {
-        "subsidiary_cell_polygons": subsidiary_cell_polygons,
-        "subsidiary_cell_area": subsidiary_area,
-    }
-    formatted.update(subsidiary_cells)
+    subsidiary_cells = find_subsidiary_cells(annotation, subsidiary_cell_index)
+    subsidiary_cell_polygons = [
+        subsidiary_cell["segmentation"][0] for subsidiary_cell in subsidiary_cells
+    ]
+    formatted["subsidiary_cell_polygons"] = subsidiary_cell_polygons
 
 
-def find_subsidiary_cells(complex_annotation: Dict, structures: List[Dict]) -> List:
-    subsidiary_cells = []
-    stomata_bbox = complex_annotation["bbox"]
-    for structure in structures:
-        if is_subsidiary_cell(structure):
-            cell_bbox = structure["bbox"]
-            if is_bbox_a_mostly_in_bbox_b(
-                cell_bbox,
-                stomata_bbox,
-                ORPHAN_AREA_THRESHOLD,
-            ):
-                subsidiary_cells.append(structure)
-    return subsidiary_cells
+def find_subsidiary_cells(
+    complex_annotation: Dict,
+    subsidiary_cells: BoundingBoxIndex,
+) -> List:
+    return subsidiary_cells.find_mostly_in(complex_annotation["bbox"])
 
 
 def is_subsidiary_cell(annotation: Dict) -> bool:
@@ -150,22 +153,14 @@ def is_subsidiary_cell(annotation: Dict) -> bool:
 def maybe_add_stomata_pore(
     complex_annotation: Dict,
     formatted: Dict,
-    structures: List[Dict],
+    pores: BoundingBoxIndex,
 ):
-    if is_closed_stomata(complex_annotation):
-        pore = {"pore_area": 0.0, "pore_polygon": []}
-    else:
-        pore = find_stomata_pore(complex_annotation, structures)
-        if pore is None:
-            pore = {"pore_area": 0.0, "pore_polygon": []}
-        else:
-            polygon = pore["segmentation"][0]
-            pore = {"pore_area": get_polygon_area(polygon), "pore_polygon": polygon}
-    formatted.update(pore)
-
-
-def get_polygon_area(polygon: List[float]) -> float:
-    return Polygon(format_polygon_coordinates(polygon)).area
+    pore_polygon = []
+    if not is_closed_stomata(complex_annotation):
+        pore = find_stomata_pore(complex_annotation, pores)
+        if pore is not None:
+            pore_polygon = pore["segmentation"][0]
+    formatted["pore_polygon"] = pore_polygon
 
 
 def is_closed_stomata(annotation: Dict) -> bool:
@@ -174,14 +169,11 @@ def is_closed_stomata(annotation: Dict) -> bool:
 
 
 def find_stomata_pore(
-    complex_annotation: Dict, structures: List[Dict]
+    complex_annotation: Dict, pores: BoundingBoxIndex
 ) -> Union[Dict, None]:
-    stomata_bbox = complex_annotation["bbox"]
-    for structure in structures:
-        if is_stomata_pore(structure):
-            pore_bbox = structure["bbox"]
-            if is_bbox_a_in_bbox_b(pore_bbox, stomata_bbox):
-                return structure
+    contained_pores = pores.find_contained_in(complex_annotation["bbox"])
+    if len(contained_pores) > 0:
+        return contained_pores[0]
 
 
 def is_stomata_pore(annotation: Dict) -> bool:
@@ -189,38 +181,73 @@ def is_stomata_pore(annotation: Dict) -> bool:
     return class_label == NAMES_TO_CATEGORY_ID["Stomatal Pore"]
 
 
-def add_pore_keypoints(annotation: Dict, formatted: Dict):
+def add_pore_keypoints(annotations: List[Dict], formatted_annotations: List[Dict]):
+    open_stomata = [
+        (annotation, formatted)
+        for annotation, formatted in zip(annotations, formatted_annotations)
+        if not is_closed_stomata(annotation)
+    ]
+    open_keypoints_CD = iter(
+        find_CD_batch(
+            [formatted["pore_polygon"] for _, formatted in open_stomata],
+            [annotation["keypoints"] for annotation, _ in open_stomata],
+        )
+    )
+    for annotation, formatted in zip(annotations, formatted_annotations):
+        if is_closed_stomata(annotation):
+            keypoints_CD = list(NO_KEYPOINTS)
+            pore_width = 0.0
+        else:
+            keypoints_CD = next(open_keypoints_CD)
+            pore_width = l2_dist(keypoints_CD)
+        set_pore_keypoints(annotation, formatted, keypoints_CD, pore_width)
+
+
+def set_pore_keypoints(
+    annotation: Dict,
+    formatted: Dict,
+    keypoints_CD: List[float],
+    pore_width: float,
+):
     keypoints_AB = annotation["keypoints"]
-    pore_length = l2_dist(keypoints_AB)
-    if is_closed_stomata(annotation):
-        keypoints_CD = [-1, -1, 1, -1, -1, 1]
-        pore_width = 0.0
-    else:
-        pore_polygon = formatted["pore_polygon"]
-        keypoints_CD = find_CD(pore_polygon, keypoints_AB)
-        pore_width = l2_dist(keypoints_CD)
     pore_keypoints = {
         "AB_keypoints": keypoints_AB,
         "CD_keypoints": keypoints_CD,
-        "pore_length": pore_length,
+        "pore_length": l2_dist(keypoints_AB),
         "pore_width": pore_width,
     }
     formatted.update(pore_keypoints)
 
 
-def add_guard_cell_keypoints(formatted: Dict):
-    add_guard_cell_width_keypoints(formatted)
-    add_guard_cell_groove_keypoints(formatted)
-
-
-def add_guard_cell_width_keypoints(formatted: Dict):
-    guard_cell_polygon = get_guard_cell_polygon(formatted["guard_cell_polygons"])
-    guard_cell_polygon = guard_cell_polygon.convex_hull.exterior.coords
-    guard_cell_polygon = flatten_shapely_coords(guard_cell_polygon)
+def add_guard_cell_keypoints(formatted_annotations: List[Dict]):
+    guard_cell_polygons = get_guard_cell_hulls(
+        [formatted["guard_cell_polygons"] for formatted in formatted_annotations]
+    )
+    keypoints_AB = [formatted["AB_keypoints"] for formatted in formatted_annotations]
+    width_keypoints = find_CD_batch(guard_cell_polygons, keypoints_AB)
+    groove_keypoints = find_AB_batch(guard_cell_polygons, keypoints_AB)
+    for formatted, width, groove in zip(
+        formatted_annotations, width_keypoints, groove_keypoints
+    ):
+        add_guard_cell_width_keypoints(formatted, width)
+        add_guard_cell_groove_keypoints(formatted, groove)
+
+
+def get_guard_cell_hulls(guard_cell_polygons: List[List]) -> List[List[float]]:
+    # Convex hulls of each complex's two guard cells, found for all at once
+    polygons = [polygon for polygons in guard_cell_polygons for polygon in polygons[:2]]
+    pair_indices = np.repeat(np.arange(len(guard_cell_polygons)), 2)
+    guard_cells = shapely.multipolygons(build_polygons(polygons), indices=pair_indices)
+    hulls = shapely.convex_hull(guard_cells)
+    coordinates, hull_indices = shapely.get_coordinates(hulls, return_index=True)
+    ends = np.cumsum(np.bincount(hull_indices, minlength=len(hulls)))
+    return [hull.ravel().tolist() for hull in np.split(coordinates, ends[:-1])]
+
+
+def add_guard_cell_width_keypoints(formatted: Dict, keypoints: List[float]):
     keypoints_AB = formatted["AB_keypoints"]
-    keypoints = find_CD(guard_cell_polygon, keypoints_AB)
     keypoints_CD = formatted["CD_keypoints"]
-    if keypoints_CD == [-1, -1, 1, -1, -1, 1]:
+    if keypoints_CD == NO_KEYPOINTS:
         midpoint = calculate_midpoint_of_keypoints(keypoints_AB)
         keypoints_CD = [*midpoint, 1, *midpoint, 1]
     keypoint_1 = [*keypoints[:3], *keypoints_CD[:3]]
@@ -233,12 +260,8 @@ def add_guard_cell_width_keypoints(formatted: Dict):
     formatted.update(guard_cell_width)
 
 
-def add_guard_cell_groove_keypoints(formatted: Dict):
-    guard_cell_polygon = get_guard_cell_polygon(formatted["guard_cell_polygons"])
-    guard_cell_polygon = guard_cell_polygon.convex_hull.exterior.coords
-    guard_cell_polygon = flatten_shapely_coords(guard_cell_polygon)
+def add_guard_cell_groove_keypoints(formatted: Dict, keypoints: List[float]):
     keypoints_AB = formatted["AB_keypoints"]
-    keypoints = find_AB(guard_cell_polygon, keypoints_AB)
     keypoint_1 = [*keypoints[:3], *keypoints_AB[:3]]
     keypoint_2 = [*keypoints_AB[3:], *keypoints[3:]]
     length = (l2_dist(keypoint_1) + l2_dist(keypoint_2)) / 2
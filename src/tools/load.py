@@ -54,6 +54,10 @@ def decode_downloaded_image(bytestream):
     return cv2.cvtColor(np.array(Image.open(bytestream)), cv2.COLOR_RGB2BGR)
 
 
+def load_image_from_folder(directory, filename):
+    return decode_downloaded_image(os.path.join(directory, filename))
+
+
 def preprocess_image(image):
     image = cv2.imdecode(image, cv2.IMREAD_COLOR)
     return image
@@ -111,14 +115,14 @@ def maybe_create_folders():
     os.makedirs("./assets/arabidopsis/", exist_ok=True)
     os.makedirs("./assets/barley/", exist_ok=True)
     os.makedirs("./assets/config/", exist_ok=True)
-    os.makedirs("./output/temp/", exist_ok=True)
+    os.makedirs(Option_State["output_path"], exist_ok=True)
 
 
 def clean_temporary_folder():
-    path = "./output/temp/"
+    path = Option_State["output_path"]
     files = os.listdir(path)
     for file in files:
-        os.remove(path + file)
+        os.remove(os.path.join(path, file))
 
 
 def maybe_create_visualisation_folder():
@@ -0,0 +1,109 @@
+import os
+import time
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+from inference.constants import IOU_THRESHOLD
+from inference.predictions import ModelOutput
+from inference.utils import intersection_over_union
+from tools.cloud_files import IMAGE_DICTS
+from tools.load import download_image
+
+DRIFT_MEASUREMENTS = ["pore_length", "pore_width"]
+
+
+def load_example_images(species: str, limit: int) -> List[Tuple[str, np.ndarray]]:
+    images = []
+    for image_name, urls in list(IMAGE_DICTS[species].items())[:limit]:
+        filepath = os.path.join(".", "assets", species.lower(), f"{image_name}.png")
+        if os.path.exists(filepath):
+            image = cv2.imread(filepath)
+        else:
+            image = download_image(urls["image"])
+        images.append((image_name, image))
+    return images
+
+
+def measure_images(engine, images: List[np.ndarray]) -> Tuple[List[List[Dict]], float]:
+    # Only the forward passes are timed, post-processing is shared by all modes
+    engine.run_on_image(images[0])
+    detections, time_elapsed = [], 0.0
+    for image in images:
+        start_time = time.time()
+        predictions = engine.run_on_image(image)
+        time_elapsed += time.time() - start_time
+        detections.append(ModelOutput(predictions, 0).detections)
+    return detections, time_elapsed
+
+
+def match_detections(reference: List[Dict], candidate: List[Dict]) -> List[Tuple]:
+    # Greedily pairs each reference stoma with the best overlapping candidate
+    pairs, unmatched = [], list(candidate)
+    for detection in reference:
+        ious = [
+            intersection_over_union(detection["bbox"], other["bbox"])
+            for other in unmatched
+        ]
+        if len(ious) > 0 and max(ious) > IOU_THRESHOLD:
+            pairs.append((detection, unmatched.pop(int(np.argmax(ious)))))
+    return pairs
+
+
+def calculate_drift(
+    reference: List[List[Dict]],
+    candidate: List[List[Dict]],
+    measurements: List[str] = DRIFT_MEASUREMENTS,
+) -> Dict:
+    n_reference = sum([len(detections) for detections in reference])
+    count_difference = sum([abs(len(a) - len(b)) for a, b in zip(reference, candidate)])
+    pairs = []
+    for reference_detections, candidate_detections in zip(reference, candidate):
+        pairs.extend(match_detections(reference_detections, candidate_detections))
+    drift = {
+        "n_stomata": n_reference,
+        "n_matched": len(pairs),
+        "count_drift": count_difference / max(n_reference, 1),
+    }
+    for measurement in measurements:
+        relative_differences = [
+            abs(b[measurement] - a[measurement]) / a[measurement]
+            for a, b in pairs
+            if a[measurement] > 0
+        ]
+        if len(relative_differences) == 0:
+            relative_differences = [0.0]
+        drift[f"{measurement}_drift"] = float(np.mean(relative_differences))
+        drift[f"{measurement}_max_drift"] = float(np.max(relative_differences))
+    return drift
+
+
+def is_within_tolerance(drift: Dict, tolerance: float) -> bool:
+    drifts = [drift["count_drift"]]
+    drifts += [drift[f"{measurement}_drift"] for measurement in DRIFT_MEASUREMENTS]
+    return all([value <= tolerance for value in drifts])
+
+
+def print_comparison(
+    species: str,
+    reference_time: float,
+    candidate_time: float,
+    drift: Dict,
+    tolerance: float,
+):
+    speedup = reference_time / candidate_time if candidate_time > 0 else 0.0
+    status = "within" if is_within_tolerance(drift, tolerance) else "EXCEEDS"
+    print(f"{species}:")
+    print(f"  time {reference_time:.2f}s -> {candidate_time:.2f}s ({speedup:.2f}x)")
+    print(
+        f"  stomata {drift['n_stomata']}, matched {drift['n_matched']},"
+        f" count drift {drift['count_drift']:.2%}"
+    )
+    for measurement in DRIFT_MEASUREMENTS:
+        name = measurement.replace("_", " ")
+        print(
+            f"  {name} drift {drift[f'{measurement}_drift']:.2%} mean,"
+            f" {drift[f'{measurement}_max_drift']:.2%} max"
+        )
+    print(f"  drift {status} the {tolerance:.1%} tolerance")
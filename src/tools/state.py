@@ -1,5 +1,7 @@
 import os
 
+from tools.constants import DEFAULT_TILE_OVERLAP
+
 Option_State = {
     "mode": "",
     "plant_type": "",
@@ -19,6 +21,24 @@ Option_State = {
     "minimum_stoma_length": 0.0,
     "folder_path": "",
     "folder_inference": None,
+    "output_path": "./output/temp/",
+    "batch_size": 1,
+    "n_workers": 1,
+    "prefetch_depth": 2,
+    "tile_size": 0,
+    "tile_overlap": DEFAULT_TILE_OVERLAP,
+    "inference_resolution": {"Arabidopsis": 0, "Barley": 0},
+    "calibrated_resolution": False,
+    "compact_masks": False,
+    "quantize_model": False,
+    "inference_backend": "PyTorch",
+    "measurement_mode": "Keypoints",
+    "density_only": False,
+    "use_result_cache": True,
+    "result_cache_path": "./output/cache/",
+    "parquet_output": False,
+    "stage_timing": False,
+    "timing_report_path": "./output/timings/",
     "visualisation_path": None,
     "visualise": False,
     "infer_button": False,
@@ -0,0 +1,201 @@
+import math
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+import torch
+from detectron2.structures import Boxes, Instances
+
+from inference.constants import NAMES_TO_CATEGORY_ID
+from inference.masks import LowResolutionMasks
+
+MASK_HEAD_RESOLUTION = 28
+OPEN_STOMATA_FRACTION = 0.6
+SUBSIDIARY_CELL_FRACTION = 0.7
+POINTS_PER_ELLIPSE = 64
+
+
+class SyntheticImage:
+    """
+    Stomata complexes laid out on a jittered grid, each a ring of two guard
+    cells with an optional pore and subsidiary cells, rendered either as the
+    Instances the model predicts or as ground truth annotations. Used to
+    measure post-processing without model weights. Stomata shrink as the
+    number of detections grows, so complexes stay apart at any density.
+    """
+
+    def __init__(self, n_detections: int, image_size: Tuple[int, int], seed: int):
+        self.image_size = image_size
+        self.structures = []
+        self._rng = np.random.default_rng(seed)
+        # Complexes average three structures, so half as many grid cells as
+        # detections leaves room to spare
+        n_cells = max(1, math.ceil(n_detections / 2))
+        height, width = image_size
+        n_columns = math.ceil(math.sqrt(n_cells * width / height))
+        n_rows = math.ceil(n_cells / n_columns)
+        cell_size = np.array([width / n_columns, height / n_rows])
+        semi_major = 0.3 * cell_size.min()
+        for k in range(n_columns * n_rows):
+            if len(self.structures) >= n_detections:
+                break
+            row, column = divmod(k, n_columns)
+            jitter = self._rng.uniform(-0.05, 0.05, 2) * cell_size
+            center = (np.array([column, row]) + 0.5) * cell_size + jitter
+            self._add_complex(center, semi_major, self._rng.uniform(0, 180))
+        self.structures = self.structures[:n_detections]
+
+    def _add_complex(self, center: np.ndarray, semi_major: float, angle: float):
+        axes = (semi_major, 0.5 * semi_major)
+        pore_axes = (0.6 * axes[0], 0.3 * axes[1])
+        theta = math.radians(angle)
+        direction = np.array([math.cos(theta), math.sin(theta)])
+        is_open = self._rng.uniform() < OPEN_STOMATA_FRACTION
+        category = "Open Stomata" if is_open else "Closed Stomata"
+        complex_structure = self._add_structure(category, center, axes, angle)
+        complex_structure["hole_axes"] = pore_axes
+        complex_structure["keypoints"] = [
+            *(center - pore_axes[0] * direction),
+            1.0,
+            *(center + pore_axes[0] * direction),
+            1.0,
+        ]
+        if is_open:
+            self._add_structure("Stomatal Pore", center, pore_axes, angle)
+        normal = np.array([-direction[1], direction[0]])
+        for side in [-1, 1]:
+            if self._rng.uniform() < SUBSIDIARY_CELL_FRACTION:
+                subsidiary_center = center + side * 0.75 * axes[1] * normal
+                subsidiary_axes = (0.9 * axes[0], 0.35 * axes[1])
+                self._add_structure(
+                    "Subsidiary cells", subsidiary_center, subsidiary_axes, angle
+                )
+
+    def _add_structure(
+        self,
+        category: str,
+        center: np.ndarray,
+        axes: Tuple[float, float],
+        angle: float,
+    ) -> Dict:
+        structure = {
+            "category_id": NAMES_TO_CATEGORY_ID[category],
+            "center": center,
+            "axes": axes,
+            "angle": angle,
+            "polygon": get_ellipse_points(center, axes, angle),
+            "hole_axes": None,
+            "keypoints": [0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+            "confidence": float(self._rng.uniform(0.6, 1.0)),
+        }
+        self.structures.append(structure)
+        return structure
+
+    def to_instances(self, compact_masks: bool = False) -> Instances:
+        height, width = self.image_size
+        boxes = np.array(
+            [get_bounding_box(s, self.image_size) for s in self.structures]
+        )
+        instances = Instances(self.image_size)
+        instances.pred_boxes = Boxes(torch.tensor(boxes, dtype=torch.float32))
+        instances.scores = torch.tensor([s["confidence"] for s in self.structures])
+        instances.pred_classes = torch.tensor(
+            [s["category_id"] for s in self.structures], dtype=torch.int64
+        )
+        keypoints = [s["keypoints"] for s in self.structures]
+        instances.pred_keypoints = torch.tensor(keypoints).reshape(-1, 2, 3)
+        if compact_masks:
+            masks = [
+                self._render_mask_head_output(structure, box)
+                for structure, box in zip(self.structures, boxes)
+            ]
+            instances.pred_masks = LowResolutionMasks(
+                torch.tensor(np.array(masks)),
+                instances.pred_boxes.tensor.clone(),
+                self.image_size,
+            )
+        else:
+            masks = np.zeros((len(self), height, width), dtype=bool)
+            for mask, structure in zip(masks, self.structures):
+                draw_structure(mask, structure, (0, 0))
+            instances.pred_masks = torch.from_numpy(masks)
+        return instances
+
+    def _render_mask_head_output(self, structure: Dict, box: np.ndarray) -> np.ndarray:
+        x1, y1, x2, y2 = [int(v) for v in box]
+        patch = np.zeros((max(y2 - y1, 1), max(x2 - x1, 1)), dtype=bool)
+        draw_structure(patch, structure, (x1, y1))
+        size = (MASK_HEAD_RESOLUTION, MASK_HEAD_RESOLUTION)
+        return cv2.resize(patch.astype(np.float32), size, interpolation=cv2.INTER_AREA)
+
+    def to_ground_truth(self) -> List[Dict]:
+        # Annotations as stored, with COCO style xywh boxes and flat polygons
+        annotations = []
+        for structure in self.structures:
+            x1, y1, x2, y2 = get_bounding_box(structure, self.image_size)
+            annotation = {
+                "category_id": structure["category_id"],
+                "bbox": [x1, y1, x2 - x1, y2 - y1],
+                "keypoints": structure["keypoints"],
+            }
+            if structure["hole_axes"] is None:
+                annotation["segmentation"] = [structure["polygon"].flatten().tolist()]
+            else:
+                annotation["segmentation"] = split_into_guard_cells(structure)
+            annotations.append(annotation)
+        return annotations
+
+    def __len__(self) -> int:
+        return len(self.structures)
+
+
+def get_ellipse_points(
+    center: np.ndarray,
+    axes: Tuple[float, float],
+    angle: float,
+    start: float = 0.0,
+    end: float = 360.0,
+) -> np.ndarray:
+    endpoint = end - start < 360
+    t = np.radians(np.linspace(start, end, POINTS_PER_ELLIPSE, endpoint=endpoint))
+    theta = math.radians(angle)
+    x = axes[0] * np.cos(t)
+    y = axes[1] * np.sin(t)
+    points = np.stack(
+        [
+            center[0] + x * math.cos(theta) - y * math.sin(theta),
+            center[1] + x * math.sin(theta) + y * math.cos(theta),
+        ],
+        axis=1,
+    )
+    return points
+
+
+def get_bounding_box(structure: Dict, image_size: Tuple[int, int]) -> List[float]:
+    height, width = image_size
+    x1, y1 = np.clip(structure["polygon"].min(axis=0), 0, [width, height])
+    x2, y2 = np.clip(structure["polygon"].max(axis=0) + 1, 0, [width, height])
+    return [float(x1), float(y1), float(x2), float(y2)]
+
+
+def draw_structure(mask: np.ndarray, structure: Dict, offset: Tuple[int, int]):
+    canvas = mask.view(np.uint8)
+    polygon = np.round(structure["polygon"] - offset).astype(np.int32)
+    cv2.fillPoly(canvas, [polygon], 1)
+    if structure["hole_axes"] is not None:
+        hole = get_ellipse_points(
+            structure["center"], structure["hole_axes"], structure["angle"]
+        )
+        cv2.fillPoly(canvas, [np.round(hole - offset).astype(np.int32)], 0)
+
+
+def split_into_guard_cells(structure: Dict) -> List[List[float]]:
+    # Each guard cell is half of the outer ellipse closed by half of the pore
+    center, angle = structure["center"], structure["angle"]
+    guard_cells = []
+    for start in [0.0, 180.0]:
+        end = start + 180
+        outer = get_ellipse_points(center, structure["axes"], angle, start, end)
+        inner = get_ellipse_points(center, structure["hole_axes"], angle, start, end)
+        guard_cells.append(np.concatenate([outer, inner[::-1]]).flatten().tolist())
+    return guard_cells
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The packages are imported from src, as the app runs them
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
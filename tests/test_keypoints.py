@@ -0,0 +1,74 @@
+from typing import List, Tuple, Union
+
+import numpy as np
+import pytest
+
+from inference.keypoints import NO_KEYPOINTS, find_keypoints, find_keypoints_batch
+
+# Largest acceptable difference between the coordinates of matching keypoints
+KEYPOINT_TOLERANCE = 1e-9
+POINTS_PER_ELLIPSE = 64
+
+
+def build_pores(
+    n_pores: int,
+    seed: int,
+) -> Tuple[List[List[float]], List[Union[List[float], None]]]:
+    # Pores as smooth ellipses and rounded to whole pixels, as traced from
+    # masks, which gives collinear edges and vertices on the keypoint lines.
+    # Each is given with its keypoints and without, so they are extracted
+    rng = np.random.default_rng(seed)
+    polygons, keypoints = [], []
+    for _ in range(n_pores):
+        centre = rng.uniform(50, 950, size=2)
+        axes = rng.uniform([5, 1], [40, 12])
+        angle = rng.uniform(0, np.pi)
+        points, pore_keypoints = get_ellipse(centre, axes, angle)
+        for polygon in [points, np.round(points)]:
+            polygons += [polygon.flatten().tolist()] * 2
+            keypoints += [pore_keypoints, None]
+    return polygons, keypoints
+
+
+def get_ellipse(
+    centre: np.ndarray,
+    axes: np.ndarray,
+    angle: float,
+) -> Tuple[np.ndarray, List[float]]:
+    theta = np.linspace(0, 2 * np.pi, POINTS_PER_ELLIPSE, endpoint=False)
+    x, y = axes[0] * np.cos(theta), axes[1] * np.sin(theta)
+    cos, sin = np.cos(angle), np.sin(angle)
+    points = np.stack([x * cos - y * sin, x * sin + y * cos], axis=1) + centre
+    (x_1, y_1), (x_2, y_2) = points[0], points[POINTS_PER_ELLIPSE // 2]
+    return points, [x_1, y_1, 1, x_2, y_2, 1]
+
+
+def build_rectangles() -> Tuple[List[List[float]], List[Union[List[float], None]]]:
+    # Keypoint lines ending on the polygon's edges and passing through vertices
+    polygons = [[10, 10, 40, 10, 40, 20, 10, 20]] * 4
+    keypoints = [[10, 15, 1, 40, 15, 1], [25, 10, 1, 25, 20, 1], None]
+    keypoints += [[10, 10, 1, 40, 20, 1]]
+    return polygons, keypoints
+
+
+def is_matching(keypoints: List[float], expected: List[float]) -> bool:
+    difference = np.abs(np.subtract(keypoints, expected))
+    return bool((difference <= KEYPOINT_TOLERANCE).all())
+
+
+@pytest.mark.parametrize("flip_line", [True, False])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_batched_keypoints_match_shapely(flip_line: bool, seed: int):
+    polygons, keypoints = build_pores(200, seed)
+    rectangles, rectangle_keypoints = build_rectangles()
+    polygons += rectangles + [[]]
+    keypoints += rectangle_keypoints + [None]
+    batched = find_keypoints_batch(polygons, keypoints, flip_line)
+    for i, (polygon, polygon_keypoints) in enumerate(zip(polygons, keypoints)):
+        expected = find_keypoints(polygon, polygon_keypoints, flip_line)
+        assert is_matching(batched[i], expected), f"polygon {i}"
+
+
+def test_batched_keypoints_without_polygons():
+    assert find_keypoints_batch([[], []], [None, None], True) == [NO_KEYPOINTS] * 2
+    assert find_keypoints_batch([], [], False) == []